@@ -0,0 +1 @@
+"""بنچمارک‌های کارایی AmeleClashBot"""
@@ -0,0 +1,68 @@
+"""
+بنچمارک تاخیر هر کوئری: اتصال جدید برای هر کوئری در برابر اتصال‌های ماندگار
+
+اجرا:
+    python -m benchmarks.bench_connections --users 100000
+"""
+
+import argparse
+import random
+import sqlite3
+import statistics
+import time
+
+from main import Database
+from benchmarks.datagen import generate_database
+
+
+def legacy_get_user_row(db_path: str, user_id: int):
+    """رفتار قبلی execute_query: باز و بسته کردن اتصال برای هر کوئری"""
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+    results = cursor.fetchall()
+    conn.close()
+    return results
+
+
+def measure(fn, ids) -> list:
+    """اندازه‌گیری زمان هر فراخوانی به میکروثانیه"""
+    samples = []
+    for user_id in ids:
+        start = time.perf_counter()
+        fn(user_id)
+        samples.append((time.perf_counter() - start) * 1_000_000)
+    return samples
+
+
+def report(name: str, samples: list):
+    samples = sorted(samples)
+    p99 = samples[int(len(samples) * 0.99) - 1]
+    print(
+        f"{name:<22} mean={statistics.mean(samples):8.1f}us  "
+        f"p50={statistics.median(samples):8.1f}us  p99={p99:8.1f}us"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--queries', type=int, default=20_000)
+    parser.add_argument('--db', default='bench_users.db')
+    args = parser.parse_args()
+    
+    db_path = generate_database(args.db, args.users)
+    rng = random.Random(1)
+    ids = [rng.randint(1, args.users) for _ in range(args.queries)]
+    
+    db = Database(db_path)
+    report('connect-per-query', measure(lambda uid: legacy_get_user_row(db_path, uid), ids))
+    report('pooled connections', measure(lambda uid: db.execute_query(
+        'SELECT * FROM users WHERE user_id = ?', (uid,)), ids))
+    report('pooled get_user', measure(db.get_user, ids))
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+بنچمارک پردازش دسته‌ای اقتصاد (NumPy) و بررسی برابری با GameEngine.production_for
+
+اجرا:
+    python -m benchmarks.bench_economy --users 100000
+"""
+
+import argparse
+import sys
+import time
+from typing import Tuple
+
+from main import (
+    Database, GameEngine, EconomyBatchEngine, BuildingType, RESOURCE_PRODUCTION,
+    PRODUCTION_RATE_COLUMNS, ECONOMY_CHUNK_SIZE
+)
+from benchmarks.datagen import generate_database
+
+
+def add_duplicate_buildings(db: Database, users: int) -> list:
+    """ساختن معدن و جمع‌کننده دوم برای چند کاربر؛ نرخ‌ها مثل upgrade_building افزایشی به‌روز می‌شوند"""
+    user_ids = list(range(1, users + 1))
+    with db.transaction() as uow:
+        for user_id in user_ids:
+            for building_type, column in PRODUCTION_RATE_COLUMNS.items():
+                uow.execute(
+                    'INSERT INTO buildings (user_id, building_type, level) VALUES (?, ?, 1)',
+                    (user_id, building_type.value)
+                )
+                uow.increment_user(user_id, **{column: RESOURCE_PRODUCTION[building_type][1]})
+    return user_ids
+
+
+def check_parity(db: Database, engine: EconomyBatchEngine, now: float, sample: int) -> Tuple[int, int]:
+    """مقایسه نتیجه برداری با محاسبه تک‌کاربره روی sample کاربر اول؛ (تعداد مقایسه، تعداد اختلاف)"""
+    game = GameEngine(db)
+    compared = mismatches = 0
+    for chunk in engine.iter_chunks():
+        gold, elixir = engine.compute_accrual(chunk, now)
+        for i, user_id in enumerate(chunk['user_id'][:sample - compared].tolist()):
+            expected = game.production_for(db.get_user(user_id), now)
+            if expected != {'gold': int(gold[i]), 'elixir': int(elixir[i])}:
+                mismatches += 1
+                print(f"mismatch user={user_id}: scalar={expected} "
+                      f"vectorized={{'gold': {gold[i]}, 'elixir': {elixir[i]}}}")
+            compared += 1
+        if compared >= sample:
+            break
+    return compared, mismatches
+
+
+def check_rate_sums(db: Database, engine: EconomyBatchEngine, user_ids: list) -> int:
+    """نرخ هر کاربر باید جمع نرخ همه ساختمان‌های آن نوع باشد (حتی با ساختمان تکراری)؛ تعداد کاربران ناهمخوان"""
+    expected = {}
+    for building_type, column in PRODUCTION_RATE_COLUMNS.items():
+        for user_id, level in db.execute_query(
+            f'''SELECT user_id, level FROM buildings
+            WHERE building_type = ? AND user_id IN ({', '.join('?' * len(user_ids))})''',
+            (building_type.value, *user_ids)
+        ):
+            key = (user_id, column)
+            expected[key] = expected.get(key, 0) + RESOURCE_PRODUCTION[building_type][level]
+    
+    wanted = set(user_ids)
+    mismatches = 0
+    for chunk in engine.iter_chunks():
+        for i, user_id in enumerate(chunk['user_id'].tolist()):
+            if user_id not in wanted:
+                continue
+            wanted.discard(user_id)
+            batch = {column: int(chunk[column][i]) for column in PRODUCTION_RATE_COLUMNS.values()}
+            summed = {column: expected.get((user_id, column), 0) for column in batch}
+            if batch != summed:
+                mismatches += 1
+                print(f"rate mismatch user={user_id}: batch={batch} buildings={summed}")
+        if not wanted:
+            break
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--parity-sample', type=int, default=5_000)
+    parser.add_argument('--hours', type=float, default=5.0)
+    parser.add_argument('--chunk-size', type=int, default=ECONOMY_CHUNK_SIZE)
+    parser.add_argument('--duplicates', type=int, default=100)
+    parser.add_argument('--db', default='bench_economy.db')
+    args = parser.parse_args()
+    
+    db = Database(generate_database(args.db, args.users))
+    engine = EconomyBatchEngine(db, chunk_size=args.chunk_size)
+    now = time.time() + args.hours * 3600
+    
+    # کاربرانی با دو معدن/جمع‌کننده؛ جدول buildings یکتایی (user_id, building_type) ندارد
+    duplicated = add_duplicate_buildings(db, min(args.duplicates, args.users))
+    rate_mismatches = check_rate_sums(db, engine, duplicated)
+    print(f"duplicate buildings: {len(duplicated) - rate_mismatches}/{len(duplicated)} rate sums match")
+    
+    compared, mismatches = check_parity(db, engine, now, args.parity_sample)
+    print(f"parity: {compared - mismatches}/{compared} users match")
+    mismatches += rate_mismatches
+    
+    start = time.perf_counter()
+    stats = engine.run_offline_accrual(now)
+    elapsed = time.perf_counter() - start
+    total = db.execute_query('SELECT COUNT(*) FROM users')[0][0]
+    print(f"offline accrual: {total} users in {elapsed:.2f}s "
+          f"({total / elapsed:,.0f} users/sec, {stats['users']} updated)")
+    db.close()
+    
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
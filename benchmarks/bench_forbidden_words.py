@@ -0,0 +1,83 @@
+"""
+بنچمارک فیلتر کلمات ممنوعه: حلقه قبلی روی همه کلمات در برابر خودکاره Aho-Corasick
+
+لیست کلمات و پیام‌ها به صورت مصنوعی (با seed ثابت) از حروف فارسی ساخته می‌شوند.
+
+اجرا:
+    python -m benchmarks.bench_forbidden_words --words 5000
+"""
+
+import argparse
+import random
+import sys
+
+from main import WordMatcher
+from benchmarks.bench_connections import measure, report
+
+PERSIAN_LETTERS = 'ابپتثجچحخدذرزژسشصضطظعغفقکگلمنوهی'
+
+# گونه‌های نوشتاری که کاربران برای دور زدن فیلتر استفاده می‌کنند
+VARIANTS = {'ی': 'ي', 'ک': 'ك', 'ه': 'ة'}
+
+
+def legacy_check(words, text: str):
+    """رفتار قبلی check_forbidden_words"""
+    found_words = []
+    for word in words:
+        if word in text.lower():
+            found_words.append(word)
+    return len(found_words) > 0, found_words
+
+
+def make_word(rng: random.Random) -> str:
+    return ''.join(rng.choice(PERSIAN_LETTERS) for _ in range(rng.randint(3, 8)))
+
+
+def make_message(rng: random.Random, words, hit_rate: float) -> str:
+    tokens = [make_word(rng) for _ in range(rng.randint(3, 25))]
+    if rng.random() < hit_rate:
+        tokens.insert(rng.randrange(len(tokens) + 1), rng.choice(words))
+    return ' '.join(tokens)
+
+
+def obfuscate(rng: random.Random, word: str) -> str:
+    """درج نیم‌فاصله، کشیده و حروف عربی در کلمه"""
+    chars = [VARIANTS.get(c, c) for c in word]
+    chars.insert(rng.randrange(1, len(chars)), rng.choice(['‌', 'ـ']))
+    return ''.join(chars)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--words', type=int, default=5_000)
+    parser.add_argument('--messages', type=int, default=5_000)
+    parser.add_argument('--hit-rate', type=float, default=0.05)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    words = sorted({make_word(rng) for _ in range(args.words)})
+    messages = [make_message(rng, words, args.hit_rate) for _ in range(args.messages)]
+
+    matcher = WordMatcher(words)
+
+    # هر کلمه‌ای که حلقه قبلی پیدا کند باید خودکاره هم پیدا کند
+    mismatches = sum(
+        1 for text in messages
+        if set(legacy_check(words, text)[1]) - set(matcher.find(text))
+    )
+    print(f"parity: {args.messages - mismatches}/{args.messages} messages match")
+
+    evasions = [obfuscate(rng, rng.choice(words)) for _ in range(1_000)]
+    legacy_caught = sum(1 for text in evasions if legacy_check(words, text)[0])
+    matcher_caught = sum(1 for text in evasions if matcher.find(text))
+    print(f"obfuscated variants caught: legacy={legacy_caught}/1000 matcher={matcher_caught}/1000")
+
+    indexes = range(len(messages))
+    report(f'legacy ({len(words)} words)', measure(lambda i: legacy_check(words, messages[i]), indexes))
+    report('aho-corasick', measure(lambda i: matcher.find(messages[i]), indexes))
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+بنچمارک مسیر دیتابیسی منوی اصلی (collect_resources -> calculate_production)
+
+مقایسه محاسبه قبلی (کوئری ساختمان‌ها برای هر نمایش) با ستون‌های نرخ تولید.
+
+اجرا:
+    python -m benchmarks.bench_main_menu --users 100000
+"""
+
+import argparse
+import random
+import time
+
+from main import Database, GameEngine, BuildingType, UpdateContext
+from benchmarks.datagen import generate_database
+from benchmarks.bench_connections import measure, report
+
+
+def legacy_calculate_production(game: GameEngine, user_id: int):
+    """محاسبه قبلی: خواندن همه ساختمان‌ها و تبدیل هر ردیف به BuildingType"""
+    user = game.db.get_user(user_id)
+    buildings = game.db.execute_query(
+        'SELECT building_type, level FROM buildings WHERE user_id = ?',
+        (user_id,)
+    )
+    hours_passed = (time.time() - user.last_collection_epoch) / 3600
+    
+    gold_production = 0
+    elixir_production = 0
+    for building in buildings:
+        b_type = BuildingType(building['building_type'])
+        level = building['level']
+        if b_type == BuildingType.GOLD_MINE:
+            gold_production += int(game.resource_production.get(b_type, {}).get(level, 0) * hours_passed)
+        elif b_type == BuildingType.ELIXIR_COLLECTOR:
+            elixir_production += int(game.resource_production.get(b_type, {}).get(level, 0) * hours_passed)
+    
+    max_storage = 50000 * user.level
+    return {
+        'gold': max(0, min(gold_production, max_storage - user.gold)),
+        'elixir': max(0, min(elixir_production, max_storage - user.elixir)),
+    }
+
+
+def in_update(fn):
+    """اجرای هر فراخوانی داخل یک کانتکست آپدیت جدا (مثل یک نمایش منو)"""
+    def wrapper(user_id):
+        with UpdateContext.scope():
+            fn(user_id)
+    return wrapper
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--queries', type=int, default=20_000)
+    parser.add_argument('--db', default='bench_users.db')
+    args = parser.parse_args()
+    
+    db = Database(generate_database(args.db, args.users))
+    game = GameEngine(db)
+    rng = random.Random(1)
+    ids = [rng.randint(1, args.users) for _ in range(args.queries)]
+    
+    # با کش خالی (هر نمایش منو برای کاربر جدید)
+    db.user_cache.max_size = 0
+    report('buildings query', measure(in_update(lambda uid: legacy_calculate_production(game, uid)), ids))
+    report('rate columns', measure(in_update(game.calculate_production), ids))
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+بنچمارک ستون‌های زمانی: متن ISO با DATE(...) در برابر epoch عددی با BETWEEN
+
+- پلن و تاخیر شمارش حمله‌های امروز یک بازیکن
+- هزینه تبدیل زمان متنی (fromisoformat) در برابر تفریق عددی
+- سرعت تبدیل آنلاین ردیف‌های قدیمی (backfill_timestamps)
+
+اجرا:
+    python -m benchmarks.bench_timestamps --users 100000 --attacks 1000000
+"""
+
+import argparse
+import datetime
+import random
+import time
+
+from main import Database, day_range, parse_legacy_time
+from benchmarks.datagen import generate_database
+from benchmarks.bench_connections import measure, report
+
+ATTACK_COUNT_QUERIES = [
+    (
+        'DATE(timestamp) (before)',
+        '''SELECT COUNT(*) FROM attack_logs
+        WHERE attacker_id = ? AND DATE(timestamp) = DATE('now')''',
+        lambda user_id: (user_id,),
+    ),
+    (
+        'epoch BETWEEN (after)',
+        '''SELECT COUNT(*) FROM attack_logs
+        WHERE attacker_id = ? AND timestamp_epoch BETWEEN ? AND ?''',
+        lambda user_id: (user_id, *day_range()),
+    ),
+]
+
+
+def seed_attack_logs(db: Database, users: int, attacks: int, days: int = 30):
+    """لاگ حمله در بازه چند روز گذشته؛ ستون متنی و عددی هر دو پر می‌شوند"""
+    if db.execute_query('SELECT COUNT(*) FROM attack_logs')[0][0]:
+        return
+
+    rng = random.Random(7)
+    now = int(time.time())
+    rows = []
+    for _ in range(attacks):
+        ts = now - rng.randint(0, days * 86400)
+        rows.append((
+            rng.randint(1, users), rng.randint(1, users), 'win', 10, '{}',
+            datetime.datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'), ts,
+        ))
+    with db.transaction() as uow:
+        uow.executemany(
+            '''INSERT INTO attack_logs
+            (attacker_id, defender_id, result, trophies_change, resources_stolen, timestamp, timestamp_epoch)
+            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            rows
+        )
+
+
+def print_plan(db: Database, name: str, query: str, params: tuple):
+    print(name)
+    for row in db.execute_query('EXPLAIN QUERY PLAN ' + query, params):
+        print(f"       {row['detail']}")
+
+
+def measure_backfill(db: Database, batch_size: int) -> float:
+    """پاک کردن ستون epoch و اندازه‌گیری سرعت پر کردن دوباره آن (ردیف در ثانیه)"""
+    with db.transaction() as uow:
+        uow.execute('UPDATE attack_logs SET timestamp_epoch = NULL')
+        uow.execute("UPDATE backfills SET last_rowid = 0, done = 0 WHERE name = 'attack_logs.timestamp'")
+        uow.execute("UPDATE backfills SET done = 1 WHERE name != 'attack_logs.timestamp'")
+
+    total = db.execute_query('SELECT COUNT(*) FROM attack_logs')[0][0]
+    start = time.perf_counter()
+    while db.backfill_timestamps(batch_size):
+        pass
+    elapsed = time.perf_counter() - start
+
+    missing = db.execute_query('SELECT COUNT(*) FROM attack_logs WHERE timestamp_epoch IS NULL')[0][0]
+    assert missing == 0, f"{missing} rows were not backfilled"
+    return total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--attacks', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=5_000)
+    parser.add_argument('--batch-size', type=int, default=5_000)
+    parser.add_argument('--db', default='bench_timestamps.db')
+    args = parser.parse_args()
+
+    db = Database(generate_database(args.db, args.users))
+    seed_attack_logs(db, args.users, args.attacks)
+
+    rng = random.Random(1)
+    ids = [rng.randint(1, args.users) for _ in range(args.queries)]
+
+    for name, query, params in ATTACK_COUNT_QUERIES:
+        print_plan(db, name, query, params(1))
+    for name, query, params in ATTACK_COUNT_QUERIES:
+        report(name, measure(lambda uid: db.execute_query(query, params(uid)), ids))
+
+    # مسیر داغ production_for: تبدیل متن در برابر عدد
+    text_value = datetime.datetime.now().isoformat()
+    epoch_value = int(time.time())
+    report('parse ISO text', measure(lambda _: time.time() - parse_legacy_time(text_value), ids))
+    report('epoch integer', measure(lambda _: time.time() - epoch_value, ids))
+
+    rate = measure_backfill(db, args.batch_size)
+    print(f"backfill: {rate:,.0f} rows/sec (batch={args.batch_size})")
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
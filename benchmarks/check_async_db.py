@@ -0,0 +1,108 @@
+"""
+بررسی AsyncDatabase: یک کوئری کند نباید پاسخ بقیه بازیکن‌ها را معطل کند
+و متدهای نویسنده هیچ‌وقت همزمان روی تنها نویسنده اجرا نشوند
+
+اجرا:
+    python -m benchmarks.check_async_db --stall 0.5
+"""
+
+import argparse
+import asyncio
+import sys
+import threading
+import time
+
+from main import Database, AsyncDatabase
+from benchmarks.datagen import generate_database
+
+# شمارش تا N با CTE بازگشتی؛ فقط CPU مصرف می‌کند و GIL را آزاد نگه می‌دارد
+SLOW_QUERY = '''WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < ?)
+SELECT COUNT(*) FROM c'''
+
+
+def calibrate(db: Database, stall: float) -> int:
+    """N لازم برای اینکه SLOW_QUERY حدود stall ثانیه طول بکشد"""
+    n = 100_000
+    while True:
+        start = time.perf_counter()
+        db.execute_query(SLOW_QUERY, (n,))
+        elapsed = time.perf_counter() - start
+        if elapsed > 0.05:
+            return int(n * stall / elapsed)
+        n *= 4
+
+
+async def check_slow_read(adb: AsyncDatabase, n: int, stall: float, user_id: int) -> bool:
+    """get_user در حین اجرای کوئری کند باید خیلی زودتر از stall تمام شود"""
+    slow = asyncio.create_task(adb.execute_query(SLOW_QUERY, (n,)))
+    await asyncio.sleep(0.05)
+
+    start = time.perf_counter()
+    user = await adb.get_user(user_id)
+    fast_elapsed = time.perf_counter() - start
+    slow_running = not slow.done()
+
+    await slow
+    slow_elapsed = time.perf_counter() - start + 0.05
+
+    passed = user is not None and slow_running and fast_elapsed < stall / 5
+    print(f"{'OK  ' if passed else 'FAIL'} get_user during slow query: "
+          f"{fast_elapsed * 1000:.1f}ms (slow query {slow_elapsed * 1000:.0f}ms, "
+          f"still running={slow_running})")
+    return passed
+
+
+async def check_single_writer(adb: AsyncDatabase, db: Database, user_ids: list) -> bool:
+    """بازه اجرای متدهای نویسنده نباید روی هم بیفتد"""
+    intervals = []
+    threads = set()
+    update_user = db.update_user
+
+    def tracked_update_user(user_id: int, **kwargs):
+        start = time.perf_counter()
+        threads.add(threading.current_thread().name)
+        # مکث عمدی تا اجرای همزمان (اگر رخ دهد) حتما دیده شود
+        time.sleep(0.05)
+        update_user(user_id, **kwargs)
+        intervals.append((start, time.perf_counter()))
+
+    db.update_user = tracked_update_user
+    try:
+        await asyncio.gather(*(adb.update_user(uid, gold=1000) for uid in user_ids))
+    finally:
+        del db.update_user
+
+    intervals.sort()
+    overlaps = sum(1 for a, b in zip(intervals, intervals[1:]) if b[0] < a[1])
+    passed = overlaps == 0 and len(intervals) == len(user_ids) and len(threads) == 1
+    print(f"{'OK  ' if passed else 'FAIL'} {len(intervals)} concurrent writes: "
+          f"{overlaps} overlaps on threads {sorted(threads)}")
+    return passed
+
+
+async def run_checks(db: Database, stall: float) -> bool:
+    adb = AsyncDatabase(db)
+    try:
+        n = calibrate(db, stall)
+        ok = await check_slow_read(adb, n, stall, user_id=1)
+        ok = await check_single_writer(adb, db, [2, 3, 4, 5]) and ok
+    finally:
+        adb.close()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1_000)
+    parser.add_argument('--stall', type=float, default=0.5)
+    parser.add_argument('--db', default='bench_async_db.db')
+    args = parser.parse_args()
+
+    db = Database(generate_database(args.db, args.users))
+    ok = asyncio.run(run_checks(db, args.stall))
+    db.close()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
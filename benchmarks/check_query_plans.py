@@ -0,0 +1,118 @@
+"""
+بررسی EXPLAIN QUERY PLAN کوئری‌های پرتکرار؛ هر کوئری باید از ایندکس استفاده کند
+
+اجرا:
+    python -m benchmarks.check_query_plans --users 10000
+"""
+
+import argparse
+import sys
+
+from main import Database, ADMIN_ID
+from benchmarks.datagen import generate_database
+
+# (نام، کوئری، پارامترها، ایندکس مورد انتظار)
+HOT_QUERIES = [
+    (
+        'show_profile_menu attack count',
+        '''SELECT COUNT(*) FROM attack_logs 
+        WHERE attacker_id = ? AND timestamp_epoch BETWEEN ? AND ?''',
+        (1, 1704067200, 1704153599),
+        'idx_attack_logs_attacker_epoch',
+    ),
+    (
+        'get_user_missions',
+        'SELECT * FROM missions WHERE user_id = ? AND mission_day = ?',
+        (1, 20000),
+        'idx_missions_user_day_type',
+    ),
+    (
+        'apply_mission_progress',
+        '''UPDATE missions SET current_value = current_value + CASE WHEN completed = 0 THEN ? ELSE 0 END
+        WHERE user_id = ? AND mission_day = ? AND mission_type = ?''',
+        (1, 1, 20000, 'send_clan_messages'),
+        'idx_missions_user_day_type',
+    ),
+    (
+        'apply_mission_progress completed',
+        '''SELECT mission_id, user_id, mission_type, reward_gold, reward_elixir, reward_gem
+        FROM missions
+        WHERE user_id IN (1, 2, 3) AND mission_day = ? AND completed = 0
+        AND current_value >= target_value''',
+        (20000,),
+        'idx_missions_user_day_type',
+    ),
+    (
+        'prune_missions',
+        '''DELETE FROM missions WHERE mission_id IN (
+            SELECT mission_id FROM missions WHERE mission_day < ? LIMIT ?
+        )''',
+        (20000, 5000),
+        'idx_missions_day',
+    ),
+    (
+        'get_top_players',
+        '''SELECT * FROM users 
+        WHERE banned = 0 AND user_id != ?
+        ORDER BY trophies DESC, level DESC
+        LIMIT ?''',
+        (ADMIN_ID, 10),
+        'idx_users_leaderboard',
+    ),
+    (
+        'EconomyBatchEngine.iter_chunks',
+        '''SELECT u.user_id, u.level, u.gold, u.elixir, u.trophies, u.storage_cap,
+               COALESCE(u.last_collection_epoch, u.last_collection_time),
+               u.gold_rate, u.elixir_rate
+        FROM users u
+        WHERE u.user_id > ? AND +u.banned = 0
+        ORDER BY u.user_id
+        LIMIT ?''',
+        (5000, 20000),
+        'INTEGER PRIMARY KEY',
+    ),
+    (
+        'get_pending_reports',
+        '''SELECT r.*, 
+               u1.game_name as reporter_name,
+               u2.game_name as reported_name
+        FROM reports r
+        JOIN users u1 ON r.reporter_id = u1.user_id
+        JOIN users u2 ON r.reported_user_id = u2.user_id
+        WHERE r.status = 'pending'
+        ORDER BY r.created_at DESC''',
+        (),
+        'idx_reports_status_created',
+    ),
+]
+
+
+def check_plans(db: Database) -> bool:
+    """چاپ پلن هر کوئری و بررسی استفاده از ایندکس مورد انتظار"""
+    ok = True
+    for name, query, params, index in HOT_QUERIES:
+        plan = [row['detail'] for row in db.execute_query('EXPLAIN QUERY PLAN ' + query, params)]
+        passed = any(index in step for step in plan) and not any(
+            'TEMP B-TREE' in step for step in plan
+        )
+        ok = ok and passed
+        print(f"{'OK  ' if passed else 'FAIL'} {name}")
+        for step in plan:
+            print(f"       {step}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--db', default='bench_plans.db')
+    args = parser.parse_args()
+    
+    db = Database(generate_database(args.db, args.users))
+    ok = check_plans(db)
+    db.close()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+ساخت دیتابیس مصنوعی برای بنچمارک‌ها
+"""
+
+import os
+import random
+import sqlite3
+import time
+
+from main import Database, BuildingType, UserRole, RESOURCE_PRODUCTION, STORAGE_CAP_PER_LEVEL
+
+BUILDING_TYPES = [
+    BuildingType.TOWN_HALL.value,
+    BuildingType.GOLD_MINE.value,
+    BuildingType.ELIXIR_COLLECTOR.value,
+    BuildingType.BARRACKS.value,
+]
+
+
+def generate_database(path: str, users: int, seed: int = 42) -> str:
+    """ساخت یک db.db مصنوعی با تعداد کاربر مشخص (در صورت وجود، دوباره ساخته نمی‌شود)"""
+    if os.path.exists(path):
+        return path
+    
+    # ساخت جداول با همان کد اصلی ربات
+    Database(path).close()
+    
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    now = int(time.time())
+    
+    user_rows = []
+    building_rows = []
+    for user_id in range(1, users + 1):
+        level = rng.randint(1, 30)
+        levels = {b_type: rng.randint(1, 10) for b_type in BUILDING_TYPES}
+        user_rows.append((
+            user_id,
+            f'user{user_id}',
+            f'player_{user_id}',
+            level,
+            rng.randint(0, level * 1000),
+            rng.randint(0, 50000 * level),
+            rng.randint(0, 50000 * level),
+            rng.randint(0, 500),
+            rng.randint(0, 5000),
+            RESOURCE_PRODUCTION[BuildingType.GOLD_MINE][levels[BuildingType.GOLD_MINE.value]],
+            RESOURCE_PRODUCTION[BuildingType.ELIXIR_COLLECTOR][levels[BuildingType.ELIXIR_COLLECTOR.value]],
+            STORAGE_CAP_PER_LEVEL * level,
+            now - rng.randint(0, 48 * 3600),
+        ))
+        for b_type in BUILDING_TYPES:
+            building_rows.append((user_id, b_type, levels[b_type]))
+    
+    conn.executemany(
+        '''INSERT INTO users
+        (user_id, username, game_name, level, experience, gold, elixir, gem, trophies,
+         gold_rate, elixir_rate, storage_cap, last_collection_epoch)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+        user_rows
+    )
+    conn.executemany(
+        'INSERT INTO buildings (user_id, building_type, level) VALUES (?, ?, ?)',
+        building_rows
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+# نسبت‌های دنیای مصنوعی نسبت به تعداد کاربران
+CLAN_SIZE = 40
+CLAN_MEMBERSHIP = 0.75
+ATTACKS_PER_USER = 2
+MESSAGES_PER_CLAN = 50
+ATTACK_HISTORY_DAYS = 30
+
+
+def clan_role(index: int) -> str:
+    """نقش عضو بر اساس ترتیب پیوستن (اولی رهبر)"""
+    if index == 0:
+        return UserRole.LEADER.value
+    if index < 3:
+        return UserRole.CO_LEADER.value
+    if index < 8:
+        return UserRole.ELDER.value
+    return UserRole.MEMBER.value
+
+
+def generate_world(path: str, users: int, seed: int = 42) -> str:
+    """دیتابیس کامل (کاربران، ساختمان‌ها، قبایل، لاگ حمله و چت) با seed ثابت"""
+    if os.path.exists(path):
+        return path
+    
+    generate_database(path, users, seed)
+    
+    rng = random.Random(seed + 1)
+    conn = sqlite3.connect(path)
+    now = int(time.time())
+    
+    # عضویت در قبایل
+    clan_count = max(1, users // CLAN_SIZE)
+    members = {clan_id: [] for clan_id in range(1, clan_count + 1)}
+    for user_id in range(1, users + 1):
+        if rng.random() < CLAN_MEMBERSHIP:
+            members[rng.randint(1, clan_count)].append(user_id)
+    members = {clan_id: ids for clan_id, ids in members.items() if ids}
+    
+    conn.executemany(
+        '''INSERT INTO clans
+        (clan_id, name, tag, description, leader_id, level, trophies, member_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+        (
+            (clan_id, f'clan_{clan_id}', f'#C{clan_id}', 'benchmark clan', ids[0],
+             rng.randint(1, 10), rng.randint(0, 50000), len(ids))
+            for clan_id, ids in members.items()
+        )
+    )
+    conn.executemany(
+        'UPDATE users SET clan_id = ?, role = ? WHERE user_id = ?',
+        (
+            (clan_id, clan_role(index), user_id)
+            for clan_id, ids in members.items()
+            for index, user_id in enumerate(ids)
+        )
+    )
+    
+    # لاگ حمله‌های چند روز گذشته (ستون متنی و epoch هر دو پر می‌شوند)
+    def attack_rows():
+        for _ in range(users * ATTACKS_PER_USER):
+            ts = now - rng.randint(0, ATTACK_HISTORY_DAYS * 86400)
+            won = rng.random() < 0.5
+            yield (
+                rng.randint(1, users), rng.randint(1, users),
+                'win' if won else 'lose', rng.randint(5, 40) * (1 if won else -1),
+                '{}', time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts)), ts,
+            )
+    
+    conn.executemany(
+        '''INSERT INTO attack_logs
+        (attacker_id, defender_id, result, trophies_change, resources_stolen, timestamp, timestamp_epoch)
+        VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        attack_rows()
+    )
+    
+    # چت قبایل
+    conn.executemany(
+        'INSERT INTO clan_messages (clan_id, user_id, message, created_epoch) VALUES (?, ?, ?, ?)',
+        (
+            (clan_id, rng.choice(ids), f'message {i}', now - rng.randint(0, 7 * 86400))
+            for clan_id, ids in members.items()
+            for i in range(MESSAGES_PER_CLAN)
+        )
+    )
+    conn.commit()
+    conn.close()
+    return path
@@ -0,0 +1,159 @@
+"""
+سرور جعلی Bot API تلگرام برای تست بار بدون تماس با تلگرام واقعی
+
+متدهای sendMessage، editMessageText، answerCallbackQuery، setWebhook (و بقیه با
+نتیجه true) پاسخ داده می‌شوند. ربات با TELEGRAM_API_URL به این سرور وصل می‌شود:
+
+    python -m benchmarks.fake_telegram --port 8081
+    TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_TOKEN=123456:fake WEBHOOK_URL=http://127.0.0.1:8080 python main.py
+
+با --enforce-limits محدودیت‌های تلگرام (۳۰ پیام در ثانیه کلی و ۱ پیام در ثانیه
+برای هر چت) اعمال و در صورت عبور، خطای 429 با retry_after برگردانده می‌شود.
+آمار فراخوانی‌ها از GET /stats خوانده می‌شود.
+"""
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import time
+
+from aiohttp import web
+
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'AmeleClashBot', 'username': 'amele_clash_bot'}
+
+# متدهایی که پیام می‌فرستند یا ویرایش می‌کنند و مشمول محدودیت نرخ‌اند
+LIMITED_METHODS = {'sendMessage', 'editMessageText'}
+GLOBAL_LIMIT_PER_SEC = 30
+CHAT_LIMIT_PER_SEC = 1
+
+
+class FakeTelegramAPI:
+    """پیاده‌سازی حداقلی Bot API؛ listenerها برای هر فراخوانی (method, params) صدا زده می‌شوند"""
+
+    def __init__(self, latency: float = 0.0, enforce_limits: bool = False):
+        self.latency = latency
+        self.enforce_limits = enforce_limits
+        self.calls = collections.Counter()
+        self.rate_limited = collections.Counter()
+        self.listeners = []
+        self.webhook_url = None
+        self._message_ids = itertools.count(1)
+        self._global_window = collections.deque()
+        self._chat_last_send = {}
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle_method)
+        app.router.add_get('/stats', self.handle_stats)
+        return app
+
+    @staticmethod
+    async def _params(request: web.Request) -> dict:
+        if request.content_type == 'application/json':
+            return await request.json()
+        params = dict(await request.post())
+        params.update(request.query)
+        return params
+
+    def _retry_after(self, chat_id) -> int:
+        """ثانیه‌های انتظار اگر ارسال از محدودیت عبور کند، در غیر این صورت 0"""
+        now = time.monotonic()
+        while self._global_window and now - self._global_window[0] >= 1:
+            self._global_window.popleft()
+        if len(self._global_window) >= GLOBAL_LIMIT_PER_SEC:
+            return 1
+
+        last = self._chat_last_send.get(chat_id)
+        if last is not None and now - last < 1 / CHAT_LIMIT_PER_SEC:
+            return 1
+
+        self._global_window.append(now)
+        self._chat_last_send[chat_id] = now
+        return 0
+
+    def _result(self, method: str, params: dict):
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('sendMessage', 'editMessageText'):
+            if method == 'editMessageText' and 'inline_message_id' in params:
+                return True
+            message_id = params.get('message_id') or next(self._message_ids)
+            return {
+                'message_id': int(message_id),
+                'from': BOT_USER,
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                'date': int(time.time()),
+                'text': params.get('text', ''),
+            }
+        if method == 'getWebhookInfo':
+            return {'url': self.webhook_url or '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url')
+        elif method == 'deleteWebhook':
+            self.webhook_url = None
+        return True
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = await self._params(request)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.enforce_limits and method in LIMITED_METHODS:
+            retry_after = self._retry_after(params.get('chat_id'))
+            if retry_after:
+                self.rate_limited[method] += 1
+                return web.json_response({
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {retry_after}',
+                    'parameters': {'retry_after': retry_after},
+                }, status=429)
+
+        self.calls[method] += 1
+        for listener in self.listeners:
+            listener(method, params)
+        return web.json_response({'ok': True, 'result': self._result(method, params)})
+
+    def stats(self) -> dict:
+        return {'calls': dict(self.calls), 'rate_limited': dict(self.rate_limited), 'webhook_url': self.webhook_url}
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+
+async def start_server(api: FakeTelegramAPI, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(api.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def serve(args):
+    api = FakeTelegramAPI(args.latency / 1000, args.enforce_limits)
+    runner = await start_server(api, args.host, args.port)
+    print(f"fake Bot API listening on http://{args.host}:{args.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(json.dumps(api.stats(), indent=2))
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='added delay per call (ms)')
+    parser.add_argument('--enforce-limits', action='store_true')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,409 @@
+"""
+تولید بار روی /webhook با ترکیب واقعی آپدیت‌ها و اندازه‌گیری تاخیر سرتاسری
+
+سرور جعلی Bot API (benchmarks.fake_telegram) در همین پروسه اجرا می‌شود؛ پایان هر
+آپدیت اولین فراخوانی Bot API ربات برای همان چت است. هر کاربر مجازی در هر لحظه
+حداکثر یک آپدیت باز دارد و بعد از پاسخ کمی «فکر» می‌کند.
+
+مراحل: ثبت نام کاربران (/start و نام بازی) و ساخت قبیله برای بخشی از آن‌ها،
+سپس ارسال با نرخ ثابت از ترکیب start/menu/attack/chat.
+
+اجرا (ربات در یک پوشه موقت و با دیتابیس تازه اجرا می‌شود):
+    python -m benchmarks.loadgen --spawn-bot --users 500 --rate 100 --duration 30
+
+یا روی رباتی که با TELEGRAM_API_URL=http://127.0.0.1:8081 اجرا شده:
+    python -m benchmarks.loadgen --webhook http://127.0.0.1:8080/webhook
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from benchmarks.fake_telegram import FakeTelegramAPI, start_server, BOT_USER
+
+# شناسه کاربران مجازی دور از شناسه‌های واقعی
+USER_ID_BASE = 10_000_000_000
+# از هر چند کاربر یکی قبیله می‌سازد (فقط اعضای قبیله چت دارند)
+CLAN_EVERY = 20
+
+MENU_CALLBACKS = [
+    'main_menu', 'village', 'profile', 'clan', 'attack', 'leaderboard', 'missions', 'daily_reward', 'help',
+]
+DEFAULT_MIX = 'start=0.1,menu=0.55,attack=0.2,chat=0.15'
+
+
+def percentile(samples: list, q: float) -> float:
+    samples = sorted(samples)
+    return samples[max(0, int(len(samples) * q) - 1)] if samples else 0.0
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - {'start', 'menu', 'attack', 'chat'}
+    if unknown:
+        raise ValueError(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return mix
+
+
+class UpdateFactory:
+    """ساخت JSON آپدیت‌های تلگرام با update_id صعودی"""
+
+    def __init__(self):
+        # شروع از زمان فعلی تا اجرای دوباره در پنجره تکراری‌های ربات نیفتد
+        self._next_id = int(time.time()) * 1000
+
+    def _update_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'load{user_id}', 'username': f'load{user_id}'}
+
+    def message(self, user_id: int, text: str) -> dict:
+        update_id = self._update_id()
+        message = {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': update_id, 'message': message}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        update_id = self._update_id()
+        return {'update_id': update_id, 'callback_query': {
+            'id': f'{user_id}:{update_id}',
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': 'menu',
+            },
+        }}
+
+
+class ResponseTracker:
+    """تطبیق فراخوانی‌های Bot API با آپدیت باز هر چت"""
+
+    def __init__(self):
+        self._waiting = {}
+
+    def expect(self, user_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[user_id] = future
+        return future
+
+    def cancel(self, user_id: int):
+        self._waiting.pop(user_id, None)
+
+    def on_api_call(self, method: str, params: dict):
+        if method == 'answerCallbackQuery':
+            chat_id = params.get('callback_query_id', '').split(':')[0]
+        else:
+            chat_id = params.get('chat_id')
+        try:
+            future = self._waiting.pop(int(chat_id), None)
+        except (TypeError, ValueError):
+            return
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+
+class LoadGenerator:
+    def __init__(self, session: aiohttp.ClientSession, webhook: str, tracker: ResponseTracker, timeout: float):
+        self.session = session
+        self.webhook = webhook
+        self.tracker = tracker
+        self.timeout = timeout
+        self.updates = UpdateFactory()
+        self.latencies = collections.defaultdict(list)  # سناریو -> تاخیر سرتاسری (ms)
+        self.ack_latencies = []
+        self.errors = collections.Counter()
+
+    async def send(self, user_id: int, update: dict, scenario: str) -> bool:
+        """ارسال آپدیت و انتظار برای اولین پاسخ ربات به همان چت"""
+        future = self.tracker.expect(user_id)
+        start = time.perf_counter()
+        try:
+            async with self.session.post(self.webhook, json=update) as response:
+                await response.read()
+                status = response.status
+        except aiohttp.ClientError as e:
+            self.tracker.cancel(user_id)
+            self.errors[f'connection: {type(e).__name__}'] += 1
+            return False
+        self.ack_latencies.append((time.perf_counter() - start) * 1000)
+        if status != 200:
+            self.tracker.cancel(user_id)
+            self.errors[f'http {status}'] += 1
+            return False
+
+        try:
+            done = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.tracker.cancel(user_id)
+            self.errors[f'timeout ({scenario})'] += 1
+            return False
+        self.latencies[scenario].append((done - start) * 1000)
+        return True
+
+    async def register(self, user_id: int, index: int):
+        """ثبت نام و برای بخشی از کاربران ساخت قبیله"""
+        steps = [
+            (self.updates.message(user_id, '/start'), 'register'),
+            (self.updates.message(user_id, f'player{index}'), 'register'),
+        ]
+        if index % CLAN_EVERY == 0:
+            steps += [
+                (self.updates.callback(user_id, 'clan_create'), 'register'),
+                (self.updates.message(user_id, f'lg_clan_{index}'), 'register'),
+                (self.updates.message(user_id, f'#{to_base36(index).rjust(2, "0")[-5:]}'), 'register'),
+                (self.updates.message(user_id, 'load test clan'), 'register'),
+            ]
+        for update, scenario in steps:
+            if not await self.send(user_id, update, scenario):
+                return
+
+    async def act(self, user_id: int, scenario: str, in_clan: bool):
+        """یک اقدام کاربر؛ ارسال پیام چت دو آپدیت است (باز کردن و متن)"""
+        if scenario == 'start':
+            await self.send(user_id, self.updates.message(user_id, '/start'), 'start')
+        elif scenario == 'menu':
+            await self.send(user_id, self.updates.callback(user_id, random.choice(MENU_CALLBACKS)), 'menu')
+        elif scenario == 'attack':
+            await self.send(user_id, self.updates.callback(user_id, 'attack_random'), 'attack')
+        elif scenario == 'chat' and in_clan:
+            if await self.send(user_id, self.updates.callback(user_id, 'clan_chat_send'), 'chat_open'):
+                await self.send(user_id, self.updates.message(user_id, f'hello {random.randint(1, 10**6)}'), 'chat_send')
+
+
+def to_base36(value: int) -> str:
+    digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    text = ''
+    while True:
+        value, remainder = divmod(value, 36)
+        text = digits[remainder] + text
+        if not value:
+            return text
+
+
+async def wait_for_bot(session: aiohttp.ClientSession, base_url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(base_url + '/') as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"bot did not come up at {base_url}")
+        await asyncio.sleep(0.5)
+
+
+async def run_load(gen: LoadGenerator, users: list, clan_members: set, mix: dict,
+                   rate: float, duration: float, think_time: float) -> dict:
+    """ارسال با نرخ ثابت (open loop)؛ اگر کاربر بیکاری نباشد، اقدام رد می‌شود"""
+    idle = list(users)
+    idle_leaders = [u for u in users if u in clan_members]
+    scenarios, weights = zip(*mix.items())
+    skipped = 0
+    tasks = set()
+
+    async def user_action(user_id: int, scenario: str):
+        try:
+            await gen.act(user_id, scenario, user_id in clan_members)
+            await asyncio.sleep(think_time)
+        finally:
+            idle.append(user_id)
+            if user_id in clan_members:
+                idle_leaders.append(user_id)
+
+    def take(pool: list):
+        index = random.randrange(len(pool))
+        pool[index], pool[-1] = pool[-1], pool[index]
+        return pool.pop()
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    sent = 0
+    while loop.time() - start < duration:
+        next_at = start + sent / rate
+        await asyncio.sleep(max(0.0, next_at - loop.time()))
+        sent += 1
+
+        scenario = random.choices(scenarios, weights)[0]
+        if scenario == 'chat' and not idle_leaders:
+            scenario = 'menu'
+        pool = idle_leaders if scenario == 'chat' else idle
+        if not pool:
+            skipped += 1
+            continue
+        user_id = take(pool)
+        # کاربر از هر دو لیست بیکارها خارج می‌شود
+        other = idle if pool is idle_leaders else idle_leaders
+        if user_id in other:
+            other.remove(user_id)
+
+        task = asyncio.ensure_future(user_action(user_id, scenario))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    elapsed = loop.time() - start
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return {'elapsed': elapsed, 'scheduled': sent, 'skipped_no_idle_user': skipped}
+
+
+def summarize(gen: LoadGenerator, load: dict, api: FakeTelegramAPI) -> dict:
+    completed = sum(len(v) for k, v in gen.latencies.items() if k != 'register')
+    all_latencies = [x for k, v in gen.latencies.items() if k != 'register' for x in v]
+    return {
+        'elapsed_s': load['elapsed'],
+        'scheduled': load['scheduled'],
+        'skipped_no_idle_user': load['skipped_no_idle_user'],
+        'completed': completed,
+        'throughput_per_s': completed / load['elapsed'] if load['elapsed'] else 0.0,
+        'ack_ms': {'p50': percentile(gen.ack_latencies, 0.5), 'p99': percentile(gen.ack_latencies, 0.99)},
+        'e2e_ms': {
+            name: {
+                'count': len(values),
+                'p50': percentile(values, 0.5),
+                'p90': percentile(values, 0.9),
+                'p99': percentile(values, 0.99),
+                'max': max(values),
+            }
+            for name, values in sorted(list(gen.latencies.items()) + [('all', all_latencies)]) if values
+        },
+        'errors': dict(gen.errors),
+        'api': api.stats(),
+    }
+
+
+def print_report(summary: dict):
+    print(f"\nthroughput: {summary['throughput_per_s']:.1f} updates/s "
+          f"({summary['completed']} completed in {summary['elapsed_s']:.1f}s, "
+          f"{summary['skipped_no_idle_user']} skipped: no idle user)")
+    print(f"webhook ack: p50={summary['ack_ms']['p50']:.1f}ms p99={summary['ack_ms']['p99']:.1f}ms")
+    for name, stats in summary['e2e_ms'].items():
+        print(f"  {name:<10} n={stats['count']:<7} p50={stats['p50']:7.1f}ms p90={stats['p90']:7.1f}ms "
+              f"p99={stats['p99']:7.1f}ms max={stats['max']:7.1f}ms")
+    if summary['errors']:
+        print("errors:")
+        for name, count in sorted(summary['errors'].items()):
+            print(f"  {name}: {count}")
+    print(f"Bot API calls: {summary['api']['calls']}")
+    if summary['api']['rate_limited']:
+        print(f"Bot API 429s: {summary['api']['rate_limited']}")
+
+
+def spawn_bot(args) -> subprocess.Popen:
+    """اجرای main.py در یک پوشه موقت (db.db تازه) با Bot API جعلی"""
+    workdir = tempfile.mkdtemp(prefix='amele_load_')
+    main_py = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+    env = dict(
+        os.environ,
+        BOT_TOKEN='123456:fake-token',
+        WEBHOOK_URL=f'http://127.0.0.1:{args.bot_port}',
+        TELEGRAM_API_URL=f'http://127.0.0.1:{args.api_port}',
+        PORT=str(args.bot_port),
+    )
+    log = open(os.path.join(workdir, 'bot.log'), 'w')
+    print(f"bot running in {workdir} (log: bot.log)")
+    return subprocess.Popen([sys.executable, main_py], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def run(args):
+    random.seed(args.seed)
+    api = FakeTelegramAPI(args.api_latency / 1000, args.enforce_limits)
+    tracker = ResponseTracker()
+    api.listeners.append(tracker.on_api_call)
+    runner = await start_server(api, '127.0.0.1', args.api_port)
+
+    bot = spawn_bot(args) if args.spawn_bot else None
+    webhook = args.webhook or f'http://127.0.0.1:{args.bot_port}/webhook'
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await wait_for_bot(session, webhook.rsplit('/webhook', 1)[0], args.startup_timeout)
+            gen = LoadGenerator(session, webhook, tracker, args.timeout)
+            users = [USER_ID_BASE + i for i in range(args.users)]
+
+            if not args.skip_register:
+                start = time.perf_counter()
+                semaphore = asyncio.Semaphore(args.connections)
+
+                async def register(index: int):
+                    async with semaphore:
+                        await gen.register(users[index], index)
+
+                await asyncio.gather(*(register(i) for i in range(len(users))))
+                print(f"registered {len(users)} users in {time.perf_counter() - start:.1f}s"
+                      f"{f' (errors: {dict(gen.errors)})' if gen.errors else ''}")
+
+            clan_members = {users[i] for i in range(0, len(users), CLAN_EVERY)}
+            load = await run_load(gen, users, clan_members, parse_mix(args.mix),
+                                  args.rate, args.duration, args.think_time)
+            summary = summarize(gen, load, api)
+    finally:
+        if bot is not None:
+            # ربات هنگام خاموش شدن هنوز Bot API جعلی همین پروسه را صدا می‌زند
+            bot.terminate()
+            await asyncio.get_running_loop().run_in_executor(None, bot.wait, 30)
+        await runner.cleanup()
+
+    print_report(summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--webhook', help='default: http://127.0.0.1:<bot-port>/webhook')
+    parser.add_argument('--spawn-bot', action='store_true', help='run main.py against the fake API')
+    parser.add_argument('--bot-port', type=int, default=8080)
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--api-latency', type=float, default=0.0, help='fake Bot API delay per call (ms)')
+    parser.add_argument('--enforce-limits', action='store_true', help='fake API returns 429 like Telegram')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=100, help='actions per second')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--think-time', type=float, default=0.5, help='seconds a user waits after a reply')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for a reply')
+    parser.add_argument('--connections', type=int, default=100)
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    parser.add_argument('--skip-register', action='store_true')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the summary as JSON')
+    args = parser.parse_args()
+
+    summary = asyncio.run(run(args))
+    sys.exit(1 if summary['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
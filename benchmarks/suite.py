@@ -0,0 +1,189 @@
+"""
+مجموعه بنچمارک مقیاس Database و GameEngine در 10k/100k/1M بازیکن
+
+برای هر اندازه یک دنیای مصنوعی با seed ثابت ساخته می‌شود (datagen.generate_world)،
+متدهای داغ روی یک کپی از آن اجرا می‌شوند و نتیجه در JSON ذخیره می‌شود.
+با --baseline، p50 هر متد با خط مبنا مقایسه می‌شود و اگر بیش از آستانه کندتر شده
+باشد اجرا با کد 1 تمام می‌شود. خط مبنا وابسته به ماشین است؛ روی همان ماشینی که
+مقایسه انجام می‌شود با --save-baseline ساخته شود.
+
+اجرا:
+    python -m benchmarks.suite --sizes 10000,100000,1000000
+    python -m benchmarks.suite --baseline benchmarks/baseline.json --threshold 0.30
+    python -m benchmarks.suite --save-baseline benchmarks/baseline.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import time
+
+from main import Database, GameEngine, UpdateContext
+from benchmarks.datagen import generate_world
+from benchmarks.bench_connections import measure
+
+DEFAULT_SIZES = '10000,100000'
+
+
+def percentile(samples: list, q: float) -> float:
+    samples = sorted(samples)
+    return samples[max(0, int(len(samples) * q) - 1)]
+
+
+def in_update(fn):
+    """هر فراخوانی در کانتکست آپدیت جدا (مثل یک درخواست کاربر)"""
+    def wrapper(arg):
+        with UpdateContext.scope():
+            fn(arg)
+    return wrapper
+
+
+def build_cases(db: Database, game: GameEngine, users: int, iterations: int, seed: int) -> list:
+    """(نام، تابع، ورودی‌ها)؛ ورودی‌ها با seed ثابت ساخته می‌شوند"""
+    rng = random.Random(seed)
+    clan_ids = [row[0] for row in db.execute_query('SELECT clan_id FROM clans')]
+    user_ids = [rng.randint(1, users) for _ in range(iterations)]
+    clans = [rng.choice(clan_ids) for _ in range(iterations)]
+    pairs = []
+    while len(pairs) < iterations:
+        attacker, defender = rng.randint(1, users), rng.randint(1, users)
+        if attacker != defender:
+            pairs.append((attacker, defender))
+
+    return [
+        ('get_user', db.get_user, user_ids),
+        ('get_clan_members', db.get_clan_members, clans),
+        ('get_clan_messages', db.get_clan_messages, clans),
+        ('get_top_players', lambda _: db.get_top_players(10), user_ids),
+        ('get_top_clans', lambda _: db.get_top_clans(10), user_ids),
+        ('leaderboard.top_players', lambda _: game.leaderboard.top_players(10), user_ids),
+        ('leaderboard.rank', game.leaderboard.rank, user_ids),
+        ('matchmaking.find_opponent', lambda uid: game.matchmaking.find_opponent(uid, 1000), user_ids),
+        ('calculate_production', game.calculate_production, user_ids),
+        # آخرین مورد چون دیتابیس را تغییر می‌دهد
+        ('simulate_attack', lambda pair: game.simulate_attack(*pair), pairs),
+    ]
+
+
+def run_size(users: int, iterations: int, rounds: int, seed: int, data_dir: str) -> dict:
+    """اجرای همه موارد روی یک کپی از دنیای این اندازه"""
+    world = os.path.join(data_dir, f'bench_world_{users}.db')
+    setup = {}
+    if not os.path.exists(world):
+        start = time.perf_counter()
+        generate_world(world, users, seed)
+        setup['generate_s'] = time.perf_counter() - start
+
+    # کپی کاری تا حمله‌ها دنیای ذخیره‌شده را تغییر ندهند
+    work = os.path.join(data_dir, f'bench_world_{users}.run.db')
+    shutil.copyfile(world, work)
+    db = Database(work)
+    game = GameEngine(db)
+
+    start = time.perf_counter()
+    game.leaderboard.load(db)
+    game.matchmaking.load(db)
+    setup['load_indexes_s'] = time.perf_counter() - start
+
+    # مسیر دیتابیسی بدون کش کاربران
+    db.user_cache.max_size = 0
+    random.seed(seed)  # نتیجه حمله‌ها
+
+    results = {}
+    for name, fn, args in build_cases(db, game, users, iterations, seed):
+        fn = in_update(fn)
+        measure(fn, args[:min(200, len(args))])  # گرم کردن کش صفحات
+        # کمترین p50 بین چند دور، نویز ماشین را کم می‌کند (مثل timeit)
+        runs = [measure(fn, args) for _ in range(rounds)]
+        samples = [sample for run in runs for sample in run]
+        results[name] = {
+            'p50_us': min(statistics.median(run) for run in runs),
+            'p99_us': percentile(samples, 0.99),
+            'mean_us': statistics.mean(samples),
+            'ops_per_sec': 1_000_000 / statistics.mean(samples),
+        }
+        print(f"{users:>9,} {name:<26} p50={results[name]['p50_us']:9.1f}us  "
+              f"p99={results[name]['p99_us']:9.1f}us")
+
+    db.close()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(work + suffix):
+            os.remove(work + suffix)
+    return {'setup': setup, 'cases': results}
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_delta_us: float) -> list:
+    """مقایسه p50 با خط مبنا؛ لیست موارد کندشده را برمی‌گرداند"""
+    regressions = []
+    for size, current in results['sizes'].items():
+        base_cases = baseline.get('sizes', {}).get(size, {}).get('cases', {})
+        for name, case in current['cases'].items():
+            base = base_cases.get(name)
+            if base is None:
+                continue
+            ratio = case['p50_us'] / base['p50_us'] if base['p50_us'] else 1.0
+            regressed = ratio > 1 + threshold and case['p50_us'] - base['p50_us'] > min_delta_us
+            print(f"{int(size):>9,} {name:<26} {base['p50_us']:9.1f} -> {case['p50_us']:9.1f}us "
+                  f"({(ratio - 1) * 100:+6.1f}%){'  REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append((size, name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma-separated player counts')
+    parser.add_argument('--iterations', type=int, default=2_000)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--data-dir', default='.')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help='fail if p50 regresses against this JSON')
+    parser.add_argument('--threshold', type=float, default=0.30, help='allowed p50 slowdown (0.30 = 30%%)')
+    parser.add_argument('--min-delta-us', type=float, default=10.0, help='ignore smaller absolute slowdowns')
+    parser.add_argument('--save-baseline', help='also write the results to this path')
+    args = parser.parse_args()
+
+    # لاگ هر حمله (و هشدار کوئری کند) در خروجی، زمان‌ها را خراب می‌کند
+    logging.disable(logging.WARNING)
+
+    results = {
+        'meta': {
+            'created': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'iterations': args.iterations,
+            'rounds': args.rounds,
+        },
+        'sizes': {},
+    }
+    for users in (int(size) for size in args.sizes.split(',')):
+        results['sizes'][str(users)] = run_size(users, args.iterations, args.rounds, args.seed, args.data_dir)
+
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {path}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_delta_us)
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.threshold:.0%}")
+            sys.exit(1)
+        print("no regressions")
+
+
+if __name__ == '__main__':
+    main()
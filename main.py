@@ -14,18 +14,37 @@ import datetime
 import random
 import string
 import re
-from typing import Dict, List, Tuple, Optional, Any
+import signal
+import queue
+import threading
+import functools
+import hmac
+import bisect
+import copy
+import contextvars
+import time
+import collections
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List, Tuple, Optional, Any, Callable, Awaitable
 from dataclasses import dataclass
 from enum import Enum
 
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebhookInfo
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
 from aiogram.utils import executor
-from aiogram.utils.exceptions import TelegramAPIError
+from aiogram.utils.exceptions import TelegramAPIError, RetryAfter
+
+try:
+    import numpy as np
+except ImportError:  # فقط برای پردازش دسته‌ای اقتصاد لازم است
+    np = None
 
 import aiohttp
 from aiohttp import web
@@ -46,10 +65,99 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 PORT = int(os.getenv('PORT', 8080))
+# آدرس جایگزین Bot API (مثلا سرور جعلی benchmarks.fake_telegram برای تست بار)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
 
 # ***** اصلاح شد: دیتابیس به db.db وصل می‌شود *****
 DATABASE_FILE = 'db.db'
 
+# تنظیمات اتصال‌های SQLite
+DB_READER_CONNECTIONS = int(os.getenv('DB_READER_CONNECTIONS', 4))
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', 65536))  # 64 مگابایت
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', 268435456))  # 256 مگابایت
+DB_BUSY_TIMEOUT_MS = 5000
+
+# پروفایل کوئری‌ها: آستانه کوئری کند (برای گرفتن EXPLAIN QUERY PLAN) و حداکثر fingerprintهای نگهداری‌شده
+QUERY_PROFILER_ENABLED = os.getenv('QUERY_PROFILER_ENABLED', '1') == '1'
+QUERY_SLOW_THRESHOLD_MS = float(os.getenv('QUERY_SLOW_THRESHOLD_MS', 20))
+QUERY_PROFILER_MAX_FINGERPRINTS = 500
+
+# تنظیمات کش کاربران
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 50000))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 30))  # ثانیه
+
+# پهنای هر بازه تروفی در حریف‌یابی
+MATCHMAKING_BAND_WIDTH = int(os.getenv('MATCHMAKING_BAND_WIDTH', 100))
+
+# تنظیمات رتبه‌بندی درون‌حافظه‌ای
+LEADERBOARD_BUCKET_SIZE = 512
+LEADERBOARD_RECONCILE_INTERVAL = float(os.getenv('LEADERBOARD_RECONCILE_INTERVAL', 300))  # ثانیه
+
+# فایل لیست کلمات ممنوعه (هر خط یک کلمه) و فاصله بررسی تغییر آن
+FORBIDDEN_WORDS_FILE = os.getenv('FORBIDDEN_WORDS_FILE', 'forbidden_words.txt')
+FORBIDDEN_WORDS_RELOAD_INTERVAL = float(os.getenv('FORBIDDEN_WORDS_RELOAD_INTERVAL', 10))  # ثانیه
+
+# اندازه هر دسته در پردازش دسته‌ای اقتصاد
+ECONOMY_CHUNK_SIZE = int(os.getenv('ECONOMY_CHUNK_SIZE', 20000))
+
+# تنظیمات ذخیره دسته‌ای پیام‌های قبیله
+CHAT_FLUSH_BATCH_SIZE = 100
+CHAT_FLUSH_MAX_LATENCY = 0.05  # ثانیه
+
+# تنظیمات ذخیره دسته‌ای پیشرفت ماموریت‌ها
+MISSION_FLUSH_BATCH_SIZE = 500
+MISSION_FLUSH_MAX_LATENCY = 1.0  # ثانیه
+
+# نگهداری ماموریت‌های روزهای گذشته و اندازه هر دسته حذف
+MISSION_RETENTION_DAYS = int(os.getenv('MISSION_RETENTION_DAYS', 7))
+MISSION_PRUNE_BATCH_SIZE = 5000
+
+# تبدیل آنلاین ستون‌های زمانی متنی به epoch (ردیف در هر دسته)
+TIMESTAMP_BACKFILL_BATCH_SIZE = int(os.getenv('TIMESTAMP_BACKFILL_BATCH_SIZE', 5000))
+
+# وضعیت‌های FSM (ثبت‌نام، ساخت قبیله، ...): ظرفیت لایه حافظه، عمر جریان‌های رهاشده و ذخیره دسته‌ای
+FSM_HOT_SIZE = int(os.getenv('FSM_HOT_SIZE', 10000))
+FSM_STATE_TTL = float(os.getenv('FSM_STATE_TTL', 86400))  # ثانیه
+FSM_SWEEP_INTERVAL = float(os.getenv('FSM_SWEEP_INTERVAL', 600))  # ثانیه
+FSM_FLUSH_BATCH_SIZE = 200
+FSM_FLUSH_MAX_LATENCY = 0.5  # ثانیه
+FSM_PRUNE_BATCH_SIZE = 5000
+
+# worker صف آپدیت‌های هر کاربر بعد از این مدت بیکاری جمع می‌شود
+UPDATE_WORKER_IDLE_TIMEOUT = float(os.getenv('UPDATE_WORKER_IDLE_TIMEOUT', 30))  # ثانیه
+
+# حداکثر آپدیت‌های در حال پردازش همزمان و حداکثر آپدیت‌های صف‌شده
+UPDATE_MAX_CONCURRENCY = int(os.getenv('UPDATE_MAX_CONCURRENCY', 64))
+UPDATE_MAX_QUEUED = int(os.getenv('UPDATE_MAX_QUEUED', 5000))
+# از این تعداد صف‌شده به بعد، callbackهای کم‌اهمیت دور ریخته می‌شوند
+UPDATE_SHED_THRESHOLD = int(os.getenv('UPDATE_SHED_THRESHOLD', 2000))
+
+# تعداد update_idهای اخیر که برای تشخیص ارسال دوباره نگهداری می‌شوند
+UPDATE_DEDUP_WINDOW = int(os.getenv('UPDATE_DEDUP_WINDOW', 10000))
+
+# فاصله اندازه‌گیری دیرکرد event loop
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv('EVENT_LOOP_LAG_INTERVAL', 0.5))  # ثانیه
+
+# callbackهای کم‌اهمیت (راهنما، رتبه‌بندی، بروزرسانی چت) که زیر بار اول حذف می‌شوند
+LOW_VALUE_CALLBACKS = frozenset({'help', 'leaderboard', 'clan_chat'})
+
+# صف ارسال پیام‌ها: محدودیت‌های تلگرام (۳۰ پیام در ثانیه کلی و حدود ۱ پیام در ثانیه برای هر چت)
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', 30))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', 1))
+# پیام‌های پشت‌سرهم مجاز در یک چت (مثلا پاسخ + منوی اصلی)
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', 3))
+OUTBOUND_MAX_IN_FLIGHT = 30
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_DRAIN_TIMEOUT = 10.0  # ثانیه
+# متدهایی که پیام می‌فرستند یا ویرایش می‌کنند و از صف ارسال عبور می‌کنند
+OUTBOUND_QUEUED_METHODS = frozenset({
+    'sendMessage', 'editMessageText', 'editMessageReplyMarkup',
+    'sendPhoto', 'sendDocument', 'forwardMessage', 'copyMessage',
+})
+
+# توکن روت‌های /debug (?token=...)؛ بدون تنظیم آن، این روت‌ها غیرفعال‌اند (404)
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN')
+
 # آی‌دی ادمین اصلی (کشور ابرقدرت)
 ADMIN_ID = 8285797031
 
@@ -79,6 +187,21 @@ class UserRole(Enum):
     LEADER = "leader"  # رهبر قبیله
     ADMIN = "admin"  # ادمین سیستم
 
+class GameEvent(Enum):
+    """رویدادهای بازی که ماموریت‌ها را پیش می‌برند"""
+    CLAN_MESSAGE_SENT = "clan_message_sent"
+    ATTACK_DONE = "attack_done"
+    BUILDING_UPGRADED = "building_upgraded"
+    RESOURCES_COLLECTED = "resources_collected"
+
+# نوع ماموریتی که هر رویداد پیش می‌برد
+EVENT_MISSION_TYPES = {
+    GameEvent.CLAN_MESSAGE_SENT: 'send_clan_messages',
+    GameEvent.ATTACK_DONE: 'attack_players',
+    GameEvent.BUILDING_UPGRADED: 'upgrade_building',
+    GameEvent.RESOURCES_COLLECTED: 'collect_resources',
+}
+
 @dataclass
 class User:
     """مدل کاربر"""
@@ -94,11 +217,14 @@ class User:
     clan_id: Optional[int] = None
     role: UserRole = UserRole.MEMBER
     last_daily_reward: Optional[str] = None
-    last_attack_time: Optional[str] = None
-    last_collection_time: str = None
+    last_attack_epoch: Optional[int] = None  # ثانیه از ۱۹۷۰ (UTC)
+    last_collection_epoch: int = 0
     warnings: int = 0
     banned: bool = False
     created_at: str = None
+    gold_rate: int = 0  # تولید سکه در ساعت (از روی ساختمان‌ها)
+    elixir_rate: int = 0  # تولید اکسیر در ساعت
+    storage_cap: int = 50000  # ظرفیت انبار
 
 @dataclass
 class Clan:
@@ -133,7 +259,7 @@ class AttackLog:
     result: str  # win/lose/draw
     trophies_change: int
     resources_stolen: Dict[str, int]
-    timestamp: str
+    timestamp_epoch: int
 
 @dataclass
 class Report:
@@ -153,7 +279,99 @@ class ClanMessage:
     clan_id: int
     user_id: int
     message: str
-    created_at: str = None
+    created_epoch: int = 0
+
+# تنظیمات تولید منابع (سطح ساختمان -> تولید در ساعت)
+RESOURCE_PRODUCTION = {
+    BuildingType.GOLD_MINE: {1: 10, 2: 25, 3: 50, 4: 100, 5: 200, 6: 400, 7: 800, 8: 1500, 9: 3000, 10: 6000},
+    BuildingType.ELIXIR_COLLECTOR: {1: 8, 2: 20, 3: 40, 4: 80, 5: 160, 6: 320, 7: 640, 8: 1200, 9: 2400, 10: 4800}
+}
+
+# کلمات ممنوعه پیش‌فرض (در صورت نبود فایل FORBIDDEN_WORDS_FILE)
+DEFAULT_FORBIDDEN_WORDS = [
+    'فحش1', 'فحش2', 'فحش3', 'توهین1', 'توهین2',
+    'کلمه‌ناسزا1', 'کلمه‌ناسزا2'
+]
+
+# ماموریت‌های روزانه: (نوع، هدف، پاداش سکه، پاداش اکسیر، پاداش جم)
+DAILY_MISSIONS = [
+    ('collect_resources', 50000, 1000, 500, 5),
+    ('attack_players', 3, 1500, 750, 10),
+    ('upgrade_building', 1, 2000, 1000, 15),
+    ('send_clan_messages', 5, 500, 250, 3),
+]
+
+# SQL ساخت ماموریت‌های یک روز از روی جدول users (بدون تکرار به لطف ایندکس یکتا)
+MATERIALIZE_MISSIONS_SQL = '''WITH templates(mission_type, target_value, reward_gold, reward_elixir, reward_gem) AS (
+    VALUES {values}
+)
+INSERT OR IGNORE INTO missions
+(user_id, mission_type, target_value, reward_gold, reward_elixir, reward_gem, mission_day, created_epoch)
+SELECT u.user_id, t.mission_type, t.target_value, t.reward_gold, t.reward_elixir, t.reward_gem, ?,
+       CAST(strftime('%s', 'now') AS INTEGER)
+FROM users u CROSS JOIN templates t
+WHERE {where}'''.replace('{values}', ', '.join(['(?, ?, ?, ?, ?)'] * len(DAILY_MISSIONS)))
+
+
+def now_epoch() -> int:
+    """زمان فعلی به ثانیه از ۱۹۷۰ (UTC)"""
+    return int(time.time())
+
+
+def current_mission_day() -> int:
+    """شماره روز ماموریت (روزهای گذشته از ۱۹۷۰ به وقت UTC)"""
+    return now_epoch() // 86400
+
+
+def day_range(day: Optional[int] = None) -> Tuple[int, int]:
+    """ابتدا و انتهای یک روز UTC به epoch برای کوئری‌های BETWEEN"""
+    if day is None:
+        day = current_mission_day()
+    start = day * 86400
+    return start, start + 86399
+
+
+def format_epoch(value: Optional[int], fmt: str = '%Y-%m-%d %H:%M') -> str:
+    """نمایش epoch به وقت UTC"""
+    if value is None:
+        return ''
+    return datetime.datetime.utcfromtimestamp(value).strftime(fmt)
+
+
+def parse_legacy_time(value: Optional[str]) -> Optional[int]:
+    """تبدیل زمان متنی قدیمی به epoch؛ isoformat با T به وقت محلی و CURRENT_TIMESTAMP به وقت UTC نوشته شده بود"""
+    if not value:
+        return None
+    parsed = datetime.datetime.fromisoformat(value)
+    if 'T' not in value:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return int(parsed.timestamp())
+
+
+# معادل SQL همان تبدیل برای پر کردن ستون‌های جدید
+LEGACY_TIME_SQL = (
+    "CASE WHEN instr({column}, 'T') > 0 "
+    "THEN CAST(strftime('%s', {column}, 'utc') AS INTEGER) "
+    "ELSE CAST(strftime('%s', {column}) AS INTEGER) END"
+)
+
+# ستون‌های زمانی متنی که به epoch تبدیل می‌شوند: (نام، جدول، ستون جدید، ستون قدیمی)
+TIMESTAMP_BACKFILLS = [
+    ('users.last_collection', 'users', 'last_collection_epoch', 'last_collection_time'),
+    ('users.last_attack', 'users', 'last_attack_epoch', 'last_attack_time'),
+    ('attack_logs.timestamp', 'attack_logs', 'timestamp_epoch', 'timestamp'),
+    ('clan_messages.created', 'clan_messages', 'created_epoch', 'created_at'),
+    ('missions.created', 'missions', 'created_epoch', 'created_at'),
+]
+
+# ستون نرخ تولید هر ساختمان در جدول users
+PRODUCTION_RATE_COLUMNS = {
+    BuildingType.GOLD_MINE: 'gold_rate',
+    BuildingType.ELIXIR_COLLECTOR: 'elixir_rate',
+}
+
+# ظرفیت انبار به ازای هر لول کاربر
+STORAGE_CAP_PER_LEVEL = 50000
 
 # ============================================================================
 # State Machine برای FSM
@@ -168,10 +386,649 @@ class Form(StatesGroup):
     waiting_for_message = State()
     waiting_for_attack_target = State()
 
+# ============================================================================
+# متریک‌ها (فرمت متنی Prometheus)
+# ============================================================================
+
+# مرزهای سطل‌های هیستوگرام تاخیر (ثانیه)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# کوئری‌های SQLite معمولا زیر یک میلی‌ثانیه‌اند
+DB_LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+EVENT_LOOP_LAG_BUCKETS = (0.001, 0.0025) + LATENCY_BUCKETS
+
+
+class LatencyHistogram:
+    """هیستوگرام تاخیر با سطل‌های ثابت (تجمعی نیست) به همراه تعداد خطا"""
+    
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # آخرین سطل: بیشتر از بزرگ‌ترین مرز
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+    
+    def observe(self, seconds: float, error: bool = False):
+        # بدون قفل: از دست رفتن یک افزایش نادر بین تردها برای متریک قابل قبول است
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
+    
+    def quantile(self, q: float) -> float:
+        """تخمین صدک از روی سطل‌ها (مرز بالای سطلی که صدک در آن است)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+    
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+def _format_labels(names: Tuple[str, ...], values: tuple, extra: str = '') -> str:
+    """ساخت {name="value",...} با escape مقادیر"""
+    parts = [
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class CounterFamily:
+    """شمارنده با برچسب"""
+    
+    kind = 'counter'
+    
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: Dict[tuple, float] = {}
+    
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+    
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+    
+    def render(self) -> List[str]:
+        return [
+            f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}'
+            for labels, value in list(self._values.items())
+        ]
+
+
+class HistogramFamily:
+    """یک LatencyHistogram برای هر ترکیب برچسب؛ در صورت نیاز شمارنده خطا هم منتشر می‌شود"""
+    
+    kind = 'histogram'
+    
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS, errors_name: Optional[str] = None):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.errors_name = errors_name
+        self._histograms: Dict[tuple, LatencyHistogram] = {}
+    
+    def labels(self, *label_values) -> LatencyHistogram:
+        histogram = self._histograms.get(label_values)
+        if histogram is None:
+            histogram = self._histograms.setdefault(label_values, LatencyHistogram(self.buckets))
+        return histogram
+    
+    def items(self) -> List[Tuple[tuple, LatencyHistogram]]:
+        return list(self._histograms.items())
+    
+    def render(self) -> List[str]:
+        lines = []
+        for labels, histogram in self.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), list(histogram.counts)):
+                cumulative += count
+                le = 'le="{}"'.format(_format_value(bound))
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}')
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f'{self.name}_sum{label_text} {histogram.total!r}')
+            # count از جمع سطل‌ها تا با سطل +Inf یکی باشد
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+class CallbackFamily:
+    """مقدار محاسبه‌شده هنگام scrape (بدون هزینه در مسیر داغ)؛ fn عدد یا دیکشنری برچسب -> عدد برمی‌گرداند"""
+    
+    def __init__(self, name: str, help_text: str, kind: str,
+                 fn: Callable[[], Any], label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.fn = fn
+        self.label_names = label_names
+    
+    def render(self) -> List[str]:
+        value = self.fn()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [
+            f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(v)}'
+            for labels, v in value.items()
+        ]
+
+
+class MetricsRegistry:
+    """مجموعه متریک‌های پروسه و خروجی متنی /metrics"""
+    
+    def __init__(self):
+        self._families: 'OrderedDict[str, Any]' = OrderedDict()
+    
+    def _get_or_add(self, family):
+        existing = self._families.get(family.name)
+        if existing is not None and not isinstance(family, CallbackFamily):
+            return existing
+        self._families[family.name] = family
+        return family
+    
+    def counter(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> CounterFamily:
+        return self._get_or_add(CounterFamily(name, help_text, label_names))
+    
+    def histogram(self, name: str, help_text: str, label_names: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+                  errors_name: Optional[str] = None) -> HistogramFamily:
+        return self._get_or_add(HistogramFamily(name, help_text, label_names, buckets, errors_name))
+    
+    def gauge(self, name: str, help_text: str, fn: Callable[[], Any],
+              label_names: Tuple[str, ...] = (), kind: str = 'gauge'):
+        """ثبت (یا جایگزینی) متریکی که هنگام scrape از fn خوانده می‌شود"""
+        self._get_or_add(CallbackFamily(name, help_text, kind, fn, label_names))
+    
+    def render(self) -> str:
+        lines = []
+        for family in list(self._families.values()):
+            try:
+                samples = family.render()
+            except Exception as e:
+                logger.error(f"Error collecting metric {family.name}: {e}")
+                continue
+            lines.append(f'# HELP {family.name} {family.help_text}')
+            lines.append(f'# TYPE {family.name} {family.kind}')
+            lines.extend(samples)
+            
+            if isinstance(family, HistogramFamily) and family.errors_name:
+                lines.append(f'# HELP {family.errors_name} Errors for {family.name}')
+                lines.append(f'# TYPE {family.errors_name} counter')
+                for labels, histogram in family.items():
+                    lines.append(f'{family.errors_name}{_format_labels(family.label_names, labels)} {histogram.errors}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+DB_QUERY_SECONDS = METRICS.histogram(
+    'amele_db_query_duration_seconds', 'SQLite statement duration by statement label',
+    ('statement',), DB_LATENCY_BUCKETS
+)
+
+# دستورهای تغییر داده بر SELECTهای داخل WITH اولویت دارند
+_STATEMENT_DML_RE = re.compile(r'\b(INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+_STATEMENT_SELECT_RE = re.compile(r'\bSELECT\b', re.IGNORECASE)
+_STATEMENT_TABLE_RE = {
+    'select': re.compile(r'\bFROM\s+(\w+)', re.IGNORECASE),
+    'delete': re.compile(r'\bFROM\s+(\w+)', re.IGNORECASE),
+    'insert': re.compile(r'\bINTO\s+(\w+)', re.IGNORECASE),
+    'replace': re.compile(r'\bINTO\s+(\w+)', re.IGNORECASE),
+    'update': re.compile(r'\bUPDATE\s+(?:OR\s+\w+\s+)?(\w+)', re.IGNORECASE),
+}
+_statement_labels: Dict[str, str] = {}
+_STATEMENT_LABEL_CACHE_SIZE = 4096
+
+
+def statement_label(query: str) -> str:
+    """برچسب کم‌تنوع یک دستور SQL مثل select_users (عملیات + جدول اصلی)"""
+    label = _statement_labels.get(query)
+    if label is not None:
+        return label
+    
+    match = _STATEMENT_DML_RE.search(query) or _STATEMENT_SELECT_RE.search(query)
+    if match is None:
+        words = query.split(None, 1)
+        label = words[0].lower() if words else 'empty'
+    else:
+        verb = match.group(0).lower()
+        table = _STATEMENT_TABLE_RE[verb].search(query, match.start())
+        label = f'{verb}_{table.group(1).lower()}' if table else verb
+    
+    # کوئری‌های f-string نباید کش را بی‌نهایت بزرگ کنند
+    if len(_statement_labels) < _STATEMENT_LABEL_CACHE_SIZE:
+        _statement_labels[query] = label
+    return label
+
+
+_FINGERPRINT_RULES = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE), 'IN (...)'),
+    (re.compile(r'(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+'), r'\1, ...'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def query_fingerprint(query: str) -> str:
+    """شکل عمومی کوئری: مقادیر ثابت و لیست‌های IN با ? جایگزین می‌شوند"""
+    for pattern, replacement in _FINGERPRINT_RULES:
+        query = pattern.sub(replacement, query)
+    return query.strip()
+
+
+class QueryStats:
+    """آمار تجمعی یک fingerprint"""
+    
+    __slots__ = ('fingerprint', 'count', 'rows', 'max', 'histogram', 'plan')
+    
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.rows = 0
+        self.max = 0.0
+        self.histogram = LatencyHistogram(DB_LATENCY_BUCKETS)
+        self.plan: Optional[List[str]] = None
+
+
+class QueryProfiler:
+    """پروفایل کوئری‌های SQLite بر اساس fingerprint؛ برای کوئری‌های کند یک بار EXPLAIN QUERY PLAN گرفته می‌شود"""
+    
+    def __init__(self, slow_threshold: float = QUERY_SLOW_THRESHOLD_MS / 1000,
+                 max_fingerprints: int = QUERY_PROFILER_MAX_FINGERPRINTS):
+        self.slow_threshold = slow_threshold
+        self.max_fingerprints = max_fingerprints
+        self.enabled = QUERY_PROFILER_ENABLED
+        self._stats: Dict[str, QueryStats] = {}
+        self._fingerprints: Dict[str, str] = {}  # متن کوئری -> fingerprint
+        self._lock = threading.Lock()
+        self.dropped = 0  # اجراهایی که به دلیل پر بودن جدول ثبت نشدند
+    
+    def record(self, query: str, elapsed: float, rows: int = 0,
+               conn: Optional[sqlite3.Connection] = None, params: Any = None):
+        """ثبت یک اجرا؛ conn و params فقط برای گرفتن پلن کوئری کند لازم‌اند"""
+        fingerprint = self._fingerprints.get(query)
+        if fingerprint is None:
+            fingerprint = query_fingerprint(query)
+            if len(self._fingerprints) < _STATEMENT_LABEL_CACHE_SIZE:
+                self._fingerprints[query] = fingerprint
+        
+        with self._lock:
+            stats = self._stats.get(fingerprint)
+            if stats is None:
+                if len(self._stats) >= self.max_fingerprints:
+                    self.dropped += 1
+                    return
+                stats = self._stats[fingerprint] = QueryStats(fingerprint)
+            stats.count += 1
+            stats.rows += max(rows, 0)
+            stats.max = max(stats.max, elapsed)
+            stats.histogram.observe(elapsed)
+            need_plan = elapsed >= self.slow_threshold and stats.plan is None and conn is not None
+            if need_plan:
+                stats.plan = []  # فقط یک بار
+        
+        if need_plan:
+            stats.plan = self._explain(conn, query, params)
+            logger.warning(
+                f"🐢 Slow query ({elapsed * 1000:.1f} ms): {fingerprint[:200]} | plan: {' / '.join(stats.plan)}"
+            )
+    
+    @staticmethod
+    def _explain(conn: sqlite3.Connection, query: str, params: Any) -> List[str]:
+        try:
+            rows = conn.execute('EXPLAIN QUERY PLAN ' + query, params or ()).fetchall()
+        except Exception as e:
+            return [f'(no plan: {e})']
+        return [row[3] for row in rows]
+    
+    def report(self, limit: int = 20, order_by: str = 'total') -> List[Dict[str, Any]]:
+        """پرهزینه‌ترین fingerprintها (total، p99 یا count)"""
+        keys = {
+            'total': lambda s: s.histogram.total,
+            'p99': lambda s: s.histogram.quantile(0.99),
+            'count': lambda s: s.count,
+        }
+        if order_by not in keys:
+            raise ValueError(f"Unknown order: {order_by}")
+        
+        with self._lock:
+            top = sorted(self._stats.values(), key=keys[order_by], reverse=True)[:limit]
+            return [
+                {
+                    'fingerprint': s.fingerprint,
+                    'statement': statement_label(s.fingerprint),
+                    'count': s.count,
+                    'total_ms': s.histogram.total * 1000,
+                    'mean_ms': s.histogram.mean * 1000,
+                    'p50_ms': s.histogram.quantile(0.5) * 1000,
+                    'p99_ms': s.histogram.quantile(0.99) * 1000,
+                    'max_ms': s.max * 1000,
+                    'rows': s.rows,
+                    'rows_per_call': s.rows / s.count,
+                    'plan': s.plan or None,
+                }
+                for s in top
+            ]
+    
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.dropped = 0
+
+
+QUERY_PROFILER = QueryProfiler()
+
+
+def _observe_query(query: str, start: float, rows: int = 0,
+                   conn: Optional[sqlite3.Connection] = None, params: Any = None):
+    """ثبت مدت اجرای یک دستور SQL در متریک‌ها و پروفایلر کوئری"""
+    elapsed = time.perf_counter() - start
+    DB_QUERY_SECONDS.labels(statement_label(query)).observe(elapsed)
+    if QUERY_PROFILER.enabled:
+        QUERY_PROFILER.record(query, elapsed, rows, conn, params)
+
 # ============================================================================
 # دیتابیس
 # ============================================================================
 
+class ConnectionPool:
+    """مدیریت اتصال‌های ماندگار SQLite (یک نویسنده، چند خواننده)"""
+    
+    def __init__(self, db_path: str, readers: int = DB_READER_CONNECTIONS):
+        self.db_path = db_path
+        
+        # اتصال نویسنده اول ساخته می‌شود تا حالت WAL قبل از خواننده‌ها فعال شود
+        self._writer = self._connect()
+        self._writer_lock = threading.RLock()
+        
+        # دیتابیس حافظه‌ای بین اتصال‌ها مشترک نیست، پس خواندن هم از نویسنده انجام می‌شود
+        self._readers: Optional[queue.Queue] = None
+        if db_path != ':memory:' and readers > 0:
+            self._readers = queue.Queue()
+            for _ in range(readers):
+                self._readers.put(self._connect(read_only=True))
+    
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """ساخت و پیکربندی یک اتصال جدید"""
+        # تراکنش‌ها به صورت صریح با BEGIN IMMEDIATE باز می‌شوند (isolation_level=None)
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        if not read_only:
+            cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('PRAGMA synchronous = NORMAL')
+        cursor.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+        cursor.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+        cursor.execute('PRAGMA temp_store = MEMORY')
+        cursor.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+        if read_only:
+            cursor.execute('PRAGMA query_only = ON')
+        cursor.close()
+        return conn
+    
+    @contextmanager
+    def reader(self):
+        """امانت گرفتن یک اتصال خواننده"""
+        if self._readers is None:
+            with self.writer() as conn:
+                yield conn
+            return
+        
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+    
+    @contextmanager
+    def writer(self):
+        """دسترسی انحصاری به اتصال نویسنده"""
+        with self._writer_lock:
+            yield self._writer
+    
+    def close(self):
+        """بستن همه اتصال‌ها"""
+        if self._readers is not None:
+            while not self._readers.empty():
+                self._readers.get_nowait().close()
+        with self._writer_lock:
+            self._writer.close()
+
+_USERS_WRITE_RE = re.compile(r'\b(UPDATE|INTO|FROM)\s+users\b', re.IGNORECASE)
+
+_current_update: contextvars.ContextVar = contextvars.ContextVar('current_update', default=None)
+
+class UpdateContext:
+    """کانتکست یک آپدیت تلگرام: identity map کاربر/قبیله و شمارش کوئری‌ها"""
+    
+    def __init__(self, update_id: Optional[int] = None):
+        self.update_id = update_id
+        self.users: Dict[int, Optional[User]] = {}
+        self.clans: Dict[int, Optional[Clan]] = {}
+        self.query_count = 0
+    
+    @staticmethod
+    def current() -> Optional['UpdateContext']:
+        """کانتکست آپدیت فعلی (یا None بیرون از پردازش آپدیت)"""
+        return _current_update.get()
+    
+    @classmethod
+    @contextmanager
+    def scope(cls, update_id: Optional[int] = None):
+        """فعال کردن کانتکست برای یک آپدیت؛ اگر از قبل فعال باشد همان استفاده می‌شود"""
+        ctx = _current_update.get()
+        if ctx is not None:
+            yield ctx
+            return
+        
+        ctx = cls(update_id)
+        token = _current_update.set(ctx)
+        try:
+            yield ctx
+        finally:
+            _current_update.reset(token)
+            logger.debug(f"📨 Update {update_id}: {ctx.query_count} queries")
+
+def _count_query():
+    """شمارش کوئری در کانتکست آپدیت فعلی"""
+    ctx = _current_update.get()
+    if ctx is not None:
+        ctx.query_count += 1
+
+class UserCache:
+    """کش LRU با TTL برای get_user همراه با شمارنده‌های hit/miss/eviction"""
+    
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: 'OrderedDict[int, Tuple[float, User]]' = OrderedDict()
+        self._lock = threading.Lock()
+        
+        # نسل نامعتبرسازی‌ها؛ خواندنی که قبل از یک نوشتن شروع شده نباید کش شود
+        self._generation = 0
+        self._invalidated: 'OrderedDict[int, int]' = OrderedDict()
+        self._invalidated_floor = 0
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+    
+    def get(self, user_id: int) -> Optional[User]:
+        """خواندن از کش (None یعنی miss)"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            expires_at, user = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return user
+    
+    def load_token(self) -> int:
+        """نسل فعلی؛ قبل از خواندن از دیتابیس گرفته می‌شود"""
+        return self._generation
+    
+    def put(self, user: User, token: int):
+        """ذخیره کاربر در کش، اگر از زمان token نامعتبر نشده باشد"""
+        with self._lock:
+            invalidated_at = self._invalidated.get(user.user_id, self._invalidated_floor)
+            if invalidated_at > token:
+                return
+            
+            self._entries[user.user_id] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(user.user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, user_id: int):
+        """حذف کاربر از کش بعد از هر نوشتن"""
+        with self._lock:
+            self._generation += 1
+            self._invalidated[user_id] = self._generation
+            self._invalidated.move_to_end(user_id)
+            if len(self._invalidated) > self.max_size:
+                _, generation = self._invalidated.popitem(last=False)
+                self._invalidated_floor = max(self._invalidated_floor, generation)
+            
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+    
+    def clear(self):
+        """خالی کردن کامل کش"""
+        with self._lock:
+            self._generation += 1
+            self._invalidated.clear()
+            self._invalidated_floor = self._generation
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        """آمار کش برای تنظیم اندازه"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+class UnitOfWork:
+    """یک تراکنش باز روی اتصال نویسنده؛ فقط از طریق Database.transaction ساخته می‌شود"""
+    
+    # ستون‌هایی از users که تغییر نسبی روی آن‌ها مجاز است
+    INCREMENT_COLUMNS = {
+        'gold', 'elixir', 'gem', 'trophies', 'experience', 'level', 'warnings',
+        'gold_rate', 'elixir_rate', 'storage_cap',
+    }
+    
+    def __init__(self, db: 'Database', conn: sqlite3.Connection):
+        self.db = db
+        self.conn = conn
+        # کاربرانی که بعد از پایان تراکنش باید از کش حذف شوند
+        self.touched_users = set()
+    
+    def query(self, query: str, params: tuple = ()) -> list:
+        """اجرای SELECT داخل تراکنش"""
+        _count_query()
+        start = time.perf_counter()
+        rows = self.conn.execute(query, params).fetchall()
+        _observe_query(query, start, len(rows), self.conn, params)
+        return rows
+    
+    def execute(self, query: str, params: tuple = ()) -> int:
+        """اجرای INSERT/UPDATE/DELETE داخل تراکنش"""
+        _count_query()
+        start = time.perf_counter()
+        cursor = self.conn.execute(query, params)
+        _observe_query(query, start, cursor.rowcount, self.conn, params)
+        return cursor.lastrowid
+    
+    def executemany(self, query: str, seq_of_params: list) -> int:
+        """اجرای یک دستور برای چند ردیف داخل تراکنش"""
+        _count_query()
+        start = time.perf_counter()
+        rowcount = self.conn.executemany(query, seq_of_params).rowcount
+        _observe_query(query, start, rowcount)
+        return rowcount
+    
+    def get_user(self, user_id: int) -> Optional[User]:
+        """خواندن کاربر با قفل نوشتن (داده تازه داخل تراکنش)"""
+        rows = self.query('SELECT * FROM users WHERE user_id = ?', (user_id,))
+        if rows:
+            return Database._user_from_row(rows[0])
+        return None
+    
+    def update_user(self, user_id: int, **kwargs):
+        """مقداردهی مستقیم ستون‌های کاربر"""
+        if not kwargs:
+            return
+        set_clause = ', '.join([f'{k} = ?' for k in kwargs.keys()])
+        self.execute(
+            f'UPDATE users SET {set_clause} WHERE user_id = ?',
+            tuple(kwargs.values()) + (user_id,)
+        )
+        self.touched_users.add(user_id)
+    
+    def increment_user(self, user_id: int, **deltas):
+        """تغییر نسبی ستون‌های کاربر در خود SQL (مثلا gold = gold + ?) بدون رفتن زیر صفر"""
+        deltas = {k: v for k, v in deltas.items() if v}
+        if not deltas:
+            return
+        for column in deltas:
+            if column not in self.INCREMENT_COLUMNS:
+                raise ValueError(f"Column {column} cannot be incremented")
+        set_clause = ', '.join([f'{k} = MAX(0, {k} + ?)' for k in deltas.keys()])
+        self.execute(
+            f'UPDATE users SET {set_clause} WHERE user_id = ?',
+            tuple(deltas.values()) + (user_id,)
+        )
+        self.touched_users.add(user_id)
+
+MISSION_PROGRESS_DROPPED = METRICS.counter(
+    'amele_mission_progress_dropped_total', 'Mission progress increments that matched no mission row'
+)
+
+
 class Database:
     """کلاس مدیریت دیتابیس SQLite"""
     
@@ -179,11 +1036,53 @@ class Database:
     def __init__(self, db_path: str = DATABASE_FILE):
         self.db_path = db_path
         logger.info(f"📁 Connecting to database: {self.db_path}")
+        self.pool = ConnectionPool(db_path)
+        self.user_cache = UserCache()
+        self._active_uow: Optional[UnitOfWork] = None
         self._init_db()
     
+    def close(self):
+        """بستن اتصال‌های دیتابیس"""
+        self.pool.close()
+    
+    # migrationهای شماره‌دار؛ آخرین شماره اعمال‌شده در PRAGMA user_version ذخیره می‌شود
+    MIGRATIONS = [
+        (1, '_migrate_base_schema'),
+        (2, '_migrate_query_indexes'),
+        (3, '_migrate_production_rates'),
+        (4, '_migrate_mission_day'),
+        (5, '_migrate_epoch_timestamps'),
+        (6, '_migrate_fsm_states'),
+    ]
+    SCHEMA_VERSION = MIGRATIONS[-1][0]
+    
     def _init_db(self):
-        """ایجاد جداول دیتابیس"""
-        conn = sqlite3.connect(self.db_path)
+        """اجرای migrationهای اعمال‌نشده دیتابیس"""
+        current_version = self.get_schema_version()
+        if current_version >= self.SCHEMA_VERSION:
+            logger.info(f"✅ Database schema is up to date (v{current_version})")
+            return
+        
+        for version, method_name in self.MIGRATIONS:
+            if version <= current_version:
+                continue
+            
+            # هر migration همراه با شماره نسخه در یک تراکنش اعمال می‌شود
+            with self.transaction() as uow:
+                getattr(self, method_name)(uow.conn)
+                uow.conn.execute(f'PRAGMA user_version = {version}')
+            
+            logger.info(f"🛠️ Migration {version} applied: {method_name}")
+        
+        logger.info(f"✅ Database schema migrated to v{self.SCHEMA_VERSION}")
+    
+    def get_schema_version(self) -> int:
+        """نسخه فعلی اسکیمای دیتابیس"""
+        with self.pool.writer() as conn:
+            return conn.execute('PRAGMA user_version').fetchone()[0]
+    
+    def _migrate_base_schema(self, conn: sqlite3.Connection):
+        """Migration 1: جداول اصلی و کاربر ابرقدرت"""
         cursor = conn.cursor()
         
         # جدول کاربران
@@ -318,17 +1217,170 @@ class Database:
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_clan_messages_clan_id ON clan_messages(clan_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_buildings_user_id ON buildings(user_id)')
         
-        conn.commit()
-        conn.close()
+        # ایجاد کاربر ابرقدرت (ادمین)
+        self._create_superpower_country(conn)
+    
+    def _migrate_query_indexes(self, conn: sqlite3.Connection):
+        """Migration 2: ایندکس‌های کوئری‌های پرتکرار"""
+        cursor = conn.cursor()
         
-        logger.info("✅ Database tables created successfully")
+        # شمارش حمله‌های امروز در پروفایل
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_attack_logs_attacker_time
+        ON attack_logs(attacker_id, timestamp)
+        ''')
         
-        # ایجاد کاربر ابرقدرت (ادمین)
-        self._create_superpower_country()
+        # ماموریت‌های امروز کاربر
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_missions_user_type_created
+        ON missions(user_id, mission_type, created_at)
+        ''')
+        
+        # get_top_players بدون مرتب‌سازی موقت
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_leaderboard
+        ON users(banned, trophies DESC, level DESC)
+        ''')
+        
+        # گزارش‌های در انتظار
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_reports_status_created
+        ON reports(status, created_at)
+        ''')
+    
+    def _migrate_production_rates(self, conn: sqlite3.Connection):
+        """Migration 3: ستون‌های نرخ تولید و ظرفیت انبار در users"""
+        cursor = conn.cursor()
+        cursor.execute('ALTER TABLE users ADD COLUMN gold_rate INTEGER DEFAULT 0')
+        cursor.execute('ALTER TABLE users ADD COLUMN elixir_rate INTEGER DEFAULT 0')
+        cursor.execute(f'ALTER TABLE users ADD COLUMN storage_cap INTEGER DEFAULT {STORAGE_CAP_PER_LEVEL}')
+        
+        # پر کردن ستون‌ها از روی ساختمان‌های فعلی با یک دستور
+        rates = [
+            (b_type.value, level, rate)
+            for b_type, levels in RESOURCE_PRODUCTION.items()
+            for level, rate in levels.items()
+        ]
+        values = ', '.join(['(?, ?, ?)'] * len(rates))
+        rate_sum = '''COALESCE((
+            SELECT SUM(r.rate) FROM buildings b
+            JOIN rates r ON r.building_type = b.building_type AND r.level = b.level
+            WHERE b.user_id = users.user_id AND b.building_type = ?
+        ), 0)'''
+        cursor.execute(
+            f'''WITH rates(building_type, level, rate) AS (VALUES {values})
+            UPDATE users SET
+                gold_rate = {rate_sum},
+                elixir_rate = {rate_sum},
+                storage_cap = ? * level''',
+            tuple(v for row in rates for v in row) + (
+                BuildingType.GOLD_MINE.value,
+                BuildingType.ELIXIR_COLLECTOR.value,
+                STORAGE_CAP_PER_LEVEL,
+            )
+        )
+    
+    def _migrate_mission_day(self, conn: sqlite3.Connection):
+        """Migration 4: ستون عددی mission_day برای ماموریت‌ها به جای فیلتر روی تاریخ"""
+        cursor = conn.cursor()
+        cursor.execute('ALTER TABLE missions ADD COLUMN mission_day INTEGER')
+        cursor.execute(
+            "UPDATE missions SET mission_day = CAST(julianday(created_at) - 2440587.5 AS INTEGER)"
+        )
+        
+        # حذف ردیف‌های تکراری احتمالی قبل از ساخت ایندکس یکتا
+        cursor.execute('''
+        DELETE FROM missions WHERE mission_id NOT IN (
+            SELECT MIN(mission_id) FROM missions GROUP BY user_id, mission_day, mission_type
+        )
+        ''')
+        cursor.execute('DROP INDEX IF EXISTS idx_missions_user_type_created')
+        cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_missions_user_day_type
+        ON missions(user_id, mission_day, mission_type)
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_missions_day ON missions(mission_day)')
+    
+    def _migrate_epoch_timestamps(self, conn: sqlite3.Connection):
+        """Migration 5: ستون‌های زمانی عددی (epoch)؛ ردیف‌های قدیمی بعدا به صورت دسته‌ای پر می‌شوند"""
+        cursor = conn.cursor()
+        for _, table, column, _ in TIMESTAMP_BACKFILLS:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} INTEGER')
+        
+        cursor.execute('DROP INDEX IF EXISTS idx_attack_logs_attacker_time')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_attack_logs_attacker_epoch
+        ON attack_logs(attacker_id, timestamp_epoch)
+        ''')
+        
+        # پیشرفت تبدیل هر ستون تا بعد از ری‌استارت ادامه پیدا کند
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backfills (
+            name TEXT PRIMARY KEY,
+            last_rowid INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        cursor.executemany(
+            'INSERT OR IGNORE INTO backfills (name) VALUES (?)',
+            [(name,) for name, _, _, _ in TIMESTAMP_BACKFILLS]
+        )
+    
+    def _migrate_fsm_states(self, conn: sqlite3.Connection):
+        """Migration 6: جدول وضعیت‌های FSM تا جریان‌های نیمه‌کاره بعد از ری‌استارت از دست نروند"""
+        cursor = conn.cursor()
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            bucket TEXT NOT NULL DEFAULT '{}',
+            updated_epoch INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_epoch)')
+    
+    def backfill_timestamps(self, batch_size: int = TIMESTAMP_BACKFILL_BATCH_SIZE) -> bool:
+        """تبدیل یک دسته از ردیف‌های قدیمی به epoch؛ اگر کاری باقی مانده باشد True برمی‌گرداند"""
+        pending = {
+            row['name']: row['last_rowid']
+            for row in self.execute_query('SELECT name, last_rowid FROM backfills WHERE done = 0')
+        }
+        
+        for name, table, column, legacy in TIMESTAMP_BACKFILLS:
+            if name not in pending:
+                continue
+            
+            # صفحه‌بندی با rowid (شناسه کاربران تلگرام پیوسته نیستند)
+            start = pending[name]
+            with self.transaction() as uow:
+                rowids = uow.query(
+                    f'SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                    (start, batch_size)
+                )
+                end = rowids[-1][0] if rowids else start
+                if rowids:
+                    uow.execute(
+                        f'''UPDATE {table} SET {column} = {LEGACY_TIME_SQL.format(column=legacy)}
+                        WHERE rowid > ? AND rowid <= ? AND {column} IS NULL AND {legacy} IS NOT NULL''',
+                        (start, end)
+                    )
+                done = len(rowids) < batch_size
+                uow.execute(
+                    'UPDATE backfills SET last_rowid = ?, done = ? WHERE name = ?',
+                    (end, int(done), name)
+                )
+            
+            if done:
+                logger.info(f"🕒 Timestamp backfill finished: {name}")
+            return True
+        
+        return False
     
-    def _create_superpower_country(self):
+    def _create_superpower_country(self, conn: sqlite3.Connection):
         """ایجاد کشور ابرقدرت (ادمین)"""
-        conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
         # بررسی وجود کاربر ادمین
@@ -367,86 +1419,199 @@ class Database:
             ''', buildings)
             
             logger.info("✅ Superpower country created successfully")
-        
-        conn.commit()
-        conn.close()
     
     def execute_query(self, query: str, params: tuple = ()) -> list:
         """اجرای کوئری SELECT"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        results = cursor.fetchall()
-        conn.close()
+        _count_query()
+        with self.pool.reader() as conn:
+            start = time.perf_counter()
+            cursor = conn.execute(query, params)
+            results = cursor.fetchall()
+            cursor.close()
+            _observe_query(query, start, len(results), conn, params)
         return results
     
     def execute_update(self, query: str, params: tuple = ()) -> int:
         """اجرای کوئری INSERT/UPDATE/DELETE"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        conn.commit()
-        last_id = cursor.lastrowid
-        conn.close()
+        # بیرون از تراکنش، هر دستور به صورت خودکار commit می‌شود
+        _count_query()
+        with self.pool.writer() as conn:
+            start = time.perf_counter()
+            cursor = conn.execute(query, params)
+            last_id = cursor.lastrowid
+            rowcount = cursor.rowcount
+            cursor.close()
+            _observe_query(query, start, rowcount, conn, params)
+        
+        # کوئری‌های خام روی users کل کش را نامعتبر می‌کنند
+        if _USERS_WRITE_RE.search(query):
+            self.user_cache.clear()
+            ctx = UpdateContext.current()
+            if ctx is not None:
+                ctx.users.clear()
         return last_id
     
-    # متدهای کمکی برای کاربران
-    def get_user(self, user_id: int) -> Optional[User]:
-        """دریافت اطلاعات کاربر"""
-        results = self.execute_query(
-            'SELECT * FROM users WHERE user_id = ?',
+    @contextmanager
+    def transaction(self):
+        """اجرای چند دستور در یک تراکنش BEGIN IMMEDIATE ... COMMIT"""
+        with self.pool.writer() as conn:
+            # تراکنش‌های تو در تو در تراکنش بیرونی ادغام می‌شوند
+            if self._active_uow is not None:
+                yield self._active_uow
+                return
+            
+            uow = UnitOfWork(self, conn)
+            self._active_uow = uow
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield uow
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+            finally:
+                self._active_uow = None
+                # حذف از کش بعد از commit تا خواننده‌ها داده قدیمی را دوباره کش نکنند
+                for user_id in uow.touched_users:
+                    self._invalidate_user(user_id)
+    
+    @staticmethod
+    def _user_from_row(row: sqlite3.Row) -> User:
+        """تبدیل یک ردیف جدول users به مدل User"""
+        return User(
+            user_id=row['user_id'],
+            username=row['username'],
+            game_name=row['game_name'],
+            level=row['level'],
+            experience=row['experience'],
+            gold=row['gold'],
+            elixir=row['elixir'],
+            gem=row['gem'],
+            trophies=row['trophies'],
+            clan_id=row['clan_id'],
+            role=UserRole(row['role']),
+            last_daily_reward=row['last_daily_reward'],
+            last_attack_epoch=(row['last_attack_epoch'] if row['last_attack_epoch'] is not None
+                               else parse_legacy_time(row['last_attack_time'])),
+            last_collection_epoch=(row['last_collection_epoch'] if row['last_collection_epoch'] is not None
+                                   else parse_legacy_time(row['last_collection_time'])),
+            warnings=row['warnings'],
+            banned=bool(row['banned']),
+            created_at=row['created_at'],
+            gold_rate=row['gold_rate'],
+            elixir_rate=row['elixir_rate'],
+            storage_cap=row['storage_cap']
+        )
+    
+    # متدهای کمکی برای کاربران
+    def _invalidate_user(self, user_id: int):
+        """حذف کاربر از کش سراسری و identity map آپدیت فعلی"""
+        self.user_cache.invalidate(user_id)
+        ctx = UpdateContext.current()
+        if ctx is not None:
+            ctx.users.pop(user_id, None)
+    
+    def _remember_user(self, user: User, token: int):
+        """ثبت کاربر خوانده‌شده در کش و identity map"""
+        self.user_cache.put(user, token)
+        ctx = UpdateContext.current()
+        if ctx is not None:
+            ctx.users[user.user_id] = user
+    
+    def get_user(self, user_id: int) -> Optional[User]:
+        """دریافت اطلاعات کاربر"""
+        ctx = UpdateContext.current()
+        if ctx is not None and user_id in ctx.users:
+            return ctx.users[user_id]
+        
+        # شیء کش‌شده بین فراخوانی‌ها مشترک است و نباید تغییر داده شود
+        user = self.user_cache.get(user_id)
+        if user is not None:
+            if ctx is not None:
+                ctx.users[user_id] = user
+            return user
+        
+        token = self.user_cache.load_token()
+        results = self.execute_query(
+            'SELECT * FROM users WHERE user_id = ?',
             (user_id,)
         )
         if results:
-            row = results[0]
-            return User(
-                user_id=row['user_id'],
-                username=row['username'],
-                game_name=row['game_name'],
-                level=row['level'],
-                experience=row['experience'],
-                gold=row['gold'],
-                elixir=row['elixir'],
-                gem=row['gem'],
-                trophies=row['trophies'],
-                clan_id=row['clan_id'],
-                role=UserRole(row['role']),
-                last_daily_reward=row['last_daily_reward'],
-                last_attack_time=row['last_attack_time'],
-                last_collection_time=row['last_collection_time'],
-                warnings=row['warnings'],
-                banned=bool(row['banned']),
-                created_at=row['created_at']
-            )
+            user = self._user_from_row(results[0])
+            self._remember_user(user, token)
+            return user
+        
+        if ctx is not None:
+            ctx.users[user_id] = None
         return None
     
+    def get_users(self, user_ids) -> Dict[int, User]:
+        """دریافت دسته‌ای کاربران با یک کوئری WHERE user_id IN (...)"""
+        ctx = UpdateContext.current()
+        found: Dict[int, User] = {}
+        missing = []
+        
+        for user_id in set(user_ids):
+            if ctx is not None and user_id in ctx.users:
+                if ctx.users[user_id] is not None:
+                    found[user_id] = ctx.users[user_id]
+                continue
+            user = self.user_cache.get(user_id)
+            if user is not None:
+                found[user_id] = user
+                if ctx is not None:
+                    ctx.users[user_id] = user
+            else:
+                missing.append(user_id)
+        
+        if missing:
+            token = self.user_cache.load_token()
+            placeholders = ', '.join('?' * len(missing))
+            results = self.execute_query(
+                f'SELECT * FROM users WHERE user_id IN ({placeholders})',
+                tuple(missing)
+            )
+            for row in results:
+                user = self._user_from_row(row)
+                self._remember_user(user, token)
+                found[user.user_id] = user
+        
+        return found
+    
     def create_user(self, user_id: int, username: str, game_name: str) -> bool:
         """ایجاد کاربر جدید"""
         try:
-            self.execute_update(
-                '''INSERT INTO users 
-                (user_id, username, game_name, last_collection_time) 
-                VALUES (?, ?, ?, CURRENT_TIMESTAMP)''',
-                (user_id, username, game_name)
-            )
-            
-            # ایجاد ساختمان‌های اولیه
-            buildings = [
-                (user_id, BuildingType.TOWN_HALL.value, 1),
-                (user_id, BuildingType.GOLD_MINE.value, 1),
-                (user_id, BuildingType.ELIXIR_COLLECTOR.value, 1),
-                (user_id, BuildingType.BARRACKS.value, 1),
-            ]
-            
-            for building in buildings:
-                self.execute_update(
+            with self.transaction() as uow:
+                uow.touched_users.add(user_id)
+                uow.execute(
+                    '''INSERT INTO users 
+                    (user_id, username, game_name, last_collection_epoch,
+                     gold_rate, elixir_rate, storage_cap) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                    (
+                        user_id, username, game_name, now_epoch(),
+                        RESOURCE_PRODUCTION[BuildingType.GOLD_MINE][1],
+                        RESOURCE_PRODUCTION[BuildingType.ELIXIR_COLLECTOR][1],
+                        STORAGE_CAP_PER_LEVEL
+                    )
+                )
+                
+                # ایجاد ساختمان‌های اولیه
+                buildings = [
+                    (user_id, BuildingType.TOWN_HALL.value, 1),
+                    (user_id, BuildingType.GOLD_MINE.value, 1),
+                    (user_id, BuildingType.ELIXIR_COLLECTOR.value, 1),
+                    (user_id, BuildingType.BARRACKS.value, 1),
+                ]
+                
+                uow.executemany(
                     'INSERT INTO buildings (user_id, building_type, level) VALUES (?, ?, ?)',
-                    building
+                    buildings
                 )
-            
-            # ایجاد ماموریت‌های روزانه
-            self.create_daily_missions(user_id)
+                
+                # ایجاد ماموریت‌های روزانه
+                self.create_daily_missions(user_id)
             
             logger.info(f"✅ User created: {game_name} (ID: {user_id})")
             return True
@@ -463,19 +1628,29 @@ class Database:
         query = f'UPDATE users SET {set_clause} WHERE user_id = ?'
         params = list(kwargs.values()) + [user_id]
         
-        self.execute_update(query, tuple(params))
+        _count_query()
+        with self.pool.writer() as conn:
+            start = time.perf_counter()
+            conn.execute(query, tuple(params))
+            _observe_query(query, start, 1, conn, tuple(params))
+        self._invalidate_user(user_id)
         return True
     
     # متدهای کمکی برای قبایل
     def get_clan(self, clan_id: int) -> Optional[Clan]:
         """دریافت اطلاعات قبیله"""
+        ctx = UpdateContext.current()
+        if ctx is not None and clan_id in ctx.clans:
+            return ctx.clans[clan_id]
+        
         results = self.execute_query(
             'SELECT * FROM clans WHERE clan_id = ?',
             (clan_id,)
         )
+        clan = None
         if results:
             row = results[0]
-            return Clan(
+            clan = Clan(
                 clan_id=row['clan_id'],
                 name=row['name'],
                 tag=row['tag'],
@@ -486,7 +1661,10 @@ class Database:
                 member_count=row['member_count'],
                 created_at=row['created_at']
             )
-        return None
+        
+        if ctx is not None:
+            ctx.clans[clan_id] = clan
+        return clan
     
     def get_clan_by_name(self, name: str) -> Optional[Clan]:
         """دریافت قبیله با نام"""
@@ -530,6 +1708,7 @@ class Database:
     
     def get_clan_members(self, clan_id: int) -> List[User]:
         """دریافت اعضای قبیله"""
+        token = self.user_cache.load_token()
         results = self.execute_query(
             '''SELECT * FROM users 
             WHERE clan_id = ? AND banned = 0 
@@ -543,28 +1722,33 @@ class Database:
             (clan_id,)
         )
         
+        # اعضا ردیف کامل دارند و در identity map ثبت می‌شوند (مثلا برای رهبر)
         members = []
         for row in results:
-            members.append(User(
-                user_id=row['user_id'],
-                username=row['username'],
-                game_name=row['game_name'],
-                level=row['level'],
-                trophies=row['trophies'],
-                role=UserRole(row['role'])
-            ))
+            user = self._user_from_row(row)
+            self._remember_user(user, token)
+            members.append(user)
         return members
     
-    def add_clan_message(self, clan_id: int, user_id: int, message: str) -> int:
-        """اضافه کردن پیام به چت قبیله"""
-        message_id = self.execute_update(
-            '''INSERT INTO clan_messages (clan_id, user_id, message)
-            VALUES (?, ?, ?)''',
-            (clan_id, user_id, message)
-        )
+    def add_clan_messages(self, messages: List[ClanMessage]) -> int:
+        """ذخیره دسته‌ای پیام‌های قبیله با یک executemany و یک commit
+        
+        تنها مسیر نوشتن پیام قبیله؛ شناسه‌ها را ClanMessageBuffer از قبل رزرو می‌کند
+        """
+        with self.transaction() as uow:
+            count = uow.executemany(
+                '''INSERT INTO clan_messages (message_id, clan_id, user_id, message, created_epoch)
+                VALUES (?, ?, ?, ?, ?)''',
+                [(m.message_id, m.clan_id, m.user_id, m.message, m.created_epoch) for m in messages]
+            )
         
-        logger.debug(f"💬 Clan message added: Clan {clan_id}, User {user_id}")
-        return message_id
+        logger.debug(f"💬 {count} clan messages flushed")
+        return count
+    
+    def get_last_clan_message_id(self) -> int:
+        """بزرگ‌ترین شناسه پیام قبیله"""
+        results = self.execute_query('SELECT MAX(message_id) AS last_id FROM clan_messages')
+        return results[0]['last_id'] or 0
     
     def get_clan_messages(self, clan_id: int, limit: int = 50) -> List[ClanMessage]:
         """دریافت پیام‌های قبیله"""
@@ -573,7 +1757,7 @@ class Database:
             FROM clan_messages cm
             JOIN users u ON cm.user_id = u.user_id
             WHERE cm.clan_id = ?
-            ORDER BY cm.created_at DESC
+            ORDER BY cm.message_id DESC
             LIMIT ?''',
             (clan_id, limit)
         )
@@ -585,7 +1769,8 @@ class Database:
                 clan_id=row['clan_id'],
                 user_id=row['user_id'],
                 message=row['message'],
-                created_at=row['created_at']
+                created_epoch=(row['created_epoch'] if row['created_epoch'] is not None
+                               else parse_legacy_time(row['created_at']))
             ))
         return messages[::-1]  # معکوس کردن برای نمایش از قدیم به جدید
     
@@ -628,38 +1813,170 @@ class Database:
         return reports
     
     # متدهای کمکی برای ماموریت‌ها
-    def create_daily_missions(self, user_id: int):
-        """ایجاد ماموریت‌های روزانه برای کاربر"""
-        missions = [
-            (user_id, 'collect_resources', 50000, 1000, 500, 5),
-            (user_id, 'attack_players', 3, 1500, 750, 10),
-            (user_id, 'upgrade_building', 1, 2000, 1000, 15),
-            (user_id, 'send_clan_messages', 5, 500, 250, 3),
-        ]
-        
-        for mission in missions:
-            self.execute_update(
-                '''INSERT INTO missions 
-                (user_id, mission_type, target_value, reward_gold, reward_elixir, reward_gem)
-                VALUES (?, ?, ?, ?, ?, ?)''',
-                mission
+    def create_daily_missions(self, user_id: int, mission_day: Optional[int] = None):
+        """ایجاد ماموریت‌های روزانه برای کاربر (در صورت وجود، کاری انجام نمی‌شود)"""
+        if mission_day is None:
+            mission_day = current_mission_day()
+        
+        with self.transaction() as uow:
+            uow.execute(
+                MATERIALIZE_MISSIONS_SQL.format(where='u.user_id = ?'),
+                tuple(v for row in DAILY_MISSIONS for v in row) + (mission_day, user_id)
             )
         
         logger.debug(f"🎯 Daily missions created for user: {user_id}")
     
-    def get_user_missions(self, user_id: int) -> List[dict]:
-        """دریافت ماموریت‌های کاربر"""
+    def materialize_daily_missions(self, mission_day: Optional[int] = None) -> int:
+        """ساخت ماموریت‌های یک روز برای همه کاربران با یک INSERT ... SELECT"""
+        if mission_day is None:
+            mission_day = current_mission_day()
+        
+        with self.transaction() as uow:
+            uow.execute(
+                MATERIALIZE_MISSIONS_SQL.format(where='u.banned = 0'),
+                tuple(v for row in DAILY_MISSIONS for v in row) + (mission_day,)
+            )
+            created = uow.query('SELECT changes()')[0][0]
+        
+        logger.info(f"🎯 Daily missions materialized for day {mission_day}: {created} rows")
+        return created
+    
+    def prune_missions(self, before_day: int, batch_size: int = MISSION_PRUNE_BATCH_SIZE) -> int:
+        """حذف ماموریت‌های روزهای قدیمی در دسته‌های کوچک تا قفل نوشتن طولانی نشود"""
+        deleted = 0
+        while True:
+            with self.transaction() as uow:
+                uow.execute(
+                    '''DELETE FROM missions WHERE mission_id IN (
+                        SELECT mission_id FROM missions WHERE mission_day < ? LIMIT ?
+                    )''',
+                    (before_day, batch_size)
+                )
+                count = uow.query('SELECT changes()')[0][0]
+            deleted += count
+            if count < batch_size:
+                break
+        
+        if deleted:
+            logger.info(f"🧹 Pruned {deleted} missions older than day {before_day}")
+        return deleted
+    
+    def get_fsm_state(self, chat_id: int, user_id: int) -> Optional[sqlite3.Row]:
+        """خواندن وضعیت FSM ذخیره‌شده یک کاربر"""
         results = self.execute_query(
-            '''SELECT * FROM missions 
-            WHERE user_id = ? AND completed = 0 
-            AND DATE(created_at) = DATE('now')''',
-            (user_id,)
+            'SELECT state, data, bucket, updated_epoch FROM fsm_states WHERE chat_id = ? AND user_id = ?',
+            (chat_id, user_id)
+        )
+        return results[0] if results else None
+    
+    def save_fsm_states(self, rows: List[Tuple[int, int, Optional[str], str, str, int]]):
+        """ذخیره دسته‌ای وضعیت‌های FSM در یک تراکنش؛ وضعیت خالی یعنی حذف ردیف"""
+        upserts = [row for row in rows if row[2] is not None or row[3] != '{}' or row[4] != '{}']
+        deletes = [(row[0], row[1]) for row in rows if row[2] is None and row[3] == '{}' and row[4] == '{}']
+        with self.transaction() as uow:
+            if upserts:
+                uow.executemany(
+                    '''INSERT INTO fsm_states (chat_id, user_id, state, data, bucket, updated_epoch)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                        state = excluded.state, data = excluded.data,
+                        bucket = excluded.bucket, updated_epoch = excluded.updated_epoch''',
+                    upserts
+                )
+            if deletes:
+                uow.executemany('DELETE FROM fsm_states WHERE chat_id = ? AND user_id = ?', deletes)
+    
+    def prune_fsm_states(self, before_epoch: int, batch_size: int = FSM_PRUNE_BATCH_SIZE) -> int:
+        """حذف وضعیت‌های FSM رهاشده در دسته‌های کوچک"""
+        deleted = 0
+        while True:
+            with self.transaction() as uow:
+                uow.execute(
+                    '''DELETE FROM fsm_states WHERE rowid IN (
+                        SELECT rowid FROM fsm_states WHERE updated_epoch < ? LIMIT ?
+                    )''',
+                    (before_epoch, batch_size)
+                )
+                count = uow.query('SELECT changes()')[0][0]
+            deleted += count
+            if count < batch_size:
+                break
+        
+        if deleted:
+            logger.info(f"🧹 Pruned {deleted} abandoned FSM states")
+        return deleted
+    
+    def get_user_missions(self, user_id: int) -> Optional[List[dict]]:
+        """ماموریت‌های تکمیل‌نشده امروز کاربر؛ اگر هنوز ساخته نشده باشند None (ساخت با create_daily_missions)"""
+        results = self.execute_query(
+            'SELECT * FROM missions WHERE user_id = ? AND mission_day = ?',
+            (user_id, current_mission_day())
         )
+        if not results:
+            return None
+        return [dict(row) for row in results if not row['completed']]
+    
+    def apply_mission_progress(self, progress: List[Tuple[int, str, int, int]]) -> List[dict]:
+        """اعمال دسته‌ای پیشرفت ماموریت‌ها (user_id, mission_type, mission_day, amount) و پرداخت پاداش در یک تراکنش"""
+        completed = []
+        users_by_day: Dict[int, set] = {}
+        for user_id, _, mission_day, _ in progress:
+            users_by_day.setdefault(mission_day, set()).add(user_id)
+        
+        with self.transaction() as uow:
+            # ردیف‌های هر روز فقط با باز کردن صفحه ماموریت‌ها یا rollover نیمه‌شب ساخته می‌شوند؛
+            # بدون این INSERT، پیشرفت کاربرانی که هنوز ردیف ندارند گم می‌شود
+            templates = tuple(v for row in DAILY_MISSIONS for v in row)
+            for mission_day, users in users_by_day.items():
+                user_ids = sorted(users)
+                for start in range(0, len(user_ids), 500):
+                    chunk = user_ids[start:start + 500]
+                    uow.execute(
+                        MATERIALIZE_MISSIONS_SQL.format(where=f"u.user_id IN ({','.join('?' * len(chunk))})"),
+                        templates + (mission_day,) + tuple(chunk)
+                    )
+            
+            # ماموریت‌های تکمیل‌شده هم match می‌شوند (بدون تغییر) تا تعداد ردیف‌ها قابل بررسی باشد
+            updated = uow.executemany(
+                '''UPDATE missions SET current_value = current_value + CASE WHEN completed = 0 THEN ? ELSE 0 END
+                WHERE user_id = ? AND mission_day = ? AND mission_type = ?''',
+                [(amount, user_id, mission_day, mission_type)
+                 for user_id, mission_type, mission_day, amount in progress]
+            )
+            if updated != len(progress):
+                MISSION_PROGRESS_DROPPED.inc(amount=len(progress) - updated)
+                logger.error(f"⚠️ {len(progress) - updated} of {len(progress)} mission progress rows "
+                             f"had no mission for days {sorted(users_by_day)}")
+            
+            for mission_day, users in users_by_day.items():
+                user_ids = sorted(users)
+                for start in range(0, len(user_ids), 500):
+                    chunk = user_ids[start:start + 500]
+                    placeholders = ','.join('?' * len(chunk))
+                    completed.extend(dict(row) for row in uow.query(
+                        f'''SELECT mission_id, user_id, mission_type, reward_gold, reward_elixir, reward_gem
+                        FROM missions
+                        WHERE user_id IN ({placeholders}) AND mission_day = ? AND completed = 0
+                        AND current_value >= target_value''',
+                        tuple(chunk) + (mission_day,)
+                    ))
+            
+            if completed:
+                uow.executemany(
+                    'UPDATE missions SET completed = 1 WHERE mission_id = ?',
+                    [(mission['mission_id'],) for mission in completed]
+                )
+                for mission in completed:
+                    uow.increment_user(
+                        mission['user_id'],
+                        gold=mission['reward_gold'],
+                        elixir=mission['reward_elixir'],
+                        gem=mission['reward_gem']
+                    )
         
-        missions = []
-        for row in results:
-            missions.append(dict(row))
-        return missions
+        for mission in completed:
+            logger.info(f"🎯 Mission completed: {mission['mission_type']} for user {mission['user_id']}")
+        return completed
     
     # متدهای کمکی برای رتبه‌بندی
     def get_top_players(self, limit: int = 10) -> List[User]:
@@ -706,6 +2023,1047 @@ class Database:
             ))
         return clans
 
+class AsyncDatabase:
+    """لایه async روی Database؛ کوئری‌ها در thread pool اجرا می‌شوند تا event loop قفل نشود"""
+    
+    # متدهایی که می‌نویسند و باید روی تنها نویسنده به ترتیب اجرا شوند
+    WRITE_METHODS = {
+        'execute_update',
+        'create_user',
+        'update_user',
+        'create_clan',
+        'add_clan_messages',
+        'create_report',
+        'create_daily_missions',
+        'materialize_daily_missions',
+        'prune_missions',
+        'backfill_timestamps',
+        'apply_mission_progress',
+        'save_fsm_states',
+        'prune_fsm_states',
+    }
+    
+    def __init__(self, db: Database, readers: int = DB_READER_CONNECTIONS):
+        self.db = db
+        self._read_executor = ThreadPoolExecutor(
+            max_workers=max(1, readers),
+            thread_name_prefix='db-read'
+        )
+        self._write_executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='db-write'
+        )
+    
+    async def run(self, fn, *args, **kwargs):
+        """اجرای یک تابع خواندنی در thread pool خواننده‌ها"""
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self._read_executor, functools.partial(ctx.run, fn, *args, **kwargs)
+        )
+    
+    async def run_write(self, fn, *args, **kwargs):
+        """اجرای یک تابع نویسنده در تنها thread نویسنده (به ترتیب ورود)"""
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self._write_executor, functools.partial(ctx.run, fn, *args, **kwargs)
+        )
+    
+    def __getattr__(self, name: str):
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+        
+        runner = self.run_write if name in self.WRITE_METHODS else self.run
+        
+        async def call(*args, **kwargs):
+            return await runner(attr, *args, **kwargs)
+        
+        call.__name__ = name
+        return call
+    
+    def close(self):
+        """منتظر ماندن برای کارهای در حال اجرا و بستن thread poolها"""
+        self._read_executor.shutdown(wait=True)
+        self._write_executor.shutdown(wait=True)
+
+class ClanMessageBuffer:
+    """بافر write-behind برای پیام‌های قبیله؛ پیام‌ها دسته‌ای و با یک commit ذخیره می‌شوند"""
+    
+    def __init__(self, adb: AsyncDatabase,
+                 batch_size: int = CHAT_FLUSH_BATCH_SIZE,
+                 max_latency: float = CHAT_FLUSH_MAX_LATENCY):
+        self.adb = adb
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        
+        # شناسه پیام‌ها از قبل رزرو می‌شود تا خواندن قبل از ذخیره هم ممکن باشد
+        self._last_id = 0
+        self._pending: List[ClanMessage] = []
+        self._in_flight: List[ClanMessage] = []
+        self._flush_lock = asyncio.Lock()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self.dropped = 0  # پیام‌هایی که با خطای دائمی ذخیره نشدند
+    
+    async def start(self):
+        """خواندن آخرین شناسه پیام از دیتابیس"""
+        self._last_id = await self.adb.get_last_clan_message_id()
+    
+    def add(self, clan_id: int, user_id: int, message: str) -> ClanMessage:
+        """افزودن پیام به بافر (بدون انتظار برای دیتابیس)"""
+        self._last_id += 1
+        msg = ClanMessage(
+            message_id=self._last_id,
+            clan_id=clan_id,
+            user_id=user_id,
+            message=message,
+            created_epoch=now_epoch()
+        )
+        self._pending.append(msg)
+        
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.max_latency, self._start_flush)
+        
+        return msg
+    
+    def _start_flush(self):
+        """شروع flush در پس‌زمینه"""
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def flush(self):
+        """ذخیره همه پیام‌های در انتظار"""
+        async with self._flush_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            
+            if not self._pending:
+                return
+            
+            self._in_flight, self._pending = self._pending, []
+            try:
+                await self.adb.add_clan_messages(self._in_flight)
+            except sqlite3.OperationalError as e:
+                # دیتابیس مشغول/قفل: پیام‌ها به ابتدای صف برمی‌گردند و دوباره تلاش می‌شود
+                logger.error(f"Error flushing clan messages: {e}")
+                self._retry(self._in_flight)
+            except Exception as e:
+                # خطای دائمی (مثلا IntegrityError) نباید پیام‌های بعدی را برای همیشه معطل کند
+                logger.error(f"Error flushing clan messages, saving one by one: {e}")
+                await self._save_one_by_one(self._in_flight)
+            finally:
+                self._in_flight = []
+    
+    def _retry(self, messages: List[ClanMessage]):
+        """برگرداندن پیام‌ها به ابتدای صف و زمان‌بندی flush بعدی"""
+        self._pending[:0] = messages
+        if self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.max_latency, self._start_flush)
+    
+    async def _save_one_by_one(self, messages: List[ClanMessage]):
+        """ذخیره تک‌تک پیام‌های یک دسته ناموفق؛ ردیف‌های خراب حذف و لاگ می‌شوند"""
+        for index, msg in enumerate(messages):
+            try:
+                await self.adb.add_clan_messages([msg])
+            except sqlite3.OperationalError as e:
+                logger.error(f"Error flushing clan messages: {e}")
+                self._retry(messages[index:])
+                return
+            except Exception as e:
+                self.dropped += 1
+                logger.error(f"⚠️ Clan message {msg.message_id} dropped: {e}")
+    
+    @property
+    def pending_count(self) -> int:
+        """تعداد پیام‌های ذخیره‌نشده"""
+        return len(self._pending) + len(self._in_flight)
+    
+    async def get_clan_messages(self, clan_id: int, limit: int = 50) -> List[ClanMessage]:
+        """دریافت پیام‌های قبیله همراه با پیام‌های هنوز ذخیره‌نشده"""
+        # برداشت بافر قبل از خواندن دیتابیس؛ تکراری‌ها با شناسه حذف می‌شوند
+        unsaved = [m for m in self._in_flight + self._pending if m.clan_id == clan_id]
+        messages = await self.adb.get_clan_messages(clan_id, limit)
+        
+        if unsaved:
+            saved_ids = {m.message_id for m in messages}
+            messages += [m for m in unsaved if m.message_id not in saved_ids]
+            messages.sort(key=lambda m: m.message_id)
+        
+        return messages[-limit:]
+    
+    async def close(self):
+        """ذخیره پیام‌های باقیمانده هنگام خاموش شدن"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
+        if self._pending:
+            logger.error(f"⚠️ {len(self._pending)} clan messages could not be saved")
+
+class MissionEngine:
+    """پیشرفت ماموریت‌ها بر اساس رویدادهای بازی؛ افزایش‌ها در حافظه جمع و دسته‌ای ذخیره می‌شوند"""
+    
+    def __init__(self, adb: AsyncDatabase,
+                 batch_size: int = MISSION_FLUSH_BATCH_SIZE,
+                 max_latency: float = MISSION_FLUSH_MAX_LATENCY):
+        self.adb = adb
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        
+        # (user_id, mission_type, mission_day) -> مجموع افزایش‌های ذخیره‌نشده؛
+        # روز هنگام رویداد ثبت می‌شود تا افزایش‌های قبل از نیمه‌شب به روز بعد نروند
+        self._pending: Dict[Tuple[int, str, int], int] = {}
+        self._in_flight: Dict[Tuple[int, str, int], int] = {}
+        self._flush_lock = asyncio.Lock()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self.completed_count = 0
+    
+    def emit(self, event: GameEvent, user_id: int, amount: int = 1):
+        """ثبت یک رویداد بازی (بدون انتظار برای دیتابیس)"""
+        mission_type = EVENT_MISSION_TYPES.get(event)
+        if mission_type is None or amount <= 0:
+            return
+        
+        key = (user_id, mission_type, current_mission_day())
+        self._pending[key] = self._pending.get(key, 0) + amount
+        
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.max_latency, self._start_flush)
+    
+    def _start_flush(self):
+        """شروع flush در پس‌زمینه"""
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def flush(self):
+        """ذخیره افزایش‌های در انتظار و پرداخت پاداش ماموریت‌های تکمیل‌شده"""
+        async with self._flush_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            
+            if not self._pending:
+                return
+            
+            self._in_flight, self._pending = self._pending, {}
+            try:
+                completed = await self.adb.apply_mission_progress(
+                    [(user_id, mission_type, mission_day, amount)
+                     for (user_id, mission_type, mission_day), amount in self._in_flight.items()]
+                )
+                self.completed_count += len(completed)
+            except Exception as e:
+                # افزایش‌ها با صف فعلی ادغام می‌شوند و دوباره تلاش می‌شود
+                logger.error(f"Error flushing mission progress: {e}")
+                for key, amount in self._in_flight.items():
+                    self._pending[key] = self._pending.get(key, 0) + amount
+                if self._timer is None:
+                    loop = asyncio.get_running_loop()
+                    self._timer = loop.call_later(self.max_latency, self._start_flush)
+            finally:
+                self._in_flight = {}
+    
+    def pending_for(self, user_id: int, mission_day: Optional[int] = None) -> Dict[str, int]:
+        """افزایش‌های ذخیره‌نشده کاربر برای هر نوع ماموریت در یک روز (پیش‌فرض امروز)"""
+        if mission_day is None:
+            mission_day = current_mission_day()
+        pending = {}
+        for source in (self._in_flight, self._pending):
+            for (key_user, mission_type, key_day), amount in source.items():
+                if key_user == user_id and key_day == mission_day:
+                    pending[mission_type] = pending.get(mission_type, 0) + amount
+        return pending
+    
+    @property
+    def pending_count(self) -> int:
+        """تعداد شمارنده‌های ذخیره‌نشده"""
+        return len(self._pending) + len(self._in_flight)
+    
+    async def close(self):
+        """ذخیره شمارنده‌های باقیمانده هنگام خاموش شدن"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
+        if self._pending:
+            logger.error(f"⚠️ {len(self._pending)} mission counters could not be saved")
+
+class FSMRecord:
+    """وضعیت، داده و bucket یک کاربر در FSM"""
+    
+    __slots__ = ('state', 'data', 'bucket', 'updated_epoch')
+    
+    def __init__(self, state: Optional[str] = None, data: dict = None, bucket: dict = None,
+                 updated_epoch: int = 0):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.bucket = bucket if bucket is not None else {}
+        self.updated_epoch = updated_epoch
+    
+    @classmethod
+    def from_row(cls, row: Optional[sqlite3.Row]) -> 'FSMRecord':
+        if row is None:
+            return cls()
+        return cls(row['state'], json.loads(row['data']), json.loads(row['bucket']), row['updated_epoch'])
+    
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data and not self.bucket
+
+
+class SQLiteFSMStorage(BaseStorage):
+    """ذخیره‌ساز FSM روی جدول fsm_states با لایه LRU در حافظه و ذخیره دسته‌ای تغییرها
+    
+    خواندن‌ها (حتی «وضعیتی ندارد») در لایه حافظه کش می‌شوند تا هر پیام متنی به دیتابیس نرود؛
+    چند تغییر پشت‌سرهم یک کاربر (set_state + update_data) در یک ردیف ادغام می‌شوند.
+    جریان‌هایی که بیش از ttl دست نخورده‌اند منقضی و با sweep از دیتابیس حذف می‌شوند.
+    """
+    
+    def __init__(self, hot_size: int = FSM_HOT_SIZE, ttl: float = FSM_STATE_TTL,
+                 batch_size: int = FSM_FLUSH_BATCH_SIZE,
+                 max_latency: float = FSM_FLUSH_MAX_LATENCY):
+        self.adb: Optional[AsyncDatabase] = None
+        self.hot_size = hot_size
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        
+        self._entries: 'OrderedDict[Tuple[int, int], FSMRecord]' = OrderedDict()
+        # (chat_id, user_id) -> آخرین نسخه ذخیره‌نشده؛ با خارج شدن از LRU از دست نمی‌رود
+        self._pending: Dict[Tuple[int, int], FSMRecord] = {}
+        self._in_flight: Dict[Tuple[int, int], FSMRecord] = {}
+        self._flush_lock = asyncio.Lock()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    async def start(self, adb: AsyncDatabase):
+        """اتصال به دیتابیس (دیسپچر قبل از ساخته شدن دیتابیس ساخته می‌شود)"""
+        self.adb = adb
+    
+    def _remember(self, key: Tuple[int, int], record: FSMRecord):
+        self._entries[key] = record
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.hot_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def _lookup(self, key: Tuple[int, int]) -> Optional[FSMRecord]:
+        """جدیدترین نسخه در حافظه: LRU، سپس صف ذخیره و در حال ذخیره"""
+        record = self._entries.get(key)
+        if record is None:
+            record = self._pending.get(key) or self._in_flight.get(key)
+        return record
+    
+    async def _load(self, chat, user) -> Tuple[Tuple[int, int], FSMRecord]:
+        chat, user = self.check_address(chat=chat, user=user)
+        key = (int(chat), int(user))
+        
+        record = self._lookup(key)
+        if record is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            row = await self.adb.get_fsm_state(*key)
+            # اگر در زمان خواندن نوشتنی انجام شده باشد، نسخه حافظه جدیدتر است
+            record = self._lookup(key) or FSMRecord.from_row(row)
+        
+        if not record.empty and now_epoch() - record.updated_epoch > self.ttl:
+            record = FSMRecord()
+            self.expirations += 1
+        
+        self._remember(key, record)
+        return key, record
+    
+    def _save(self, key: Tuple[int, int], record: FSMRecord):
+        """ثبت تغییر در حافظه و صف ذخیره (بدون انتظار برای دیتابیس)"""
+        record.updated_epoch = now_epoch()
+        self._remember(key, record)
+        self._pending[key] = record
+        
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.max_latency, self._start_flush)
+    
+    def _start_flush(self):
+        """شروع flush در پس‌زمینه"""
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def flush(self):
+        """ذخیره همه تغییرهای در انتظار"""
+        async with self._flush_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            
+            if not self._pending:
+                return
+            
+            self._in_flight, self._pending = self._pending, {}
+            # سریال‌سازی قبل از رفتن به thread تا تغییرهای بعدی روی همین رکوردها اثر نگذارد
+            rows = [
+                (chat_id, user_id, record.state, json.dumps(record.data), json.dumps(record.bucket),
+                 record.updated_epoch)
+                for (chat_id, user_id), record in self._in_flight.items()
+            ]
+            try:
+                await self.adb.save_fsm_states(rows)
+            except Exception as e:
+                # نسخه‌های جدیدتر صف فعلی حفظ می‌شوند و دوباره تلاش می‌شود
+                logger.error(f"Error flushing FSM states: {e}")
+                for key, record in self._in_flight.items():
+                    self._pending.setdefault(key, record)
+                if self._timer is None:
+                    loop = asyncio.get_running_loop()
+                    self._timer = loop.call_later(self.max_latency, self._start_flush)
+            finally:
+                self._in_flight = {}
+    
+    async def sweep(self) -> int:
+        """حذف جریان‌های رهاشده از حافظه و دیتابیس"""
+        cutoff = now_epoch() - int(self.ttl)
+        expired = [
+            key for key, record in self._entries.items()
+            if not record.empty and record.updated_epoch < cutoff and key not in self._pending
+        ]
+        for key in expired:
+            del self._entries[key]
+        self.expirations += len(expired)
+        return await self.adb.prune_fsm_states(cutoff)
+    
+    @property
+    def pending_count(self) -> int:
+        """تعداد وضعیت‌های ذخیره‌نشده"""
+        return len(self._pending) + len(self._in_flight)
+    
+    def stats(self) -> Dict[str, Any]:
+        """آمار لایه حافظه"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.hot_size,
+            'pending': self.pending_count,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+    
+    async def get_state(self, *, chat=None, user=None, default: Optional[str] = None) -> Optional[str]:
+        _, record = await self._load(chat, user)
+        return record.state if record.state is not None else self.resolve_state(default)
+    
+    async def get_data(self, *, chat=None, user=None, default: Optional[dict] = None) -> dict:
+        _, record = await self._load(chat, user)
+        return copy.deepcopy(record.data)
+    
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, record = await self._load(chat, user)
+        record.state = self.resolve_state(state)
+        self._save(key, record)
+    
+    async def set_data(self, *, chat=None, user=None, data: dict = None):
+        key, record = await self._load(chat, user)
+        record.data = copy.deepcopy(data) if data else {}
+        self._save(key, record)
+    
+    async def update_data(self, *, chat=None, user=None, data: dict = None, **kwargs):
+        key, record = await self._load(chat, user)
+        record.data.update(data or {}, **kwargs)
+        self._save(key, record)
+    
+    def has_bucket(self):
+        return True
+    
+    async def get_bucket(self, *, chat=None, user=None, default: Optional[dict] = None) -> dict:
+        _, record = await self._load(chat, user)
+        return copy.deepcopy(record.bucket)
+    
+    async def set_bucket(self, *, chat=None, user=None, bucket: dict = None):
+        key, record = await self._load(chat, user)
+        record.bucket = copy.deepcopy(bucket) if bucket else {}
+        self._save(key, record)
+    
+    async def update_bucket(self, *, chat=None, user=None, bucket: dict = None, **kwargs):
+        key, record = await self._load(chat, user)
+        record.bucket.update(bucket or {}, **kwargs)
+        self._save(key, record)
+    
+    async def close(self):
+        """ذخیره وضعیت‌های باقیمانده هنگام خاموش شدن"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.adb is not None:
+            await self.flush()
+        if self._pending:
+            logger.error(f"⚠️ {len(self._pending)} FSM states could not be saved")
+    
+    async def wait_closed(self):
+        pass
+
+# ============================================================================
+# حریف‌یابی
+# ============================================================================
+
+class MatchmakingIndex:
+    """ایندکس بازیکنان قابل حمله (غیر مسدود، غیر ادمین) دسته‌بندی‌شده بر اساس بازه تروفی"""
+    
+    def __init__(self, band_width: int = MATCHMAKING_BAND_WIDTH):
+        self.band_width = band_width
+        self._bands: Dict[int, List[int]] = {}
+        self._band_keys: List[int] = []  # بازه‌های غیر خالی، مرتب‌شده
+        self._positions: Dict[int, Tuple[int, int]] = {}  # user_id -> (بازه، جایگاه در لیست)
+        self._lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return len(self._positions)
+    
+    def load(self, db: Database):
+        """ساخت ایندکس از روی جدول users"""
+        rows = db.execute_query(
+            '''SELECT user_id, trophies FROM users
+            WHERE banned = 0 AND user_id != ? AND role != ?''',
+            (ADMIN_ID, UserRole.ADMIN.value)
+        )
+        with self._lock:
+            self._bands.clear()
+            self._band_keys.clear()
+            self._positions.clear()
+            for row in rows:
+                self._add(row['user_id'], row['trophies'])
+        
+        logger.info(f"🎯 Matchmaking index loaded: {len(rows)} players")
+    
+    def _band(self, trophies: int) -> int:
+        return max(0, trophies) // self.band_width
+    
+    def _add(self, user_id: int, trophies: int):
+        band = self._band(trophies)
+        members = self._bands.get(band)
+        if members is None:
+            members = self._bands[band] = []
+            bisect.insort(self._band_keys, band)
+        self._positions[user_id] = (band, len(members))
+        members.append(user_id)
+    
+    def _remove(self, user_id: int):
+        band, index = self._positions.pop(user_id)
+        members = self._bands[band]
+        
+        # جابه‌جایی با آخرین عضو برای حذف O(1)
+        last = members.pop()
+        if last != user_id:
+            members[index] = last
+            self._positions[last] = (band, index)
+        
+        if not members:
+            del self._bands[band]
+            del self._band_keys[bisect.bisect_left(self._band_keys, band)]
+    
+    def add(self, user_id: int, trophies: int):
+        """افزودن یا جابه‌جایی بازیکن"""
+        with self._lock:
+            if user_id in self._positions:
+                if self._positions[user_id][0] == self._band(trophies):
+                    return
+                self._remove(user_id)
+            self._add(user_id, trophies)
+    
+    def update(self, user_id: int, trophies: int):
+        """به‌روزرسانی تروفی بازیکنی که در ایندکس است"""
+        with self._lock:
+            if user_id not in self._positions:
+                return
+            if self._positions[user_id][0] == self._band(trophies):
+                return
+            self._remove(user_id)
+            self._add(user_id, trophies)
+    
+    def remove(self, user_id: int):
+        """حذف بازیکن (مثلا بعد از مسدود شدن)"""
+        with self._lock:
+            if user_id in self._positions:
+                self._remove(user_id)
+    
+    def _pick(self, band: int, exclude: int) -> Optional[int]:
+        """انتخاب تصادفی یک عضو بازه به جز خود مهاجم"""
+        members = self._bands.get(band)
+        if not members:
+            return None
+        
+        index = random.randrange(len(members))
+        if members[index] == exclude:
+            if len(members) == 1:
+                return None
+            index = (index + 1) % len(members)
+        return members[index]
+    
+    def find_opponent(self, user_id: int, trophies: int) -> Optional[int]:
+        """انتخاب حریف تصادفی نزدیک به تروفی مهاجم؛ در صورت خالی بودن، بازه گسترش می‌یابد"""
+        with self._lock:
+            band = self._band(trophies)
+            opponent = self._pick(band, user_id)
+            if opponent is not None:
+                return opponent
+            
+            # گسترش تدریجی: نزدیک‌ترین بازه‌های غیر خالی در دو طرف با جست‌وجوی دودویی
+            keys = self._band_keys
+            right = bisect.bisect_right(keys, band)
+            left = bisect.bisect_left(keys, band) - 1
+            
+            while left >= 0 or right < len(keys):
+                left_distance = band - keys[left] if left >= 0 else None
+                right_distance = keys[right] - band if right < len(keys) else None
+                
+                if right_distance is None or (
+                    left_distance is not None
+                    and (left_distance < right_distance
+                         or (left_distance == right_distance and random.random() < 0.5))
+                ):
+                    opponent = self._pick(keys[left], user_id)
+                    left -= 1
+                else:
+                    opponent = self._pick(keys[right], user_id)
+                    right += 1
+                
+                if opponent is not None:
+                    return opponent
+            
+            return None
+
+# ============================================================================
+# رتبه‌بندی
+# ============================================================================
+
+class RankedList:
+    """لیست مرتب تکه‌تکه (bucketed) با درخت فنویک روی اندازه تکه‌ها برای محاسبه جایگاه در O(log n)"""
+    
+    def __init__(self, bucket_size: int = LEADERBOARD_BUCKET_SIZE):
+        self.bucket_size = bucket_size
+        self._buckets: List[list] = []
+        self._maxes: list = []  # بزرگ‌ترین کلید هر تکه
+        self._tree: List[int] = []  # درخت فنویک روی طول تکه‌ها
+        self._len = 0
+    
+    def __len__(self) -> int:
+        return self._len
+    
+    def __iter__(self):
+        for bucket in self._buckets:
+            yield from bucket
+    
+    @classmethod
+    def from_sorted(cls, keys: list, bucket_size: int = LEADERBOARD_BUCKET_SIZE) -> 'RankedList':
+        """ساخت مستقیم از کلیدهای مرتب در O(n)"""
+        ranked = cls(bucket_size)
+        ranked._buckets = [keys[i:i + bucket_size] for i in range(0, len(keys), bucket_size)]
+        ranked._maxes = [bucket[-1] for bucket in ranked._buckets]
+        ranked._len = len(keys)
+        ranked._rebuild_tree()
+        return ranked
+    
+    def _rebuild_tree(self):
+        tree = [len(bucket) for bucket in self._buckets]
+        for i in range(len(tree)):
+            parent = i | (i + 1)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+    
+    def _tree_add(self, index: int, delta: int):
+        while index < len(self._tree):
+            self._tree[index] += delta
+            index |= index + 1
+    
+    def _prefix(self, index: int) -> int:
+        """تعداد کلیدهای تکه‌های قبل از index"""
+        total = 0
+        index -= 1
+        while index >= 0:
+            total += self._tree[index]
+            index = (index & (index + 1)) - 1
+        return total
+    
+    def add(self, key):
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            self._tree = [1]
+            self._len = 1
+            return
+        
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+        bucket = self._buckets[i]
+        bisect.insort(bucket, key)
+        self._maxes[i] = bucket[-1]
+        self._len += 1
+        
+        if len(bucket) > 2 * self.bucket_size:
+            # شکستن تکه بزرگ و بازسازی درخت (به ندرت رخ می‌دهد)
+            self._buckets[i:i + 1] = [bucket[:self.bucket_size], bucket[self.bucket_size:]]
+            self._maxes[i:i + 1] = [self._buckets[i][-1], self._buckets[i + 1][-1]]
+            self._rebuild_tree()
+        else:
+            self._tree_add(i, 1)
+    
+    def remove(self, key):
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            raise ValueError(f"{key!r} not in list")
+        bucket = self._buckets[i]
+        j = bisect.bisect_left(bucket, key)
+        if j == len(bucket) or bucket[j] != key:
+            raise ValueError(f"{key!r} not in list")
+        
+        del bucket[j]
+        self._len -= 1
+        if bucket:
+            self._maxes[i] = bucket[-1]
+            self._tree_add(i, -1)
+        else:
+            del self._buckets[i]
+            del self._maxes[i]
+            self._rebuild_tree()
+    
+    def index(self, key) -> int:
+        """جایگاه صفرمبنای کلید (یا جایی که باید درج شود)"""
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return self._len
+        return self._prefix(i) + bisect.bisect_left(self._buckets[i], key)
+    
+    def head(self, count: int) -> list:
+        """count کلید اول"""
+        result = []
+        for bucket in self._buckets:
+            if len(result) >= count:
+                break
+            result.extend(bucket[:count - len(result)])
+        return result
+
+
+class Leaderboard:
+    """رتبه‌بندی درون‌حافظه‌ای بازیکنان (trophies DESC, level DESC) که با هر تغییر تروفی به‌روز می‌شود"""
+    
+    def __init__(self, bucket_size: int = LEADERBOARD_BUCKET_SIZE):
+        self.bucket_size = bucket_size
+        self._ranked = RankedList(bucket_size)
+        self._entries: Dict[int, Tuple[int, int, str]] = {}  # user_id -> (trophies, level, game_name)
+        self._top_clans: List[Clan] = []
+        self._clans_stale = False
+        self._lock = threading.Lock()
+        # نسخه هر تغییر از آخرین همگام‌سازی؛ تغییرهای بعد از شروع snapshot از SQL تازه‌ترند
+        self._version = 0
+        self._changed: Dict[int, int] = {}
+        self.last_drift = 0
+        self.last_reconcile: Optional[float] = None
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    @staticmethod
+    def _key(user_id: int, trophies: int, level: int) -> Tuple[int, int, int]:
+        return (-trophies, -level, user_id)
+    
+    def _snapshot(self, db: Database) -> Tuple[Dict[int, Tuple[int, int, str]], List[Clan]]:
+        rows = db.execute_query(
+            '''SELECT user_id, trophies, level, game_name FROM users
+            WHERE banned = 0 AND user_id != ?''',
+            (ADMIN_ID,)
+        )
+        entries = {
+            row['user_id']: (row['trophies'], row['level'], row['game_name'])
+            for row in rows
+        }
+        return entries, db.get_top_clans(10)
+    
+    def _install(self, entries: Dict[int, Tuple[int, int, str]], top_clans: List[Clan]):
+        keys = sorted(self._key(user_id, e[0], e[1]) for user_id, e in entries.items())
+        self._ranked = RankedList.from_sorted(keys, self.bucket_size)
+        self._entries = entries
+        self._top_clans = top_clans
+        self.last_reconcile = time.time()
+    
+    def load(self, db: Database):
+        """ساخت رتبه‌بندی از روی جداول users و clans"""
+        entries, top_clans = self._snapshot(db)
+        with self._lock:
+            self._install(entries, top_clans)
+        logger.info(f"🏆 Leaderboard loaded: {len(entries)} players")
+    
+    def _touch(self, user_id: int):
+        """ثبت تغییر یک بازیکن (زیر قفل)"""
+        self._version += 1
+        self._changed[user_id] = self._version
+    
+    def reconcile(self, db: Database) -> int:
+        """مقایسه با SQL و بازسازی در صورت اختلاف؛ تعداد بازیکنان ناهمخوان را برمی‌گرداند"""
+        with self._lock:
+            started = self._version
+            self._clans_stale = False
+        entries, top_clans = self._snapshot(db)
+        with self._lock:
+            # حمله‌ای که بین snapshot و قفل commit شده اختلاف نیست؛ مقدار حافظه نگه داشته می‌شود
+            for user_id, version in self._changed.items():
+                if version <= started:
+                    continue
+                entry = self._entries.get(user_id)
+                if entry is None:
+                    entries.pop(user_id, None)
+                else:
+                    entries[user_id] = entry
+            self._changed.clear()
+            
+            drift = sum(1 for user_id, e in entries.items() if self._entries.get(user_id) != e)
+            drift += sum(1 for user_id in self._entries if user_id not in entries)
+            if drift:
+                self._install(entries, top_clans)
+            else:
+                self._top_clans = top_clans
+                self.last_reconcile = time.time()
+            self.last_drift = drift
+        
+        if drift:
+            logger.warning(f"🏆 Leaderboard drift corrected: {drift} players")
+        return drift
+    
+    def add(self, user_id: int, game_name: str, trophies: int, level: int):
+        """افزودن بازیکن جدید"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._ranked.remove(self._key(user_id, entry[0], entry[1]))
+            self._entries[user_id] = (trophies, level, game_name)
+            self._ranked.add(self._key(user_id, trophies, level))
+            self._touch(user_id)
+    
+    def update(self, user_id: int, trophies: Optional[int] = None, level: Optional[int] = None):
+        """به‌روزرسانی تروفی یا لول بازیکنی که در رتبه‌بندی است"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            old_trophies, old_level, game_name = entry
+            new_trophies = old_trophies if trophies is None else trophies
+            new_level = old_level if level is None else level
+            if (new_trophies, new_level) == (old_trophies, old_level):
+                return
+            
+            self._ranked.remove(self._key(user_id, old_trophies, old_level))
+            self._ranked.add(self._key(user_id, new_trophies, new_level))
+            self._entries[user_id] = (new_trophies, new_level, game_name)
+            self._touch(user_id)
+    
+    def remove(self, user_id: int):
+        """حذف بازیکن (مثلا بعد از مسدود شدن)"""
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self._ranked.remove(self._key(user_id, entry[0], entry[1]))
+                self._touch(user_id)
+    
+    def rank(self, user_id: int) -> Optional[int]:
+        """رتبه یک‌مبنای بازیکن در O(log n)"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            return self._ranked.index(self._key(user_id, entry[0], entry[1])) + 1
+    
+    def top_players(self, limit: int = 10) -> List[User]:
+        """برترین بازیکنان"""
+        with self._lock:
+            players = []
+            for _, _, user_id in self._ranked.head(limit):
+                trophies, level, game_name = self._entries[user_id]
+                players.append(User(
+                    user_id=user_id,
+                    username=None,
+                    game_name=game_name,
+                    level=level,
+                    trophies=trophies
+                ))
+            return players
+    
+    def top_clans(self, limit: int = 5) -> List[Clan]:
+        """برترین قبایل (از آخرین همگام‌سازی با SQL)"""
+        with self._lock:
+            return self._top_clans[:limit]
+    
+    @property
+    def clans_stale(self) -> bool:
+        """آیا بعد از آخرین خواندن قبایل، قبیله‌ای ساخته شده یا تروفی عضوی تغییر کرده است"""
+        return self._clans_stale
+    
+    def mark_clans_stale(self):
+        """برترین قبایل در نمایش بعدی رتبه‌بندی دوباره از SQL خوانده می‌شوند"""
+        self._clans_stale = True
+    
+    def refresh_clans(self, db: Database):
+        """خواندن دوباره برترین قبایل؛ تغییرهای حین خواندن دوباره علامت می‌خورند"""
+        self._clans_stale = False
+        top_clans = db.get_top_clans(10)
+        with self._lock:
+            self._top_clans = top_clans
+
+# ============================================================================
+# فیلتر کلمات ممنوعه
+# ============================================================================
+
+# جدول یکسان‌سازی نویسه‌ها: حروف عربی به فارسی، حذف نیم‌فاصله، کشیده و اعراب، حروف کوچک
+PERSIAN_NORMALIZATION_TABLE = {
+    ord('ي'): 'ی', ord('ى'): 'ی', ord('ئ'): 'ی',
+    ord('ك'): 'ک',
+    ord('ة'): 'ه', ord('ۀ'): 'ه',
+    ord('أ'): 'ا', ord('إ'): 'ا', ord('آ'): 'ا', ord('ٱ'): 'ا',
+    ord('ؤ'): 'و',
+    ord('‌'): None,  # نیم‌فاصله (ZWNJ)
+    ord('‍'): None,  # ZWJ
+    ord('ـ'): None,  # کشیده (ـ)
+    ord('ٰ'): None,  # الف مقصوره بالا
+    **{code: None for code in range(0x064B, 0x0660)},  # اعراب و تنوین
+    **{ord(c): c.lower() for c in string.ascii_uppercase},
+}
+
+
+def normalize_persian(text: str) -> str:
+    """یکسان‌سازی متن فارسی در یک گذر"""
+    return text.translate(PERSIAN_NORMALIZATION_TABLE)
+
+
+class WordMatcher:
+    """خودکاره Aho-Corasick برای یافتن همه کلمات در زمان خطی نسبت به طول متن"""
+    
+    def __init__(self, words: List[str]):
+        self.words = list(words)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]  # اندیس کلماتی که در این حالت تمام می‌شوند
+        
+        for index, word in enumerate(self.words):
+            pattern = normalize_persian(word)
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = next_state
+            self._output[state].append(index)
+        
+        self._build_failure_links()
+    
+    def _build_failure_links(self):
+        queue_ = list(self._goto[0].values())
+        head = 0
+        while head < len(queue_):
+            state = queue_[head]
+            head += 1
+            for char, next_state in self._goto[state].items():
+                queue_.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+    
+    def find(self, text: str) -> List[str]:
+        """کلمات یافت‌شده به ترتیب اولین رخداد (بدون تکرار)"""
+        goto, fail, output = self._goto, self._fail, self._output
+        found: Dict[int, None] = {}
+        state = 0
+        for char in normalize_persian(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                for index in output[state]:
+                    found.setdefault(index)
+        return [self.words[index] for index in found]
+
+
+class ForbiddenWordFilter:
+    """فیلتر کلمات ممنوعه؛ بارگذاری مجدد فایل لیست کلمات در حلقه پس‌زمینه انجام می‌شود"""
+    
+    def __init__(self, path: Optional[str] = FORBIDDEN_WORDS_FILE,
+                 reload_interval: float = FORBIDDEN_WORDS_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._mtime: Optional[float] = None
+        self._lock = threading.Lock()
+        self.matcher = WordMatcher(DEFAULT_FORBIDDEN_WORDS)
+        self.reload()
+    
+    @property
+    def words(self) -> List[str]:
+        return self.matcher.words
+    
+    def _read_words(self) -> List[str]:
+        with open(self.path, encoding='utf-8') as f:
+            return [
+                line.strip() for line in f
+                if line.strip() and not line.lstrip().startswith('#')
+            ]
+    
+    def reload(self, force: bool = False) -> bool:
+        """ساخت دوباره خودکاره در صورت تغییر فایل؛ خودکاره قبلی تا پایان ساخت استفاده می‌شود"""
+        if not self.path:
+            return False
+        
+        with self._lock:
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                return False
+            if not force and mtime == self._mtime:
+                return False
+            
+            try:
+                words = self._read_words()
+            except (OSError, UnicodeDecodeError) as e:
+                logger.error(f"Error reading forbidden words file: {e}")
+                return False
+            
+            # جایگزینی با یک انتساب؛ check همیشه یک خودکاره کامل را می‌بیند
+            self.matcher = WordMatcher(words)
+            self._mtime = mtime
+        
+        logger.info(f"🚫 Forbidden words loaded: {len(words)} words from {self.path}")
+        return True
+    
+    def check(self, text: str) -> Tuple[bool, List[str]]:
+        """بررسی وجود کلمات ممنوعه"""
+        found_words = self.matcher.find(text)
+        return len(found_words) > 0, found_words
+
 # ============================================================================
 # سیستم بازی
 # ============================================================================
@@ -715,16 +3073,12 @@ class GameEngine:
     
     def __init__(self, db: Database):
         self.db = db
-        self.forbidden_words = [
-            'فحش1', 'فحش2', 'فحش3', 'توهین1', 'توهین2',
-            'کلمه‌ناسزا1', 'کلمه‌ناسزا2'
-        ]
+        self.matchmaking = MatchmakingIndex()
+        self.leaderboard = Leaderboard()
+        self.word_filter = ForbiddenWordFilter()
         
         # تنظیمات تولید منابع
-        self.resource_production = {
-            BuildingType.GOLD_MINE: {1: 10, 2: 25, 3: 50, 4: 100, 5: 200, 6: 400, 7: 800, 8: 1500, 9: 3000, 10: 6000},
-            BuildingType.ELIXIR_COLLECTOR: {1: 8, 2: 20, 3: 40, 4: 80, 5: 160, 6: 320, 7: 640, 8: 1200, 9: 2400, 10: 4800}
-        }
+        self.resource_production = RESOURCE_PRODUCTION
         
         # هزینه‌های ارتقا
         self.upgrade_costs = {
@@ -740,34 +3094,20 @@ class GameEngine:
         if not user:
             return {'gold': 0, 'elixir': 0}
         
-        # دریافت ساختمان‌های کاربر
-        buildings = self.db.execute_query(
-            'SELECT building_type, level FROM buildings WHERE user_id = ?',
-            (user_id,)
-        )
-        
+        return self.production_for(user)
+    
+    def production_for(self, user: User, now: Optional[float] = None) -> Dict[str, int]:
+        """محاسبه O(1) تولید از روی ردیف کاربر (نرخ‌ها در users نگهداری می‌شوند)"""
         # محاسبه زمان گذشته
-        last_collection = datetime.datetime.fromisoformat(user.last_collection_time)
-        now = datetime.datetime.now()
-        hours_passed = (now - last_collection).total_seconds() / 3600
+        now = now or time.time()
+        hours_passed = (now - user.last_collection_epoch) / 3600
         
         # محاسبه تولید
-        gold_production = 0
-        elixir_production = 0
-        
-        for building in buildings:
-            b_type = BuildingType(building['building_type'])
-            level = building['level']
-            
-            if b_type == BuildingType.GOLD_MINE:
-                production_rate = self.resource_production.get(b_type, {}).get(level, 0)
-                gold_production += int(production_rate * hours_passed)
-            elif b_type == BuildingType.ELIXIR_COLLECTOR:
-                production_rate = self.resource_production.get(b_type, {}).get(level, 0)
-                elixir_production += int(production_rate * hours_passed)
+        gold_production = int(user.gold_rate * hours_passed)
+        elixir_production = int(user.elixir_rate * hours_passed)
         
         # محدودیت ظرفیت ذخیره‌سازی
-        max_storage = 50000 * user.level  # ظرفیت بر اساس لول
+        max_storage = user.storage_cap
         
         current_gold = user.gold + gold_production
         current_elixir = user.elixir + elixir_production
@@ -782,257 +3122,1062 @@ class GameEngine:
             'elixir': max(0, elixir_production)
         }
     
-    def collect_resources(self, user_id: int) -> Dict[str, int]:
-        """جمع‌آوری منابع تولید شده"""
-        production = self.calculate_production(user_id)
-        
-        if production['gold'] > 0 or production['elixir'] > 0:
-            user = self.db.get_user(user_id)
-            new_gold = user.gold + production['gold']
-            new_elixir = user.elixir + production['elixir']
-            
-            self.db.update_user(
-                user_id,
-                gold=new_gold,
-                elixir=new_elixir,
-                last_collection_time=datetime.datetime.now().isoformat()
-            )
-            
-            logger.debug(f"💰 Resources collected for user {user_id}: {production}")
-        
-        return production
+    def collect_resources(self, user_id: int) -> Dict[str, int]:
+        """جمع‌آوری منابع تولید شده"""
+        production = self.calculate_production(user_id)
+        
+        if production['gold'] > 0 or production['elixir'] > 0:
+            # محاسبه دوباره روی داده تازه داخل تراکنش و افزودن نسبی
+            with self.db.transaction() as uow:
+                user = uow.get_user(user_id)
+                production = self.production_for(user)
+                uow.increment_user(
+                    user_id,
+                    gold=production['gold'],
+                    elixir=production['elixir']
+                )
+                uow.update_user(user_id, last_collection_epoch=now_epoch())
+            
+            logger.debug(f"💰 Resources collected for user {user_id}: {production}")
+        
+        return production
+    
+    def check_forbidden_words(self, text: str) -> Tuple[bool, List[str]]:
+        """بررسی وجود کلمات ممنوعه"""
+        return self.word_filter.check(text)
+    
+    def simulate_attack(self, attacker_id: int, defender_id: int) -> Dict[str, Any]:
+        """شبیه‌سازی حمله"""
+        # کل حمله در یک تراکنش انجام می‌شود تا حمله‌های همزمان تغییرات هم را گم نکنند
+        with self.db.transaction() as uow:
+            attacker = uow.get_user(attacker_id)
+            defender = uow.get_user(defender_id)
+            
+            if not attacker or not defender:
+                return {'error': 'کاربر یافت نشد'}
+            
+            # محاسبه قدرت حمله و دفاع
+            attack_power = attacker.level * 10 + attacker.trophies // 100
+            defense_power = defender.level * 10 + defender.trophies // 100
+            
+            # اگر مدافع ادمین باشد (کشور ابرقدرت)
+            if defender_id == ADMIN_ID:
+                defense_power *= 10  # قدرت دفاع 10 برابر
+            
+            # شانس برنده
+            total_power = attack_power + defense_power
+            attacker_win_chance = attack_power / total_power
+            
+            # تولید نتیجه تصادفی
+            result = random.random()
+            
+            if result < attacker_win_chance:
+                # حمله کننده برنده شد
+                # محاسبه تروفی تغییر یافته
+                trophy_diff = defender.trophies - attacker.trophies
+                if trophy_diff > 0:
+                    trophies_change = min(40, 10 + trophy_diff // 100)
+                else:
+                    trophies_change = max(5, 10 + trophy_diff // 100)
+                
+                # محاسبه منابع دزدیده شده
+                max_steal_gold = min(defender.gold * 0.2, 100000)
+                max_steal_elixir = min(defender.elixir * 0.2, 100000)
+                
+                stolen_gold = random.randint(int(max_steal_gold * 0.5), int(max_steal_gold))
+                stolen_elixir = random.randint(int(max_steal_elixir * 0.5), int(max_steal_elixir))
+                
+                # آپدیت نسبی منابع
+                uow.increment_user(
+                    attacker_id,
+                    gold=stolen_gold,
+                    elixir=stolen_elixir,
+                    trophies=trophies_change
+                )
+                uow.update_user(attacker_id, last_attack_epoch=now_epoch())
+                
+                uow.increment_user(
+                    defender_id,
+                    gold=-stolen_gold,
+                    elixir=-stolen_elixir,
+                    trophies=-trophies_change
+                )
+                
+                # ذخیره لاگ حمله
+                uow.execute(
+                    '''INSERT INTO attack_logs 
+                    (attacker_id, defender_id, result, trophies_change, resources_stolen, timestamp_epoch)
+                    VALUES (?, ?, ?, ?, ?, ?)''',
+                    (attacker_id, defender_id, 'win', trophies_change,
+                     json.dumps({'gold': stolen_gold, 'elixir': stolen_elixir}), now_epoch())
+                )
+                
+                logger.info(f"⚔️ Attack successful: {attacker_id} -> {defender_id} (Win)")
+                
+                new_trophies = {
+                    attacker_id: attacker.trophies + trophies_change,
+                    defender_id: max(0, defender.trophies - trophies_change),
+                }
+                outcome = {
+                    'result': 'win',
+                    'trophies_change': trophies_change,
+                    'resources_stolen': {
+                        'gold': stolen_gold,
+                        'elixir': stolen_elixir
+                    },
+                    'attack_power': attack_power,
+                    'defense_power': defense_power
+                }
+            else:
+                # مدافع برنده شد
+                trophies_change = random.randint(5, 15)
+                
+                uow.increment_user(attacker_id, trophies=-trophies_change)
+                uow.update_user(attacker_id, last_attack_epoch=now_epoch())
+                
+                uow.increment_user(defender_id, trophies=trophies_change)
+                
+                # ذخیره لاگ حمله
+                uow.execute(
+                    '''INSERT INTO attack_logs 
+                    (attacker_id, defender_id, result, trophies_change, resources_stolen, timestamp_epoch)
+                    VALUES (?, ?, ?, ?, ?, ?)''',
+                    (attacker_id, defender_id, 'lose', -trophies_change, json.dumps({}), now_epoch())
+                )
+                
+                logger.info(f"⚔️ Attack failed: {attacker_id} -> {defender_id} (Lose)")
+                
+                new_trophies = {
+                    attacker_id: max(0, attacker.trophies - trophies_change),
+                    defender_id: defender.trophies + trophies_change,
+                }
+                outcome = {
+                    'result': 'lose',
+                    'trophies_change': -trophies_change,
+                    'resources_stolen': {},
+                    'attack_power': attack_power,
+                    'defense_power': defense_power
+                }
+        
+        # به‌روزرسانی ساختارهای درون‌حافظه‌ای بعد از commit
+        self._on_trophies_changed(new_trophies, bool(attacker.clan_id or defender.clan_id))
+        return outcome
+    
+    def _on_trophies_changed(self, trophies: Dict[int, int], clan_members: bool = False):
+        """اعمال تغییر تروفی در ایندکس حریف‌یابی و رتبه‌بندی"""
+        for user_id, value in trophies.items():
+            self.matchmaking.update(user_id, value)
+            self.leaderboard.update(user_id, trophies=value)
+        if clan_members:
+            self.leaderboard.mark_clans_stale()
+    
+    def get_daily_reward(self, user_id: int) -> Optional[Dict[str, int]]:
+        """دریافت پاداش روزانه"""
+        today = datetime.datetime.now().date().isoformat()
+        
+        with self.db.transaction() as uow:
+            user = uow.get_user(user_id)
+            if not user:
+                return None
+            
+            if user.last_daily_reward == today:
+                return None
+            
+            # محاسبه پاداش بر اساس لول
+            reward_gold = 1000 * user.level
+            reward_elixir = 800 * user.level
+            reward_gem = 5 + user.level // 5
+            
+            uow.increment_user(
+                user_id,
+                gold=reward_gold,
+                elixir=reward_elixir,
+                gem=reward_gem
+            )
+            uow.update_user(user_id, last_daily_reward=today)
+        
+        logger.info(f"🎁 Daily reward claimed by user {user_id}")
+        
+        return {
+            'gold': reward_gold,
+            'elixir': reward_elixir,
+            'gem': reward_gem
+        }
+    
+    def upgrade_building(self, user_id: int, building_type: BuildingType) -> Dict[str, Any]:
+        """ارتقای ساختمان"""
+        with self.db.transaction() as uow:
+            user = uow.get_user(user_id)
+            if not user:
+                return {'success': False, 'message': 'کاربر یافت نشد'}
+            
+            # دریافت ساختمان
+            building = uow.query(
+                'SELECT * FROM buildings WHERE user_id = ? AND building_type = ?',
+                (user_id, building_type.value)
+            )
+            
+            if not building:
+                return {'success': False, 'message': 'ساختمان یافت نشد'}
+            
+            building = building[0]
+            current_level = building['level']
+            
+            # بررسی ماکس لول
+            if current_level >= 10:
+                return {'success': False, 'message': 'ساختمان در ماکس لول است'}
+            
+            # بررسی هزینه
+            cost = self.upgrade_costs.get(building_type, {}).get(current_level + 1)
+            if not cost:
+                return {'success': False, 'message': 'اطلاعات ارتقا یافت نشد'}
+            
+            # بررسی منابع
+            if user.gold < cost or user.elixir < cost:
+                return {'success': False, 'message': 'منابع کافی نیست'}
+            
+            # ارتقای ساختمان
+            uow.execute(
+                '''UPDATE buildings 
+                SET level = level + 1, last_upgrade_time = CURRENT_TIMESTAMP
+                WHERE building_id = ?''',
+                (building['building_id'],)
+            )
+            
+            # افزودن تجربه
+            experience_gain = cost // 100
+            new_experience = user.experience + experience_gain
+            
+            # بررسی ارتقای لول
+            level_up = False
+            required_exp = user.level * 1000
+            
+            if new_experience >= required_exp:
+                level_up = True
+            
+            # تغییر نرخ تولید کاربر (ستون‌های denormalized)
+            rate_changes = {}
+            rate_column = PRODUCTION_RATE_COLUMNS.get(building_type)
+            if rate_column:
+                rates = RESOURCE_PRODUCTION[building_type]
+                rate_changes[rate_column] = rates.get(current_level + 1, 0) - rates.get(current_level, 0)
+            
+            # کسر منابع و افزودن تجربه در یک دستور
+            uow.increment_user(
+                user_id,
+                gold=-cost,
+                elixir=-cost,
+                experience=experience_gain - required_exp if level_up else experience_gain,
+                level=1 if level_up else 0,
+                storage_cap=STORAGE_CAP_PER_LEVEL if level_up else 0,
+                **rate_changes
+            )
+        
+        if level_up:
+            self.leaderboard.update(user_id, level=user.level + 1)
+        
+        logger.info(f"🏗️ Building upgraded: {building_type.value} for user {user_id} to level {current_level + 1}")
+        
+        return {
+            'success': True,
+            'new_level': current_level + 1,
+            'cost': cost,
+            'experience_gain': experience_gain,
+            'level_up': level_up
+        }
+
+# ============================================================================
+# پردازش دسته‌ای اقتصاد
+# ============================================================================
+
+class EconomyBatchEngine:
+    """اجرای کارهای سراسری اقتصاد (تولید آفلاین، سقف انبار، پاداش فصل) به صورت برداری با NumPy"""
+    
+    def __init__(self, db: Database, chunk_size: int = ECONOMY_CHUNK_SIZE):
+        if np is None:
+            raise RuntimeError("numpy is required for EconomyBatchEngine")
+        
+        self.db = db
+        self.chunk_size = chunk_size
+    
+    def iter_chunks(self):
+        """خواندن کاربران به صورت دسته‌ای (صفحه‌بندی با user_id)"""
+        last_id = -1
+        while True:
+            # نرخ‌ها همان ستون‌های users هستند که production_for می‌خواند (جمع همه ساختمان‌های هر نوع)؛
+            # +u.banned جلوی انتخاب idx_users_leaderboard را می‌گیرد تا صفحه‌ها روی کلید اصلی پیمایش شوند
+            rows = self.db.execute_query(
+                '''SELECT u.user_id, u.level, u.gold, u.elixir, u.trophies, u.storage_cap,
+                       COALESCE(u.last_collection_epoch, u.last_collection_time),
+                       u.gold_rate, u.elixir_rate
+                FROM users u
+                WHERE u.user_id > ? AND +u.banned = 0
+                ORDER BY u.user_id
+                LIMIT ?''',
+                (last_id, self.chunk_size)
+            )
+            if not rows:
+                return
+            
+            last_id = rows[-1]['user_id']
+            columns = list(zip(*rows))
+            yield {
+                'user_id': np.array(columns[0], dtype=np.int64),
+                'level': np.array(columns[1], dtype=np.int64),
+                'gold': np.array(columns[2], dtype=np.int64),
+                'elixir': np.array(columns[3], dtype=np.int64),
+                'trophies': np.array(columns[4], dtype=np.int64),
+                'storage_cap': np.array(columns[5], dtype=np.int64),
+                'last_collection': np.array(
+                    [t if isinstance(t, int) else parse_legacy_time(t) for t in columns[6]],
+                    dtype=np.float64
+                ),
+                # مقدار خام خوانده‌شده برای شرط نوشتن (تشخیص جمع‌آوری همزمان)
+                'last_collection_raw': np.array(columns[6], dtype=object),
+                'gold_rate': np.array(columns[7], dtype=np.int64),
+                'elixir_rate': np.array(columns[8], dtype=np.int64),
+            }
+    
+    def compute_accrual(self, chunk: Dict[str, 'np.ndarray'], now: float):
+        """محاسبه برداری تولید آفلاین؛ معادل GameEngine.production_for برای هر ردیف"""
+        hours_passed = (now - chunk['last_collection']) / 3600
+        
+        gold = (chunk['gold_rate'] * hours_passed).astype(np.int64)
+        elixir = (chunk['elixir_rate'] * hours_passed).astype(np.int64)
+        
+        # محدودیت ظرفیت ذخیره‌سازی
+        cap = chunk['storage_cap']
+        gold = np.where(chunk['gold'] + gold > cap, cap - chunk['gold'], gold)
+        elixir = np.where(chunk['elixir'] + elixir > cap, cap - chunk['elixir'], elixir)
+        
+        return np.maximum(gold, 0), np.maximum(elixir, 0)
+    
+    def _write_chunk(self, query: str, rows: list) -> int:
+        """نوشتن نتیجه یک دسته با یک executemany در یک تراکنش؛ تعداد ردیف‌های تغییرکرده"""
+        if not rows:
+            return 0
+        with self.db.transaction() as uow:
+            return uow.executemany(query, rows)
+    
+    def run_offline_accrual(self, now: Optional[float] = None) -> Dict[str, int]:
+        """جمع‌آوری منابع تولیدشده همه کاربران"""
+        now = now or time.time()
+        collected_at = int(now)
+        stats = {'users': 0, 'gold': 0, 'elixir': 0, 'skipped': 0}
+        
+        for chunk in self.iter_chunks():
+            gold, elixir = self.compute_accrual(chunk, now)
+            changed = (gold > 0) | (elixir > 0)
+            
+            rows = list(zip(
+                gold[changed].tolist(),
+                elixir[changed].tolist(),
+                [collected_at] * int(changed.sum()),
+                chunk['user_id'][changed].tolist(),
+                chunk['last_collection_raw'][changed].tolist()
+            ))
+            # خواندن بیرون از تراکنش نوشتن است؛ اگر کاربر در این فاصله جمع‌آوری کرده باشد
+            # زمان جمع‌آوری عوض شده و همان بازه نباید دوباره پرداخت شود
+            written = self._write_chunk(
+                '''UPDATE users SET gold = gold + ?, elixir = elixir + ?, last_collection_epoch = ?
+                WHERE user_id = ? AND COALESCE(last_collection_epoch, last_collection_time) IS ?''',
+                rows
+            )
+            
+            stats['users'] += written
+            stats['skipped'] += len(rows) - written
+            stats['gold'] += int(gold.sum())
+            stats['elixir'] += int(elixir.sum())
+        
+        self.db.user_cache.clear()
+        logger.info(f"💰 Offline accrual done: {stats}")
+        return stats
+    
+    def run_storage_cap_enforcement(self) -> int:
+        """کم کردن منابع بیش از ظرفیت انبار (به جز کشور ابرقدرت)"""
+        updated = 0
+        for chunk in self.iter_chunks():
+            cap = chunk['storage_cap']
+            over = ((chunk['gold'] > cap) | (chunk['elixir'] > cap)) & (chunk['user_id'] != ADMIN_ID)
+            
+            rows = list(zip(
+                np.minimum(chunk['gold'], cap)[over].tolist(),
+                np.minimum(chunk['elixir'], cap)[over].tolist(),
+                chunk['user_id'][over].tolist()
+            ))
+            self._write_chunk(
+                '''UPDATE users SET gold = MIN(gold, ?), elixir = MIN(elixir, ?)
+                WHERE user_id = ?''',
+                rows
+            )
+            updated += len(rows)
+        
+        self.db.user_cache.clear()
+        logger.info(f"📦 Storage caps enforced for {updated} users")
+        return updated
+    
+    def run_season_payout(self) -> int:
+        """پرداخت پاداش فصل بر اساس لیگ (بازه تروفی) هر کاربر"""
+        leagues = self.db.execute_query(
+            'SELECT min_trophies, max_trophies, reward_gold, reward_elixir FROM leagues'
+        )
+        if not leagues:
+            return 0
+        
+        paid = 0
+        for chunk in self.iter_chunks():
+            reward_gold = np.zeros(len(chunk['user_id']), dtype=np.int64)
+            reward_elixir = np.zeros(len(chunk['user_id']), dtype=np.int64)
+            for league in leagues:
+                in_league = (
+                    (chunk['trophies'] >= league['min_trophies'])
+                    & (chunk['trophies'] <= league['max_trophies'])
+                )
+                reward_gold[in_league] = league['reward_gold']
+                reward_elixir[in_league] = league['reward_elixir']
+            
+            rewarded = ((reward_gold > 0) | (reward_elixir > 0)) & (chunk['user_id'] != ADMIN_ID)
+            rows = list(zip(
+                reward_gold[rewarded].tolist(),
+                reward_elixir[rewarded].tolist(),
+                chunk['user_id'][rewarded].tolist()
+            ))
+            self._write_chunk(
+                'UPDATE users SET gold = gold + ?, elixir = elixir + ? WHERE user_id = ?',
+                rows
+            )
+            paid += len(rows)
+        
+        self.db.user_cache.clear()
+        logger.info(f"🏆 Season rewards paid to {paid} users")
+        return paid
+
+# ============================================================================
+# زمان‌بندی آپدیت‌ها
+# ============================================================================
+
+def update_user_id(update: types.Update) -> Optional[int]:
+    """شناسه کاربری که آپدیت را فرستاده است"""
+    for event in (update.message, update.callback_query, update.edited_message, update.inline_query):
+        if event is not None and event.from_user is not None:
+            return event.from_user.id
+    return None
+
+
+def update_type(update: types.Update) -> str:
+    """نوع آپدیت برای برچسب متریک‌ها"""
+    for kind in ('message', 'callback_query', 'edited_message', 'inline_query'):
+        if getattr(update, kind) is not None:
+            return kind
+    return 'other'
+
+
+def is_low_value_update(update: types.Update) -> bool:
+    """آیا آپدیت callback کم‌اهمیتی است که زیر بار می‌توان حذفش کرد"""
+    return update.callback_query is not None and update.callback_query.data in LOW_VALUE_CALLBACKS
+
+
+UPDATES_RECEIVED = METRICS.counter(
+    'amele_updates_received_total', 'Valid webhook updates received by type', ('type',)
+)
+UPDATES_DROPPED = METRICS.counter(
+    'amele_updates_dropped_total', 'Webhook updates dropped before processing by reason', ('reason',)
+)
+UPDATE_SECONDS = METRICS.histogram(
+    'amele_update_duration_seconds', 'Update handling duration (excluding queue wait) by type',
+    ('type',), errors_name='amele_update_errors_total'
+)
+
+
+class UpdateDeduplicator:
+    """پنجره update_idهای اخیر (بافر حلقوی + set) برای نادیده گرفتن آپدیت‌هایی که تلگرام دوباره می‌فرستد"""
+    
+    def __init__(self, window: int = UPDATE_DEDUP_WINDOW):
+        if window < 1:
+            raise ValueError("Dedup window must be at least 1")
+        self.window = window
+        self._ring: List[Optional[int]] = [None] * window
+        self._index = 0
+        self._seen = set()
+        self.duplicates = 0
+    
+    def is_duplicate(self, update_id: int) -> bool:
+        """آیا update_id در پنجره دیده شده است (ثبت جدا با remember انجام می‌شود)"""
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+        return False
+    
+    def remember(self, update_id: int):
+        """ثبت update_id پذیرفته‌شده؛ آپدیتی که رد شده ثبت نمی‌شود تا ارسال دوباره تلگرام پردازش شود"""
+        if update_id in self._seen:
+            return
+        # قدیمی‌ترین شناسه از پنجره خارج می‌شود
+        oldest = self._ring[self._index]
+        if oldest is not None:
+            self._seen.discard(oldest)
+        self._ring[self._index] = update_id
+        self._index = (self._index + 1) % self.window
+        self._seen.add(update_id)
+    
+    def stats(self) -> Dict[str, int]:
+        return {'window': self.window, 'tracked': len(self._seen), 'duplicates': self.duplicates}
+
+
+class UpdateScheduler:
+    """اجرای آپدیت‌های هر کاربر به ترتیب (یک صف و worker برای هر کاربر فعال) و کاربران مختلف به صورت همزمان"""
+    
+    def __init__(self, handler: Callable[[types.Update], Awaitable[Any]],
+                 idle_timeout: float = UPDATE_WORKER_IDLE_TIMEOUT,
+                 max_concurrency: int = UPDATE_MAX_CONCURRENCY,
+                 max_queued: int = UPDATE_MAX_QUEUED,
+                 shed_threshold: int = UPDATE_SHED_THRESHOLD):
+        self.handler = handler
+        self.idle_timeout = idle_timeout
+        self.max_queued = max_queued
+        self.shed_threshold = shed_threshold
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._queues: Dict[int, asyncio.Queue] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._tasks = set()  # آپدیت‌های بدون کاربر
+        self._pending = set()  # futureهای پردازش‌نشده
+        self.processed = 0
+        self.failed = 0
+        self.reaped = 0
+        self.shed = 0  # callbackهای کم‌اهمیت حذف‌شده زیر بار
+        self.rejected = 0  # آپدیت‌های حذف‌شده به دلیل پر بودن صف
+        self.max_depth_seen = 0
+    
+    def offer(self, update: types.Update) -> Optional[str]:
+        """پذیرش آپدیت با در نظر گرفتن بار؛ اگر حذف شود دلیل آن ('queue_full' یا 'shed') برمی‌گردد"""
+        queued = len(self._pending)
+        if queued >= self.max_queued:
+            self.rejected += 1
+            UPDATES_DROPPED.inc('queue_full')
+            return 'queue_full'
+        if queued >= self.shed_threshold and is_low_value_update(update):
+            self.shed += 1
+            UPDATES_DROPPED.inc('shed')
+            return 'shed'
+        
+        future = self.submit(update)
+        # خطا در _process لاگ می‌شود؛ future بدون انتظار رها می‌شود
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return None
+    
+    def submit(self, update: types.Update) -> asyncio.Future:
+        """قرار دادن آپدیت در صف کاربرش؛ future بعد از پردازش کامل می‌شود"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        user_id = update_user_id(update)
+        
+        if user_id is None:
+            task = asyncio.ensure_future(self._process(update, future))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return future
+        
+        queue_ = self._queues.get(user_id)
+        if queue_ is None:
+            queue_ = self._queues[user_id] = asyncio.Queue()
+            self._workers[user_id] = asyncio.ensure_future(self._worker(user_id, queue_))
+        queue_.put_nowait((update, future))
+        self.max_depth_seen = max(self.max_depth_seen, queue_.qsize())
+        return future
+    
+    async def run(self, update: types.Update):
+        """ارسال آپدیت و انتظار برای پایان پردازش آن"""
+        return await self.submit(update)
+    
+    async def _process(self, update: types.Update, future: asyncio.Future):
+        histogram = UPDATE_SECONDS.labels(update_type(update))
+        start = None
+        try:
+            async with self._slots:
+                start = time.perf_counter()
+                with UpdateContext.scope(update.update_id):
+                    result = await self.handler(update)
+                histogram.observe(time.perf_counter() - start)
+        except Exception as e:
+            if start is not None:
+                histogram.observe(time.perf_counter() - start, error=True)
+            self.failed += 1
+            logger.error(f"Error processing update {update.update_id}: {e}")
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self.processed += 1
+    
+    async def _worker(self, user_id: int, queue_: asyncio.Queue):
+        """پردازش ترتیبی صف یک کاربر؛ بعد از idle_timeout بدون آپدیت، worker جمع می‌شود"""
+        while True:
+            try:
+                update, future = await asyncio.wait_for(queue_.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                # بین بررسی خالی بودن و حذف، await نیست؛ پس آپدیت جدیدی گم نمی‌شود
+                if queue_.empty():
+                    del self._queues[user_id]
+                    del self._workers[user_id]
+                    self.reaped += 1
+                    return
+                continue
+            
+            await self._process(update, future)
+    
+    def stats(self) -> Dict[str, Any]:
+        """آمار صف‌ها"""
+        depths = [q.qsize() for q in self._queues.values()]
+        return {
+            'active_workers': len(self._workers),
+            'queued': sum(depths),
+            'max_depth': max(depths, default=0),
+            'max_depth_seen': self.max_depth_seen,
+            'in_progress': len(self._pending) - sum(depths),
+            'processed': self.processed,
+            'failed': self.failed,
+            'reaped': self.reaped,
+            'shed': self.shed,
+            'rejected': self.rejected,
+        }
+    
+    async def close(self):
+        """منتظر ماندن برای پردازش آپدیت‌های صف‌شده و توقف workerها"""
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        for worker in list(self._workers.values()):
+            worker.cancel()
+
+# ============================================================================
+# مسیریابی callbackها
+# ============================================================================
+
+CALLBACK_SECONDS = METRICS.histogram(
+    'amele_callback_duration_seconds', 'Callback query handler duration by route',
+    ('route',), errors_name='amele_callback_errors_total'
+)
+
+
+class CallbackRouter:
+    """مسیریابی callback_data با دیکشنری برای تطابق کامل و لیست پیشوندها؛ هر مسیر زمان‌سنجی می‌شود"""
+    
+    def __init__(self):
+        self._exact: Dict[str, Callable[[types.CallbackQuery], Awaitable[Any]]] = {}
+        self._prefixes: List[Tuple[str, Callable[[types.CallbackQuery], Awaitable[Any]]]] = []
+        self.metrics = CALLBACK_SECONDS
+    
+    def add(self, data: str, handler: Callable[[types.CallbackQuery], Awaitable[Any]]):
+        """مسیر با تطابق کامل"""
+        self._exact[data] = handler
+        self.metrics.labels(data)
+    
+    def add_prefix(self, prefix: str, handler: Callable[[types.CallbackQuery], Awaitable[Any]]):
+        """مسیر پیشوندی (مثلا upgrade_)؛ پیشوند طولانی‌تر اولویت دارد"""
+        self._prefixes.append((prefix, handler))
+        self._prefixes.sort(key=lambda route: len(route[0]), reverse=True)
+        self.metrics.labels(prefix + '*')
+    
+    def resolve(self, data: str) -> Tuple[Optional[str], Optional[Callable]]:
+        """نام مسیر و هندلر مربوط به callback_data"""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return data, handler
+        for prefix, handler in self._prefixes:
+            if data.startswith(prefix):
+                return prefix + '*', handler
+        return None, None
+    
+    async def dispatch(self, callback_query: types.CallbackQuery) -> bool:
+        """اجرای هندلر مسیر؛ اگر مسیری نباشد False برمی‌گرداند"""
+        name, handler = self.resolve(callback_query.data or '')
+        if handler is None:
+            return False
+        
+        histogram = self.metrics.labels(name)
+        start = time.perf_counter()
+        try:
+            await handler(callback_query)
+        except Exception:
+            histogram.observe(time.perf_counter() - start, error=True)
+            raise
+        histogram.observe(time.perf_counter() - start)
+        return True
+    
+    def stats(self) -> List[Dict[str, Any]]:
+        """آمار مسیرهایی که حداقل یک بار اجرا شده‌اند، به ترتیب p99"""
+        rows = [
+            {
+                'route': labels[0],
+                'count': h.count,
+                'errors': h.errors,
+                'mean': h.mean,
+                'p50': h.quantile(0.5),
+                'p99': h.quantile(0.99),
+            }
+            for labels, h in self.metrics.items() if h.count
+        ]
+        rows.sort(key=lambda row: row['p99'], reverse=True)
+        return rows
+
+# ============================================================================
+# ربات تلگرام
+# ============================================================================
+
+TELEGRAM_API_SECONDS = METRICS.histogram(
+    'amele_telegram_api_duration_seconds', 'Telegram Bot API call duration by method',
+    ('method',), errors_name='amele_telegram_api_errors_total'
+)
+EVENT_LOOP_LAG_SECONDS = METRICS.histogram(
+    'amele_event_loop_lag_seconds', 'Delay of event loop wake-ups beyond the scheduled time',
+    buckets=EVENT_LOOP_LAG_BUCKETS
+)
+
+OUTBOUND_WAIT_SECONDS = METRICS.histogram(
+    'amele_outbound_wait_seconds', 'Time outgoing messages wait in the send queue by lane', ('lane',)
+)
+OUTBOUND_EVENTS = METRICS.counter(
+    'amele_outbound_events_total', 'Send queue events (sent, failed, retried, coalesced) by lane',
+    ('lane', 'event')
+)
+
+
+class OutboundPriority(Enum):
+    """صف‌های اولویت ارسال؛ پاسخ‌های بازی قبل از اعلان‌ها"""
+    GAMEPLAY = 0
+    NOTIFICATION = 1
+
+
+_outbound_priority: contextvars.ContextVar = contextvars.ContextVar(
+    'outbound_priority', default=OutboundPriority.GAMEPLAY
+)
+
+
+@contextmanager
+def outbound_priority(priority: OutboundPriority):
+    """ارسال‌های داخل این بلوک (و taskهایی که در آن ساخته می‌شوند) با این اولویت صف می‌شوند"""
+    token = _outbound_priority.set(priority)
+    try:
+        yield
+    finally:
+        _outbound_priority.reset(token)
+
+
+class TokenBucket:
+    """سطل توکن با نرخ پر شدن ثابت؛ retry_after تلگرام سطل را تا زمان مشخص مسدود می‌کند"""
+    
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
     
-    def check_forbidden_words(self, text: str) -> Tuple[bool, List[str]]:
-        """بررسی وجود کلمات ممنوعه"""
-        found_words = []
-        for word in self.forbidden_words:
-            if word in text.lower():
-                found_words.append(word)
-        
-        return len(found_words) > 0, found_words
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
     
-    def simulate_attack(self, attacker_id: int, defender_id: int) -> Dict[str, Any]:
-        """شبیه‌سازی حمله"""
-        attacker = self.db.get_user(attacker_id)
-        defender = self.db.get_user(defender_id)
-        
-        if not attacker or not defender:
-            return {'error': 'کاربر یافت نشد'}
-        
-        # محاسبه قدرت حمله و دفاع
-        attack_power = attacker.level * 10 + attacker.trophies // 100
-        defense_power = defender.level * 10 + defender.trophies // 100
-        
-        # اگر مدافع ادمین باشد (کشور ابرقدرت)
-        if defender_id == ADMIN_ID:
-            defense_power *= 10  # قدرت دفاع 10 برابر
-        
-        # شانس برنده
-        total_power = attack_power + defense_power
-        attacker_win_chance = attack_power / total_power
-        
-        # تولید نتیجه تصادفی
-        import random
-        result = random.random()
-        
-        if result < attacker_win_chance:
-            # حمله کننده برنده شد
-            # محاسبه تروفی تغییر یافته
-            trophy_diff = defender.trophies - attacker.trophies
-            if trophy_diff > 0:
-                trophies_change = min(40, 10 + trophy_diff // 100)
-            else:
-                trophies_change = max(5, 10 + trophy_diff // 100)
-            
-            # محاسبه منابع دزدیده شده
-            max_steal_gold = min(defender.gold * 0.2, 100000)
-            max_steal_elixir = min(defender.elixir * 0.2, 100000)
-            
-            stolen_gold = random.randint(int(max_steal_gold * 0.5), int(max_steal_gold))
-            stolen_elixir = random.randint(int(max_steal_elixir * 0.5), int(max_steal_elixir))
-            
-            # آپدیت منابع
-            self.db.update_user(
-                attacker_id,
-                gold=attacker.gold + stolen_gold,
-                elixir=attacker.elixir + stolen_elixir,
-                trophies=attacker.trophies + trophies_change,
-                last_attack_time=datetime.datetime.now().isoformat()
-            )
-            
-            self.db.update_user(
-                defender_id,
-                gold=max(0, defender.gold - stolen_gold),
-                elixir=max(0, defender.elixir - stolen_elixir),
-                trophies=max(0, defender.trophies - trophies_change)
-            )
-            
-            # ذخیره لاگ حمله
-            self.db.execute_update(
-                '''INSERT INTO attack_logs 
-                (attacker_id, defender_id, result, trophies_change, resources_stolen)
-                VALUES (?, ?, ?, ?, ?)''',
-                (attacker_id, defender_id, 'win', trophies_change,
-                 json.dumps({'gold': stolen_gold, 'elixir': stolen_elixir}))
-            )
-            
-            logger.info(f"⚔️ Attack successful: {attacker_id} -> {defender_id} (Win)")
-            
-            return {
-                'result': 'win',
-                'trophies_change': trophies_change,
-                'resources_stolen': {
-                    'gold': stolen_gold,
-                    'elixir': stolen_elixir
-                },
-                'attack_power': attack_power,
-                'defense_power': defense_power
-            }
+    def delay(self, now: float) -> float:
+        """ثانیه‌های باقیمانده تا آزاد شدن یک توکن (0 یعنی همین حالا)"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+    
+    def block(self, until: float):
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0
+    
+    def idle(self, now: float) -> bool:
+        """سطل پر و بدون مسدودیت؛ نگه داشتنش فرقی با ساختن دوباره ندارد"""
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class OutboundJob:
+    """یک فراخوانی صف‌شده Bot API و callerهایی که منتظر نتیجه آن هستند"""
+    
+    __slots__ = ('method', 'data', 'files', 'kwargs', 'chat_id', 'priority', 'futures',
+                 'enqueued', 'attempts', 'edit_key')
+    
+    def __init__(self, method: str, data: Optional[dict], files, kwargs: dict, priority: OutboundPriority):
+        self.method = method
+        self.data = data
+        self.files = files
+        self.kwargs = kwargs
+        self.chat_id = (data or {}).get('chat_id')
+        self.priority = priority
+        self.futures: List[asyncio.Future] = []
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+        
+        # ویرایش متن یک پیام؛ ویرایش جدیدتر همان پیام جای ویرایش صف‌شده را می‌گیرد
+        self.edit_key = None
+        if method == 'editMessageText' and self.chat_id is not None and data.get('message_id') is not None:
+            self.edit_key = (self.chat_id, data['message_id'])
+
+
+class OutboundQueue:
+    """صف ارسال پیام‌ها با سطل توکن کلی و هر چت، صف‌های اولویت، احترام به retry_after و ادغام ویرایش‌ها
+    
+    ترتیب پیام‌های هر چت حفظ می‌شود (در هر لحظه حداکثر یک ارسال در جریان برای هر چت)
+    و چت‌های مسدود، ارسال به چت‌های دیگر را معطل نمی‌کنند.
+    """
+    
+    MAX_CHAT_BUCKETS = 10000
+    
+    def __init__(self, send: Callable[..., Awaitable[Any]],
+                 global_rate: float = OUTBOUND_GLOBAL_RATE,
+                 chat_rate: float = OUTBOUND_CHAT_RATE,
+                 chat_burst: int = OUTBOUND_CHAT_BURST,
+                 max_in_flight: int = OUTBOUND_MAX_IN_FLIGHT,
+                 max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.send = send
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        # ارسال کلی یکنواخت پخش می‌شود؛ انفجار ۳۰تایی پنجره یک‌ثانیه‌ای تلگرام را دوبرابر پر می‌کند
+        self._global = TokenBucket(global_rate, 1)
+        self._chat_buckets: Dict[Any, TokenBucket] = {}
+        self._lanes: List[collections.deque] = [collections.deque() for _ in OutboundPriority]
+        self._edits: Dict[Tuple[Any, Any], OutboundJob] = {}
+        self._sending = set()  # چت‌هایی که ارسالشان در جریان است
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._wakeup = asyncio.Event()
+        self._tasks = set()
+        self._runner: Optional[asyncio.Task] = None
+        
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+    
+    def start(self):
+        """شروع حلقه ارسال"""
+        self._runner = asyncio.ensure_future(self._run())
+    
+    async def submit(self, method: str, data: Optional[dict] = None, files=None, **kwargs):
+        """قرار دادن فراخوانی در صف با اولویت کانتکست فعلی و انتظار برای نتیجه آن"""
+        future = asyncio.get_running_loop().create_future()
+        job = OutboundJob(method, data, files, kwargs, _outbound_priority.get())
+        
+        queued_edit = self._edits.get(job.edit_key) if job.edit_key is not None else None
+        if queued_edit is not None:
+            # ویرایش قبلی هنوز ارسال نشده؛ فقط آخرین متن فرستاده می‌شود و هر دو caller نتیجه را می‌گیرند
+            queued_edit.data, queued_edit.files, queued_edit.kwargs = data, files, kwargs
+            queued_edit.futures.append(future)
+            self.coalesced += 1
+            OUTBOUND_EVENTS.inc(queued_edit.priority.name.lower(), 'coalesced')
+            return await future
+        
+        job.futures.append(future)
+        self._enqueue(job)
+        return await future
+    
+    def _enqueue(self, job: OutboundJob, front: bool = False):
+        lane = self._lanes[job.priority.value]
+        if front:
+            lane.appendleft(job)
         else:
-            # مدافع برنده شد
-            trophies_change = random.randint(5, 15)
-            
-            self.db.update_user(
-                attacker_id,
-                trophies=max(0, attacker.trophies - trophies_change),
-                last_attack_time=datetime.datetime.now().isoformat()
-            )
-            
-            self.db.update_user(
-                defender_id,
-                trophies=defender.trophies + trophies_change
-            )
-            
-            # ذخیره لاگ حمله
-            self.db.execute_update(
-                '''INSERT INTO attack_logs 
-                (attacker_id, defender_id, result, trophies_change, resources_stolen)
-                VALUES (?, ?, ?, ?, ?)''',
-                (attacker_id, defender_id, 'lose', -trophies_change, json.dumps({}))
-            )
-            
-            logger.info(f"⚔️ Attack failed: {attacker_id} -> {defender_id} (Lose)")
+            lane.append(job)
+        if job.edit_key is not None:
+            self._edits[job.edit_key] = job
+        self._wakeup.set()
+    
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self._prune_chat_buckets()
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+    
+    def _prune_chat_buckets(self):
+        """حذف سطل چت‌هایی که پر و بیکارند تا حافظه محدود بماند"""
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._chat_buckets.items() if c not in self._sending and b.idle(now)]:
+            del self._chat_buckets[chat_id]
+    
+    def _take_next(self) -> Tuple[Optional[OutboundJob], Optional[float]]:
+        """اولین کار قابل ارسال به ترتیب اولویت، یا (None, ثانیه‌های انتظار تا کار بعدی)"""
+        if not any(self._lanes):
+            return None, None
+        
+        now = time.monotonic()
+        delay = self._global.delay(now)
+        if delay:
+            return None, delay
+        
+        delay = None
+        skipped = set()
+        for lane in self._lanes:
+            for index, job in enumerate(lane):
+                chat_id = job.chat_id
+                if chat_id in skipped or chat_id in self._sending:
+                    continue
+                wait = self._chat_bucket(chat_id).delay(now) if chat_id is not None else 0.0
+                if wait:
+                    skipped.add(chat_id)
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+                
+                del lane[index]
+                if job.edit_key is not None:
+                    self._edits.pop(job.edit_key, None)
+                self._global.take(now)
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).take(now)
+                return job, None
+        
+        # اگر همه چت‌ها در حال ارسال باشند، پایان یک ارسال حلقه را بیدار می‌کند
+        return None, delay
+    
+    async def _run(self):
+        while True:
+            await self._slots.acquire()
+            job, delay = self._take_next()
+            if job is None:
+                self._slots.release()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
             
-            return {
-                'result': 'lose',
-                'trophies_change': -trophies_change,
-                'resources_stolen': {},
-                'attack_power': attack_power,
-                'defense_power': defense_power
-            }
+            if job.chat_id is not None:
+                self._sending.add(job.chat_id)
+            task = asyncio.ensure_future(self._send(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
     
-    def get_daily_reward(self, user_id: int) -> Optional[Dict[str, int]]:
-        """دریافت پاداش روزانه"""
-        user = self.db.get_user(user_id)
-        if not user:
-            return None
-        
-        today = datetime.datetime.now().date().isoformat()
-        
-        if user.last_daily_reward == today:
-            return None
-        
-        # محاسبه پاداش بر اساس لول
-        reward_gold = 1000 * user.level
-        reward_elixir = 800 * user.level
-        reward_gem = 5 + user.level // 5
-        
-        self.db.update_user(
-            user_id,
-            gold=user.gold + reward_gold,
-            elixir=user.elixir + reward_elixir,
-            gem=user.gem + reward_gem,
-            last_daily_reward=today
-        )
-        
-        logger.info(f"🎁 Daily reward claimed by user {user_id}")
-        
-        return {
-            'gold': reward_gold,
-            'elixir': reward_elixir,
-            'gem': reward_gem
-        }
+    async def _send(self, job: OutboundJob):
+        lane = job.priority.name.lower()
+        OUTBOUND_WAIT_SECONDS.labels(lane).observe(time.monotonic() - job.enqueued)
+        try:
+            result = await self.send(job.method, job.data, job.files, **job.kwargs)
+        except RetryAfter as e:
+            self._retry(job, e)
+        except Exception as e:
+            self._finish(job, error=e)
+        else:
+            self._finish(job, result=result)
+        finally:
+            self._sending.discard(job.chat_id)
+            self._slots.release()
+            self._wakeup.set()
     
-    def upgrade_building(self, user_id: int, building_type: BuildingType) -> Dict[str, Any]:
-        """ارتقای ساختمان"""
-        user = self.db.get_user(user_id)
-        if not user:
-            return {'success': False, 'message': 'کاربر یافت نشد'}
-        
-        # دریافت ساختمان
-        building = self.db.execute_query(
-            'SELECT * FROM buildings WHERE user_id = ? AND building_type = ?',
-            (user_id, building_type.value)
-        )
-        
-        if not building:
-            return {'success': False, 'message': 'ساختمان یافت نشد'}
-        
-        building = building[0]
-        current_level = building['level']
-        
-        # بررسی ماکس لول
-        if current_level >= 10:
-            return {'success': False, 'message': 'ساختمان در ماکس لول است'}
-        
-        # بررسی هزینه
-        cost = self.upgrade_costs.get(building_type, {}).get(current_level + 1)
-        if not cost:
-            return {'success': False, 'message': 'اطلاعات ارتقا یافت نشد'}
-        
-        # بررسی منابع
-        if user.gold < cost or user.elixir < cost:
-            return {'success': False, 'message': 'منابع کافی نیست'}
-        
-        # کسر منابع
-        self.db.update_user(
-            user_id,
-            gold=user.gold - cost,
-            elixir=user.elixir - cost
-        )
-        
-        # ارتقای ساختمان
-        self.db.execute_update(
-            '''UPDATE buildings 
-            SET level = ?, last_upgrade_time = CURRENT_TIMESTAMP
-            WHERE user_id = ? AND building_type = ?''',
-            (current_level + 1, user_id, building_type.value)
-        )
+    def _retry(self, job: OutboundJob, error: RetryAfter):
+        """مسدود کردن چت (یا کل صف) به مدت retry_after و برگرداندن کار به ابتدای صف"""
+        until = time.monotonic() + error.timeout
+        if job.chat_id is not None:
+            self._chat_bucket(job.chat_id).block(until)
+        else:
+            self._global.block(until)
         
-        # افزودن تجربه
-        experience_gain = cost // 100
-        new_experience = user.experience + experience_gain
+        job.attempts += 1
+        if job.attempts > self.max_retries:
+            self._finish(job, error=error)
+            return
         
-        # بررسی ارتقای لول
-        level_up = False
-        required_exp = user.level * 1000
+        self.retried += 1
+        OUTBOUND_EVENTS.inc(job.priority.name.lower(), 'retried')
+        logger.warning(f"⏳ Telegram flood control on {job.method} to {job.chat_id}: retry in {error.timeout}s")
         
-        if new_experience >= required_exp:
-            self.db.update_user(
-                user_id,
-                level=user.level + 1,
-                experience=new_experience - required_exp
-            )
-            level_up = True
+        newer_edit = self._edits.get(job.edit_key) if job.edit_key is not None else None
+        if newer_edit is not None:
+            # در این فاصله ویرایش جدیدتری صف شده؛ ویرایش قدیمی دیگر لازم نیست
+            newer_edit.futures.extend(job.futures)
+            self.coalesced += 1
+            OUTBOUND_EVENTS.inc(job.priority.name.lower(), 'coalesced')
+            return
+        job.enqueued = time.monotonic()
+        self._enqueue(job, front=True)
+    
+    def _finish(self, job: OutboundJob, result=None, error: Optional[Exception] = None):
+        if error is None:
+            self.sent += 1
+            OUTBOUND_EVENTS.inc(job.priority.name.lower(), 'sent')
         else:
-            self.db.update_user(
-                user_id,
-                experience=new_experience
-            )
-        
-        logger.info(f"🏗️ Building upgraded: {building_type.value} for user {user_id} to level {current_level + 1}")
-        
+            self.failed += 1
+            OUTBOUND_EVENTS.inc(job.priority.name.lower(), 'failed')
+        for future in job.futures:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+    
+    def depth(self, priority: OutboundPriority) -> int:
+        """تعداد کارهای صف‌شده در یک صف اولویت"""
+        return len(self._lanes[priority.value])
+    
+    def stats(self) -> Dict[str, Any]:
+        """آمار صف ارسال"""
         return {
-            'success': True,
-            'new_level': current_level + 1,
-            'cost': cost,
-            'experience_gain': experience_gain,
-            'level_up': level_up
+            'queued': {priority.name.lower(): self.depth(priority) for priority in OutboundPriority},
+            'in_flight': len(self._tasks),
+            'chat_buckets': len(self._chat_buckets),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'coalesced': self.coalesced,
         }
+    
+    async def close(self, timeout: float = OUTBOUND_DRAIN_TIMEOUT):
+        """ارسال پیام‌های باقیمانده (حداکثر timeout ثانیه) و توقف حلقه ارسال"""
+        deadline = time.monotonic() + timeout
+        while (any(self._lanes) or self._tasks) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._runner is not None:
+            self._runner.cancel()
+        
+        dropped = 0
+        for lane in self._lanes:
+            while lane:
+                job = lane.popleft()
+                dropped += 1
+                for future in job.futures:
+                    if not future.done():
+                        future.cancel()
+        self._edits.clear()
+        if dropped:
+            logger.error(f"⚠️ {dropped} outgoing messages could not be sent before shutdown")
+
+
+class InstrumentedBot(Bot):
+    """Bot با اندازه‌گیری تاخیر هر فراخوانی Bot API؛ ارسال پیام‌ها در صورت وجود outbound از صف عبور می‌کند"""
+    
+    outbound: Optional[OutboundQueue] = None
+    
+    async def request(self, method, data=None, files=None, **kwargs):
+        if self.outbound is not None and method in OUTBOUND_QUEUED_METHODS:
+            return await self.outbound.submit(method, data, files, **kwargs)
+        return await self.send_request(method, data, files, **kwargs)
+    
+    async def send_request(self, method, data=None, files=None, **kwargs):
+        """فراخوانی مستقیم Bot API (بدون صف)"""
+        histogram = TELEGRAM_API_SECONDS.labels(method)
+        start = time.perf_counter()
+        try:
+            result = await super().request(method, data, files, **kwargs)
+        except Exception:
+            histogram.observe(time.perf_counter() - start, error=True)
+            raise
+        histogram.observe(time.perf_counter() - start)
+        return result
 
-# ============================================================================
-# ربات تلگرام
-# ============================================================================
 
 class AmeleClashBot:
     """کلاس اصلی ربات"""
@@ -1041,30 +4186,196 @@ class AmeleClashBot:
         self.bot = None
         self.dp = None
         self.db = None
+        self.adb = None
+        self.chat_buffer = None
+        self.missions = None
+        self.scheduler = None
+        self.outbound = None
+        self.notification_tasks = set()
+        self.dedup = UpdateDeduplicator()
+        self.callback_router = self.build_callback_router()
         self.game = None
         self.app = None
         self.runner = None
         self.site = None
+        self.background_tasks = []
         
     async def on_startup(self, dp):
         """هنگام راه‌اندازی ربات"""
         # ***** اصلاح شد: ایجاد دیتابیس با نام db.db *****
         self.db = Database('db.db')
+        self.adb = AsyncDatabase(self.db)
+        self.chat_buffer = ClanMessageBuffer(self.adb)
+        await self.chat_buffer.start()
+        self.missions = MissionEngine(self.adb)
+        await self.dp.storage.start(self.adb)
         self.game = GameEngine(self.db)
+        await self.adb.run(self.game.matchmaking.load, self.db)
+        await self.adb.run(self.game.leaderboard.load, self.db)
+        # ماموریت‌های امروز؛ اگر ربات بعد از نیمه‌شب بالا آمده باشد rollover آن روز اجرا نشده است
+        await self.adb.materialize_daily_missions(current_mission_day())
+        self.background_tasks = [
+            asyncio.create_task(self.reconcile_leaderboard_loop()),
+            asyncio.create_task(self.mission_rollover_loop()),
+            asyncio.create_task(self.timestamp_backfill_loop()),
+            asyncio.create_task(self.event_loop_lag_loop()),
+            asyncio.create_task(self.fsm_sweep_loop()),
+            asyncio.create_task(self.forbidden_words_reload_loop()),
+        ]
+        self.register_metrics()
         
         await self.setup_webhook()
-        await self.bot.send_message(ADMIN_ID, "✅ ربات AmeleClashBot راه‌اندازی شد!")
+        self.notify_admin("✅ ربات AmeleClashBot راه‌اندازی شد!")
         
         # تنظیم وب‌سرور برای پنل قبیله
         await self.setup_web_server()
         
     async def on_shutdown(self, dp):
         """هنگام خاموش شدن ربات"""
-        await self.bot.delete_webhook()
+        try:
+            await self.bot.delete_webhook()
+        except Exception as e:
+            logger.error(f"Error deleting webhook: {e}")
+        for task in self.background_tasks:
+            task.cancel()
         if self.site:
             await self.site.stop()
+        if self.scheduler:
+            await self.scheduler.close()
+        if self.notification_tasks:
+            await asyncio.gather(*self.notification_tasks, return_exceptions=True)
+        if self.outbound:
+            await self.outbound.close()
+        if self.chat_buffer:
+            await self.chat_buffer.close()
+        if self.missions:
+            await self.missions.close()
+        if self.dp:
+            await self.dp.storage.close()
+        if self.adb:
+            self.adb.close()
+        if self.db:
+            self.db.close()
         await self.bot.session.close()
         
+    def register_metrics(self):
+        """متریک‌هایی که هنگام scrape از وضعیت اجزای ربات خوانده می‌شوند"""
+        cache = self.db.user_cache
+        METRICS.gauge('amele_user_cache_requests_total', 'User cache lookups by result',
+                      lambda: {('hit',): cache.hits, ('miss',): cache.misses},
+                      ('result',), kind='counter')
+        METRICS.gauge('amele_user_cache_evictions_total', 'User cache LRU evictions',
+                      lambda: cache.evictions, kind='counter')
+        METRICS.gauge('amele_user_cache_hit_ratio', 'User cache hit ratio since start',
+                      lambda: cache.stats()['hit_ratio'])
+        METRICS.gauge('amele_user_cache_size', 'Users currently cached',
+                      lambda: cache.stats()['size'])
+        
+        METRICS.gauge('amele_update_queue_depth', 'Updates waiting in per-user queues',
+                      lambda: self.scheduler.stats()['queued'])
+        METRICS.gauge('amele_updates_in_progress', 'Updates currently being handled',
+                      lambda: self.scheduler.stats()['in_progress'])
+        METRICS.gauge('amele_update_workers', 'Active per-user update workers',
+                      lambda: self.scheduler.stats()['active_workers'])
+        METRICS.gauge('amele_chat_buffer_pending', 'Clan messages not yet written to the database',
+                      lambda: self.chat_buffer.pending_count)
+        METRICS.gauge('amele_chat_messages_dropped_total', 'Clan messages dropped after a permanent write error',
+                      lambda: self.chat_buffer.dropped, kind='counter')
+        METRICS.gauge('amele_mission_progress_pending', 'Mission counters not yet written to the database',
+                      lambda: self.missions.pending_count)
+        
+        outbound = self.outbound
+        METRICS.gauge('amele_outbound_queue_depth', 'Outgoing messages waiting in the send queue by lane',
+                      lambda: {(p.name.lower(),): outbound.depth(p) for p in OutboundPriority},
+                      ('lane',))
+        METRICS.gauge('amele_outbound_in_flight', 'Outgoing messages currently being sent',
+                      lambda: outbound.stats()['in_flight'])
+        
+        fsm = self.dp.storage
+        METRICS.gauge('amele_fsm_states_cached', 'FSM states held in the in-memory tier',
+                      lambda: fsm.stats()['size'])
+        METRICS.gauge('amele_fsm_states_pending', 'FSM state changes not yet written to the database',
+                      lambda: fsm.pending_count)
+        METRICS.gauge('amele_fsm_lookups_total', 'FSM in-memory tier lookups by result',
+                      lambda: {('hit',): fsm.hits, ('miss',): fsm.misses},
+                      ('result',), kind='counter')
+        METRICS.gauge('amele_fsm_expirations_total', 'Abandoned FSM states expired by TTL',
+                      lambda: fsm.expirations, kind='counter')
+    
+    def notify_admin(self, text: str):
+        """ارسال اعلان به ادمین در صف اعلان‌ها بدون انتظار (پاسخ بازیکن معطل صف چت ادمین نمی‌شود)"""
+        with outbound_priority(OutboundPriority.NOTIFICATION):
+            self.spawn_send(self.bot.send_message(ADMIN_ID, text))
+    
+    def spawn_send(self, coro: Awaitable[Any]):
+        """اجرای یک ارسال در پس‌زمینه؛ هنگام خاموش شدن منتظر آن می‌مانیم و خطایش لاگ می‌شود"""
+        task = asyncio.ensure_future(coro)
+        self.notification_tasks.add(task)
+        task.add_done_callback(self._send_done)
+    
+    def _send_done(self, task: asyncio.Task):
+        self.notification_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Error sending background message: {task.exception()}")
+    
+    async def event_loop_lag_loop(self):
+        """اندازه‌گیری دیرکرد بیدار شدن event loop (نشانه کار مسدودکننده)"""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + EVENT_LOOP_LAG_INTERVAL
+            await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+            EVENT_LOOP_LAG_SECONDS.labels().observe(max(0.0, loop.time() - expected))
+    
+    async def fsm_sweep_loop(self):
+        """حذف دوره‌ای وضعیت‌های FSM رهاشده (ثبت‌نام یا ساخت قبیله نیمه‌کاره)"""
+        while True:
+            await asyncio.sleep(FSM_SWEEP_INTERVAL)
+            try:
+                await self.dp.storage.sweep()
+            except Exception as e:
+                logger.error(f"Error sweeping FSM states: {e}")
+    
+    async def forbidden_words_reload_loop(self):
+        """بررسی دوره‌ای فایل کلمات ممنوعه و ساخت خودکاره جدید بیرون از event loop"""
+        word_filter = self.game.word_filter
+        while True:
+            await asyncio.sleep(word_filter.reload_interval)
+            try:
+                await self.adb.run(word_filter.reload)
+            except Exception as e:
+                logger.error(f"Error reloading forbidden words: {e}")
+    
+    async def reconcile_leaderboard_loop(self):
+        """همگام‌سازی دوره‌ای رتبه‌بندی درون‌حافظه‌ای با دیتابیس"""
+        while True:
+            await asyncio.sleep(LEADERBOARD_RECONCILE_INTERVAL)
+            try:
+                await self.adb.run(self.game.leaderboard.reconcile, self.db)
+            except Exception as e:
+                logger.error(f"Error reconciling leaderboard: {e}")
+    
+    async def mission_rollover_loop(self):
+        """ساخت ماموریت‌های روز جدید برای همه کاربران و حذف روزهای قدیمی در نیمه‌شب UTC"""
+        while True:
+            now = datetime.datetime.utcnow()
+            next_day = (now + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+            await asyncio.sleep((next_day - now).total_seconds() + 1)
+            
+            mission_day = current_mission_day()
+            try:
+                await self.adb.materialize_daily_missions(mission_day)
+                await self.adb.prune_missions(mission_day - MISSION_RETENTION_DAYS)
+            except Exception as e:
+                logger.error(f"Error rolling over daily missions: {e}")
+    
+    async def timestamp_backfill_loop(self):
+        """تبدیل تدریجی زمان‌های متنی قدیمی به epoch با تراکنش‌های کوتاه"""
+        try:
+            while await self.adb.backfill_timestamps():
+                await asyncio.sleep(0.05)  # فرصت برای نوشتن‌های دیگر
+        except Exception as e:
+            logger.error(f"Error backfilling timestamps: {e}")
+    
     async def setup_webhook(self):
         """تنظیم Webhook"""
         webhook_url = f"{WEBHOOK_URL}/webhook"
@@ -1197,6 +4508,8 @@ class AmeleClashBot:
         self.app.router.add_get('/', self.handle_index)
         self.app.router.add_get('/clan/{clan_id}', self.handle_clan_chat)
         self.app.router.add_post('/webhook', self.handle_webhook)
+        self.app.router.add_get('/metrics', self.handle_metrics)
+        self.app.router.add_get('/debug/queries', self.handle_query_report)
         
         # راه‌اندازی وب‌سرور
         self.runner = web.AppRunner(self.app)
@@ -1212,22 +4525,23 @@ class AmeleClashBot:
         clan_id = int(request.match_info['clan_id'])
         
         # بررسی وجود قبیله
-        clan = self.db.get_clan(clan_id)
+        clan = await self.adb.get_clan(clan_id)
         if not clan:
             return web.Response(text="قبیله یافت نشد", status=404)
         
         # دریافت پیام‌های قبیله
-        messages = self.db.get_clan_messages(clan_id)
+        messages = await self.chat_buffer.get_clan_messages(clan_id)
         
         # فرمت‌دهی پیام‌ها برای نمایش
+        senders = await self.adb.get_users([msg.user_id for msg in messages])
         formatted_messages = []
         for msg in messages:
-            user = self.db.get_user(msg.user_id)
+            user = senders.get(msg.user_id)
             if user:
                 formatted_messages.append({
                     'game_name': user.game_name,
                     'message': msg.message,
-                    'created_at': msg.created_at
+                    'created_at': format_epoch(msg.created_epoch)
                 })
         
         return {
@@ -1296,16 +4610,68 @@ class AmeleClashBot:
         '''
         return web.Response(text=html, content_type='text/html')
     
+    async def handle_metrics(self, request):
+        """متریک‌ها در فرمت متنی Prometheus"""
+        return web.Response(
+            body=METRICS.render().encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+    
+    async def handle_query_report(self, request):
+        """گزارش JSON پروفایل کوئری‌ها (?order=total|p99|count&limit=N)"""
+        # شکل و پلن کوئری‌ها اطلاعات داخلی است؛ بدون توکن تنظیم‌شده در دسترس نیست
+        if not DEBUG_TOKEN:
+            return web.Response(status=404)
+        if not hmac.compare_digest(request.query.get('token', '').encode(), DEBUG_TOKEN.encode()):
+            return web.Response(status=403)
+        
+        try:
+            limit = int(request.query.get('limit', 50))
+            rows = QUERY_PROFILER.report(limit, request.query.get('order', 'total'))
+        except ValueError as e:
+            return web.json_response({'error': str(e)}, status=400)
+        
+        return web.json_response({
+            'slow_threshold_ms': QUERY_PROFILER.slow_threshold * 1000,
+            'fingerprints': len(QUERY_PROFILER._stats),
+            'dropped': QUERY_PROFILER.dropped,
+            'queries': rows,
+        }, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+    
     async def handle_webhook(self, request):
-        """مدیریت Webhook تلگرام"""
+        """مدیریت Webhook تلگرام؛ آپدیت فقط بررسی و در صف گذاشته می‌شود و پاسخ فوری برمی‌گردد"""
         try:
             data = await request.json()
+            if not isinstance(data, dict) or 'update_id' not in data:
+                raise ValueError("update_id is missing")
             update = types.Update(**data)
-            await self.dp.process_update(update)
-            return web.Response()
         except Exception as e:
-            logger.error(f"Error processing webhook: {e}")
-            return web.Response(status=500)
+            logger.warning(f"Invalid webhook payload: {e}")
+            UPDATES_DROPPED.inc('invalid')
+            return web.Response(status=400)
+        UPDATES_RECEIVED.inc(update_type(update))
+        
+        # آپدیت تکراری (ارسال دوباره تلگرام) به دیتابیس نمی‌رسد
+        if self.dedup.is_duplicate(update.update_id):
+            logger.debug(f"Duplicate update {update.update_id} ignored")
+            UPDATES_DROPPED.inc('duplicate')
+            return web.Response()
+        
+        # پردازش در پس‌زمینه؛ خطاهای بازی دیگر باعث ارسال دوباره از طرف تلگرام نمی‌شوند
+        dropped = self.scheduler.offer(update)
+        if dropped == 'queue_full':
+            # پاسخ غیر 2xx تا تلگرام آپدیت را دوباره بفرستد (حمله یا خرید نباید گم شود)
+            logger.warning(f"Update {update.update_id} rejected: queue full")
+            return web.Response(status=503)
+        
+        self.dedup.remember(update.update_id)
+        if dropped == 'shed':
+            logger.debug(f"Update {update.update_id} shed under load")
+            # دکمه کاربر تا پاسخ callback در حال چرخیدن می‌ماند
+            self.spawn_send(self.bot.answer_callback_query(
+                update.callback_query.id, "⏳ ربات شلوغ است، چند لحظه دیگر دوباره امتحان کنید."
+            ))
+        return web.Response()
     
     # ============================================================================
     # هندلرهای ربات
@@ -1315,7 +4681,7 @@ class AmeleClashBot:
         """هندلر دستور /start"""
         user_id = message.from_user.id
         username = message.from_user.username
-        existing_user = self.db.get_user(user_id)
+        existing_user = await self.adb.get_user(user_id)
         
         if existing_user:
             if existing_user.banned:
@@ -1344,13 +4710,18 @@ class AmeleClashBot:
         username = message.from_user.username
         
         # ایجاد کاربر جدید
-        success = self.db.create_user(user_id, username, game_name)
+        success = await self.adb.create_user(user_id, username, game_name)
         
         if success:
             await state.finish()
             
+            # افزودن به ایندکس حریف‌یابی و رتبه‌بندی
+            new_user = await self.adb.get_user(user_id)
+            self.game.matchmaking.add(user_id, new_user.trophies)
+            self.game.leaderboard.add(user_id, new_user.game_name, new_user.trophies, new_user.level)
+            
             # جمع‌آوری منابع اولیه
-            self.game.collect_resources(user_id)
+            await self.adb.run_write(self.game.collect_resources, user_id)
             
             await message.answer(
                 f"✅ ثبت نام موفقیت‌آمیز بود!\n"
@@ -1367,16 +4738,17 @@ class AmeleClashBot:
         else:
             await message.answer("خطا در ثبت نام. لطفا مجددا تلاش کنید.")
     
-    async def show_main_menu(self, message: types.Message):
-        """نمایش منوی اصلی"""
-        user_id = message.from_user.id
-        user = self.db.get_user(user_id)
+    async def show_main_menu(self, message: types.Message, user_id: int = None):
+        """نمایش منوی اصلی؛ از دکمه بازگشت، فرستنده پیام خود ربات است و user_id جدا داده می‌شود"""
+        user_id = user_id or message.from_user.id
+        user = await self.adb.get_user(user_id)
         
         if not user:
             return
         
         # جمع‌آوری خودکار منابع
-        production = self.game.collect_resources(user_id)
+        production = await self.adb.run_write(self.game.collect_resources, user_id)
+        self.missions.emit(GameEvent.RESOURCES_COLLECTED, user_id, production['gold'] + production['elixir'])
         
         keyboard = InlineKeyboardMarkup(row_width=2)
         buttons = [
@@ -1420,13 +4792,13 @@ class AmeleClashBot:
     async def show_village_menu(self, callback_query: types.CallbackQuery):
         """نمایش منوی دهکده"""
         user_id = callback_query.from_user.id
-        user = self.db.get_user(user_id)
+        user = await self.adb.get_user(user_id)
         
         if not user:
             return
         
         # دریافت ساختمان‌های کاربر
-        buildings = self.db.execute_query(
+        buildings = await self.adb.execute_query(
             'SELECT * FROM buildings WHERE user_id = ?',
             (user_id,)
         )
@@ -1471,7 +4843,7 @@ class AmeleClashBot:
     async def show_profile_menu(self, callback_query: types.CallbackQuery):
         """نمایش پروفایل کاربر"""
         user_id = callback_query.from_user.id
-        user = self.db.get_user(user_id)
+        user = await self.adb.get_user(user_id)
         
         if not user:
             return
@@ -1482,17 +4854,16 @@ class AmeleClashBot:
         
         clan_info = "🔸 بدون قبیله"
         if user.clan_id:
-            clan = self.db.get_clan(user.clan_id)
+            clan = await self.adb.get_clan(user.clan_id)
             if clan:
                 clan_info = f"🔸 قبیله: {clan.name} [{clan.tag}]"
         
-        # تعداد حمله‌های امروز
-        today = datetime.datetime.now().date().isoformat()
-        attack_count = len(self.db.execute_query(
-            '''SELECT 1 FROM attack_logs 
-            WHERE attacker_id = ? AND DATE(timestamp) = ?''',
-            (user_id, today)
-        ))
+        # تعداد حمله‌های امروز (UTC)
+        attack_count = (await self.adb.execute_query(
+            '''SELECT COUNT(*) FROM attack_logs 
+            WHERE attacker_id = ? AND timestamp_epoch BETWEEN ? AND ?''',
+            (user_id, *day_range())
+        ))[0][0]
         
         keyboard = InlineKeyboardMarkup()
         keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data="main_menu"))
@@ -1516,7 +4887,7 @@ class AmeleClashBot:
     async def show_clan_menu(self, callback_query: types.CallbackQuery):
         """نمایش منوی قبیله"""
         user_id = callback_query.from_user.id
-        user = self.db.get_user(user_id)
+        user = await self.adb.get_user(user_id)
         
         if not user:
             return
@@ -1525,8 +4896,8 @@ class AmeleClashBot:
         
         if user.clan_id:
             # کاربر در قبیله است
-            clan = self.db.get_clan(user.clan_id)
-            members = self.db.get_clan_members(user.clan_id)
+            clan = await self.adb.get_clan(user.clan_id)
+            members = await self.adb.get_clan_members(user.clan_id)
             
             clan_info = (
                 f"👥 قبیله {clan.name} [{clan.tag}]\n"
@@ -1534,7 +4905,7 @@ class AmeleClashBot:
                 f"🏆 تروفی قبیله: {clan.trophies:,}\n"
                 f"⭐ لول قبیله: {clan.level}\n"
                 f"👥 اعضا: {len(members)}/{50}\n\n"
-                f"👑 رهبر: {self.db.get_user(clan.leader_id).game_name}\n"
+                f"👑 رهبر: {(await self.adb.get_user(clan.leader_id)).game_name}\n"
             )
             
             # لیست معاونان و مدیران
@@ -1566,7 +4937,7 @@ class AmeleClashBot:
             clan_info = "شما در حال حاضر در هیچ قبیله‌ای عضو نیستید.\n\n"
             
             # نمایش قبایل برتر
-            top_clans = self.db.get_top_clans(5)
+            top_clans = await self.adb.get_top_clans(5)
             if top_clans:
                 clan_info += "🏆 قبایل برتر:\n"
                 for i, clan in enumerate(top_clans, 1):
@@ -1588,7 +4959,7 @@ class AmeleClashBot:
     async def show_attack_menu(self, callback_query: types.CallbackQuery):
         """نمایش منوی حمله"""
         user_id = callback_query.from_user.id
-        user = self.db.get_user(user_id)
+        user = await self.adb.get_user(user_id)
         
         if not user:
             return
@@ -1597,10 +4968,8 @@ class AmeleClashBot:
         cooldown = 5  # دقیقه
         can_attack = True
         
-        if user.last_attack_time:
-            last_attack = datetime.datetime.fromisoformat(user.last_attack_time)
-            now = datetime.datetime.now()
-            minutes_passed = (now - last_attack).total_seconds() / 60
+        if user.last_attack_epoch:
+            minutes_passed = (time.time() - user.last_attack_epoch) / 60
             
             if minutes_passed < cooldown:
                 can_attack = False
@@ -1638,36 +5007,34 @@ class AmeleClashBot:
     async def attack_random_player(self, callback_query: types.CallbackQuery):
         """حمله به بازیکن تصادفی"""
         user_id = callback_query.from_user.id
-        attacker = self.db.get_user(user_id)
+        attacker = await self.adb.get_user(user_id)
         
         if not attacker:
             return
         
-        # انتخاب بازیکن تصادفی (غیر از خود کاربر و ادمین)
-        targets = self.db.execute_query(
-            '''SELECT user_id FROM users 
-            WHERE user_id != ? AND user_id != ? AND banned = 0
-            ORDER BY RANDOM() LIMIT 1''',
-            (user_id, ADMIN_ID)
-        )
+        # انتخاب حریف نزدیک به تروفی کاربر (غیر از خود کاربر و ادمین)
+        target_id = self.game.matchmaking.find_opponent(user_id, attacker.trophies)
         
-        if not targets:
+        if target_id is None:
             await callback_query.answer("هیچ بازیکنی برای حمله یافت نشد!")
             return
         
-        target_id = targets[0]['user_id']
-        defender = self.db.get_user(target_id)
+        defender = await self.adb.get_user(target_id)
         
-        if not defender:
+        if not defender or defender.banned:
+            self.game.matchmaking.remove(target_id)
+            await callback_query.answer("هیچ بازیکنی برای حمله یافت نشد!")
             return
         
         # شبیه‌سازی حمله
-        result = self.game.simulate_attack(user_id, target_id)
+        result = await self.adb.run_write(self.game.simulate_attack, user_id, target_id)
         
         if 'error' in result:
             await callback_query.answer(result['error'])
             return
         
+        self.missions.emit(GameEvent.ATTACK_DONE, user_id)
+        
         # نمایش نتیجه
         result_text = ""
         if result['result'] == 'win':
@@ -1700,13 +5067,19 @@ class AmeleClashBot:
     async def attack_superpower(self, callback_query: types.CallbackQuery):
         """حمله به کشور ابرقدرت"""
         user_id = callback_query.from_user.id
-        attacker = self.db.get_user(user_id)
+        attacker = await self.adb.get_user(user_id)
         
         if not attacker:
             return
         
         # شبیه‌سازی حمله به ادمین
-        result = self.game.simulate_attack(user_id, ADMIN_ID)
+        result = await self.adb.run_write(self.game.simulate_attack, user_id, ADMIN_ID)
+        
+        if 'error' in result:
+            await callback_query.answer(result['error'])
+            return
+        
+        self.missions.emit(GameEvent.ATTACK_DONE, user_id)
         
         # نمایش نتیجه
         if result['result'] == 'win':
@@ -1739,11 +5112,13 @@ class AmeleClashBot:
         """نمایش رتبه‌بندی"""
         user_id = callback_query.from_user.id
         
-        # دریافت برترین بازیکنان
-        top_players = self.db.get_top_players(10)
-        
-        # دریافت برترین قبایل
-        top_clans = self.db.get_top_clans(5)
+        # رتبه‌بندی از حافظه خوانده می‌شود (بدون کوئری)
+        leaderboard = self.game.leaderboard
+        if leaderboard.clans_stale:
+            await self.adb.run(leaderboard.refresh_clans, self.db)
+        top_players = leaderboard.top_players(10)
+        top_clans = leaderboard.top_clans(5)
+        my_rank = leaderboard.rank(user_id)
         
         players_text = "🏆 برترین بازیکنان:\n"
         for i, player in enumerate(top_players, 1):
@@ -1755,13 +5130,16 @@ class AmeleClashBot:
             trophy_emoji = "👑" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else "🔸"
             clans_text += f"{trophy_emoji}{i}. {clan.name} [{clan.tag}] - 🏆{clan.trophies:,}\n"
         
+        rank_text = f"\n📍 رتبه شما: {my_rank:,} از {len(leaderboard):,}\n" if my_rank else ""
+        
         keyboard = InlineKeyboardMarkup()
         keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data="main_menu"))
         
         await callback_query.message.edit_text(
             f"📊 رتبه‌بندی جهانی\n\n"
             f"{players_text}"
-            f"{clans_text}",
+            f"{clans_text}"
+            f"{rank_text}",
             reply_markup=keyboard
         )
     
@@ -1769,8 +5147,19 @@ class AmeleClashBot:
         """نمایش ماموریت‌ها"""
         user_id = callback_query.from_user.id
         
-        # دریافت ماموریت‌های کاربر
-        missions = self.db.get_user_missions(user_id)
+        # دریافت ماموریت‌های کاربر؛ ساخت (نوشتن) روی thread نویسنده انجام می‌شود
+        missions = await self.adb.get_user_missions(user_id)
+        if missions is None:
+            await self.adb.create_daily_missions(user_id)
+            missions = await self.adb.get_user_missions(user_id) or []
+        
+        # پیشرفت‌هایی که هنوز ذخیره نشده‌اند هم نمایش داده می‌شوند
+        pending = self.missions.pending_for(user_id)
+        for mission in missions:
+            mission['current_value'] = min(
+                mission['target_value'],
+                mission['current_value'] + pending.get(mission['mission_type'], 0)
+            )
         
         missions_text = "🎯 ماموریت‌های روزانه:\n\n"
         if missions:
@@ -1812,7 +5201,7 @@ class AmeleClashBot:
         """دریافت پاداش روزانه"""
         user_id = callback_query.from_user.id
         
-        reward = self.game.get_daily_reward(user_id)
+        reward = await self.adb.run_write(self.game.get_daily_reward, user_id)
         
         if reward:
             await callback_query.answer(
@@ -1846,7 +5235,7 @@ class AmeleClashBot:
             return
         
         # بررسی تکراری نبودن نام
-        existing = self.db.get_clan_by_name(clan_name)
+        existing = await self.adb.get_clan_by_name(clan_name)
         if existing:
             await message.answer("این نام قبلاً استفاده شده است. لطفا نام دیگری انتخاب کنید:")
             return
@@ -1875,7 +5264,7 @@ class AmeleClashBot:
             return
         
         # بررسی تکراری نبودن تگ
-        existing = self.db.execute_query(
+        existing = await self.adb.execute_query(
             'SELECT 1 FROM clans WHERE tag = ?',
             (tag,)
         )
@@ -1905,10 +5294,11 @@ class AmeleClashBot:
         user_id = message.from_user.id
         
         # ایجاد قبیله
-        clan_id = self.db.create_clan(clan_name, clan_tag, description, user_id)
+        clan_id = await self.adb.create_clan(clan_name, clan_tag, description, user_id)
         
         if clan_id:
             await state.finish()
+            self.game.leaderboard.mark_clans_stale()
             
             # دریافت لینک چت قبیله
             chat_link = f"{WEBHOOK_URL}/clan/{clan_id}"
@@ -1925,7 +5315,8 @@ class AmeleClashBot:
             # نمایش منوی قبیله
             await self.show_clan_menu(types.CallbackQuery(
                 id="temp",
-                from_user=message.from_user,
+                # فیلد from_user در آیوگرام با نام مستعار from پر می‌شود
+                **{'from': message.from_user},
                 chat_instance="temp",
                 message=message
             ))
@@ -1936,21 +5327,22 @@ class AmeleClashBot:
     async def show_clan_chat(self, callback_query: types.CallbackQuery):
         """نمایش چت قبیله"""
         user_id = callback_query.from_user.id
-        user = self.db.get_user(user_id)
+        user = await self.adb.get_user(user_id)
         
         if not user or not user.clan_id:
             return
         
-        clan = self.db.get_clan(user.clan_id)
-        messages = self.db.get_clan_messages(user.clan_id, 20)
+        clan = await self.adb.get_clan(user.clan_id)
+        messages = await self.chat_buffer.get_clan_messages(user.clan_id, 20)
         
         chat_text = f"💬 چت قبیله {clan.name}\n\n"
         
         if messages:
+            senders = await self.adb.get_users([msg.user_id for msg in messages])
             for msg in messages:
-                sender = self.db.get_user(msg.user_id)
-                time = msg.created_at[11:16]  # فقط ساعت و دقیقه
-                chat_text += f"🕒 {time} | {sender.game_name}:\n{msg.message}\n\n"
+                sender = senders[msg.user_id]
+                sent_at = format_epoch(msg.created_epoch, '%H:%M')  # فقط ساعت و دقیقه
+                chat_text += f"🕒 {sent_at} | {sender.game_name}:\n{msg.message}\n\n"
         else:
             chat_text += "📭 هیچ پیامی وجود ندارد.\nاولین پیام را ارسال کنید!"
         
@@ -1971,7 +5363,7 @@ class AmeleClashBot:
     async def send_clan_message_start(self, callback_query: types.CallbackQuery):
         """شروع فرآیند ارسال پیام قبیله"""
         user_id = callback_query.from_user.id
-        user = self.db.get_user(user_id)
+        user = await self.adb.get_user(user_id)
         
         if not user or not user.clan_id:
             return
@@ -1990,7 +5382,7 @@ class AmeleClashBot:
     async def process_clan_message(self, message: types.Message, state: FSMContext):
         """پردازش پیام قبیله"""
         user_id = message.from_user.id
-        user = self.db.get_user(user_id)
+        user = await self.adb.get_user(user_id)
         
         if not user or not user.clan_id:
             await state.finish()
@@ -2008,7 +5400,7 @@ class AmeleClashBot:
         if has_forbidden:
             # افزایش اخطار
             warnings = user.warnings + 1
-            self.db.update_user(user_id, warnings=warnings)
+            await self.adb.update_user(user_id, warnings=warnings)
             
             if warnings >= 3:
                 # محدودیت موقت
@@ -2026,39 +5418,10 @@ class AmeleClashBot:
                 return
         
         # ذخیره پیام
-        message_id = self.db.add_clan_message(user.clan_id, user_id, text)
+        message_id = self.chat_buffer.add(user.clan_id, user_id, text).message_id
         
         # آپدیت ماموریت ارسال پیام
-        missions = self.db.execute_query(
-            '''SELECT * FROM missions 
-            WHERE user_id = ? AND mission_type = 'send_clan_messages' 
-            AND completed = 0 AND DATE(created_at) = DATE('now')''',
-            (user_id,)
-        )
-        
-        if missions:
-            mission = missions[0]
-            new_value = mission['current_value'] + 1
-            self.db.execute_update(
-                'UPDATE missions SET current_value = ? WHERE mission_id = ?',
-                (new_value, mission['mission_id'])
-            )
-            
-            # بررسی تکمیل ماموریت
-            if new_value >= mission['target_value']:
-                self.db.execute_update(
-                    '''UPDATE missions SET completed = 1 
-                    WHERE mission_id = ?''',
-                    (mission['mission_id'],)
-                )
-                
-                # دادن پاداش
-                self.db.update_user(
-                    user_id,
-                    gold=user.gold + mission['reward_gold'],
-                    elixir=user.elixir + mission['reward_elixir'],
-                    gem=user.gem + mission['reward_gem']
-                )
+        self.missions.emit(GameEvent.CLAN_MESSAGE_SENT, user_id)
         
         await state.finish()
         await message.answer("✅ پیام شما ارسال شد.")
@@ -2066,7 +5429,8 @@ class AmeleClashBot:
         # نمایش مجدد چت
         await self.show_clan_chat(types.CallbackQuery(
             id="temp",
-            from_user=message.from_user,
+            # فیلد from_user در آیوگرام با نام مستعار from پر می‌شود
+            **{'from': message.from_user},
             chat_instance="temp",
             message=message
         ))
@@ -2074,12 +5438,12 @@ class AmeleClashBot:
     async def show_clan_chat_link(self, callback_query: types.CallbackQuery):
         """نمایش لینک چت قبیله"""
         user_id = callback_query.from_user.id
-        user = self.db.get_user(user_id)
+        user = await self.adb.get_user(user_id)
         
         if not user or not user.clan_id:
             return
         
-        clan = self.db.get_clan(user.clan_id)
+        clan = await self.adb.get_clan(user.clan_id)
         chat_link = f"{WEBHOOK_URL}/clan/{clan.clan_id}"
         
         keyboard = InlineKeyboardMarkup()
@@ -2104,37 +5468,32 @@ class AmeleClashBot:
         reporter_id = callback_query.from_user.id
         
         # دریافت اطلاعات کاربر گزارش‌شده
-        reported_user = self.db.get_user(reported_user_id)
+        reported_user = await self.adb.get_user(reported_user_id)
         if not reported_user:
             await callback_query.answer("کاربر یافت نشد!")
             return
         
         # ایجاد گزارش
-        report_id = self.db.create_report(
+        report_id = await self.adb.create_report(
             reporter_id,
             reported_user_id,
             f"گزارش از طریق دکمه گزارش برای کاربر: {reported_user.game_name}"
         )
         
-        # ارسال به ادمین
-        try:
-            report_text = (
-                f"🚨 گزارش جدید!\n\n"
-                f"🆔 گزارش‌دهنده: {reporter_id}\n"
-                f"👤 کاربر گزارش‌شده:\n"
-                f"   • آی‌دی: {reported_user_id}\n"
-                f"   • یوزرنیم: @{reported_user.username if reported_user.username else 'ندارد'}\n"
-                f"   • نام بازی: {reported_user.game_name}\n"
-                f"   • اخطارها: {reported_user.warnings}\n\n"
-                f"📝 گزارش #{report_id}"
-            )
-            
-            await self.bot.send_message(ADMIN_ID, report_text)
-            
-            await callback_query.answer("✅ گزارش شما ارسال شد. با تشکر!")
-        except Exception as e:
-            logger.error(f"Error sending report to admin: {e}")
-            await callback_query.answer("⚠️ خطا در ارسال گزارش!")
+        # ارسال به ادمین (گزارش در دیتابیس ثبت شده؛ اعلان در پس‌زمینه فرستاده می‌شود)
+        report_text = (
+            f"🚨 گزارش جدید!\n\n"
+            f"🆔 گزارش‌دهنده: {reporter_id}\n"
+            f"👤 کاربر گزارش‌شده:\n"
+            f"   • آی‌دی: {reported_user_id}\n"
+            f"   • یوزرنیم: @{reported_user.username if reported_user.username else 'ندارد'}\n"
+            f"   • نام بازی: {reported_user.game_name}\n"
+            f"   • اخطارها: {reported_user.warnings}\n\n"
+            f"📝 گزارش #{report_id}"
+        )
+        self.notify_admin(report_text)
+        
+        await callback_query.answer("✅ گزارش شما ارسال شد. با تشکر!")
     
     async def show_admin_panel(self, callback_query: types.CallbackQuery):
         """نمایش پنل ادمین"""
@@ -2143,10 +5502,13 @@ class AmeleClashBot:
             return
         
         # آمار کلی
-        total_users = len(self.db.execute_query('SELECT 1 FROM users'))
-        total_clans = len(self.db.execute_query('SELECT 1 FROM clans'))
-        pending_reports = len(self.db.get_pending_reports())
-        banned_users = len(self.db.execute_query('SELECT 1 FROM users WHERE banned = 1'))
+        total_users = (await self.adb.execute_query('SELECT COUNT(*) FROM users'))[0][0]
+        total_clans = (await self.adb.execute_query('SELECT COUNT(*) FROM clans'))[0][0]
+        pending_reports = len(await self.adb.get_pending_reports())
+        banned_users = (await self.adb.execute_query('SELECT COUNT(*) FROM users WHERE banned = 1'))[0][0]
+        cache_stats = self.db.user_cache.stats()
+        scheduler_stats = self.scheduler.stats()
+        dedup_stats = self.dedup.stats()
         
         keyboard = InlineKeyboardMarkup(row_width=2)
         buttons = [
@@ -2155,6 +5517,8 @@ class AmeleClashBot:
             InlineKeyboardButton("🚨 گزارش‌ها", callback_data="admin_reports"),
             InlineKeyboardButton("📊 آمار کلی", callback_data="admin_stats"),
             InlineKeyboardButton("⚙️ تنظیمات", callback_data="admin_settings"),
+            InlineKeyboardButton("⏱️ تاخیر مسیرها", callback_data="admin_routes"),
+            InlineKeyboardButton("🐢 کوئری‌های کند", callback_data="admin_queries"),
             InlineKeyboardButton("🔙 بازگشت", callback_data="main_menu")
         ]
         keyboard.add(*buttons)
@@ -2166,6 +5530,18 @@ class AmeleClashBot:
             f"   • قبایل: {total_clans}\n"
             f"   • گزارش‌های در انتظار: {pending_reports}\n"
             f"   • کاربران مسدود: {banned_users}\n\n"
+            f"🗃️ کش کاربران:\n"
+            f"   • اندازه: {cache_stats['size']:,}/{cache_stats['max_size']:,}\n"
+            f"   • hit/miss: {cache_stats['hits']:,}/{cache_stats['misses']:,} "
+            f"({cache_stats['hit_ratio'] * 100:.1f}%)\n"
+            f"   • eviction: {cache_stats['evictions']:,}\n\n"
+            f"📥 صف آپدیت‌ها:\n"
+            f"   • کاربران فعال: {scheduler_stats['active_workers']:,}\n"
+            f"   • در صف: {scheduler_stats['queued']:,} "
+            f"(بیشترین عمق: {scheduler_stats['max_depth']}/{scheduler_stats['max_depth_seen']})\n"
+            f"   • پردازش‌شده/خطا: {scheduler_stats['processed']:,}/{scheduler_stats['failed']:,}\n"
+            f"   • حذف زیر بار/صف پر: {scheduler_stats['shed']:,}/{scheduler_stats['rejected']:,}\n"
+            f"   • تکراری (پنجره {dedup_stats['window']:,}): {dedup_stats['duplicates']:,}\n\n"
             f"انتخاب کنید:",
             reply_markup=keyboard
         )
@@ -2175,16 +5551,21 @@ class AmeleClashBot:
         if callback_query.from_user.id != ADMIN_ID:
             return
         
-        reports = self.db.get_pending_reports()
+        reports = await self.adb.get_pending_reports()
         
         if not reports:
             text = "✅ هیچ گزارش در انتظاری وجود ندارد."
         else:
             text = f"🚨 گزارش‌های در انتظار ({len(reports)})\n\n"
             
-            for i, report in enumerate(reports[:5], 1):  # فقط 5 گزارش اول
-                reporter = self.db.get_user(report.reporter_id)
-                reported = self.db.get_user(report.reported_user_id)
+            shown_reports = reports[:5]  # فقط 5 گزارش اول
+            users = await self.adb.get_users(
+                [r.reporter_id for r in shown_reports] + [r.reported_user_id for r in shown_reports]
+            )
+            
+            for i, report in enumerate(shown_reports, 1):
+                reporter = users.get(report.reporter_id)
+                reported = users.get(report.reported_user_id)
                 
                 text += (
                     f"📌 گزارش #{report.report_id}\n"
@@ -2206,6 +5587,72 @@ class AmeleClashBot:
             reply_markup=keyboard
         )
     
+    async def show_admin_routes(self, callback_query: types.CallbackQuery):
+        """نمایش تاخیر هر مسیر callback (کندترین‌ها بر اساس p99)"""
+        if callback_query.from_user.id != ADMIN_ID:
+            return
+        
+        rows = self.callback_router.stats()
+        if not rows:
+            text = "⏱️ هنوز هیچ مسیری اجرا نشده است."
+        else:
+            text = "⏱️ تاخیر مسیرها (میلی‌ثانیه)\n\n"
+            for row in rows[:15]:
+                text += (
+                    f"• {row['route']}: {row['count']:,} بار"
+                    f" | p50≤{row['p50'] * 1000:g} p99≤{row['p99'] * 1000:g}"
+                    f" | میانگین {row['mean'] * 1000:.1f}"
+                    f" | خطا {row['errors']:,}\n"
+                )
+        
+        keyboard = InlineKeyboardMarkup(row_width=2)
+        buttons = [
+            InlineKeyboardButton("🔄 بروزرسانی", callback_data="admin_routes"),
+            InlineKeyboardButton("🔙 بازگشت", callback_data="admin_panel")
+        ]
+        keyboard.add(*buttons)
+        
+        await callback_query.message.edit_text(
+            text,
+            reply_markup=keyboard
+        )
+    
+    async def show_admin_queries(self, callback_query: types.CallbackQuery):
+        """نمایش پرهزینه‌ترین کوئری‌ها (مجموع زمان) به همراه پلن کوئری‌های کند"""
+        if callback_query.from_user.id != ADMIN_ID:
+            return
+        
+        if callback_query.data == "admin_queries_reset":
+            QUERY_PROFILER.reset()
+        
+        rows = QUERY_PROFILER.report(limit=8)
+        if not rows:
+            text = "🐢 هنوز کوئری‌ای ثبت نشده است."
+        else:
+            text = f"🐢 پرهزینه‌ترین کوئری‌ها (آستانه کند: {QUERY_PROFILER.slow_threshold * 1000:g}ms)\n\n"
+            for row in rows:
+                text += (
+                    f"• {row['fingerprint'][:120]}\n"
+                    f"   {row['count']:,} بار | مجموع {row['total_ms']:,.1f}ms"
+                    f" | p50≤{row['p50_ms']:g} p99≤{row['p99_ms']:g} | ردیف/اجرا {row['rows_per_call']:.1f}\n"
+                )
+                if row['plan']:
+                    text += f"   📋 {' / '.join(row['plan'])[:150]}\n"
+                text += "\n"
+        
+        keyboard = InlineKeyboardMarkup(row_width=2)
+        buttons = [
+            InlineKeyboardButton("🔄 بروزرسانی", callback_data="admin_queries"),
+            InlineKeyboardButton("🗑️ صفر کردن", callback_data="admin_queries_reset"),
+            InlineKeyboardButton("🔙 بازگشت", callback_data="admin_panel")
+        ]
+        keyboard.add(*buttons)
+        
+        await callback_query.message.edit_text(
+            text[:4000],
+            reply_markup=keyboard
+        )
+    
     async def upgrade_building_handler(self, callback_query: types.CallbackQuery):
         """هندلر ارتقای ساختمان"""
         data = callback_query.data
@@ -2224,7 +5671,7 @@ class AmeleClashBot:
             return
         
         # ارتقای ساختمان
-        result = self.game.upgrade_building(user_id, building_type)
+        result = await self.adb.run_write(self.game.upgrade_building, user_id, building_type)
         
         if result['success']:
             response_text = (
@@ -2240,37 +5687,7 @@ class AmeleClashBot:
             await callback_query.answer(response_text)
             
             # آپدیت ماموریت ارتقای ساختمان
-            missions = self.db.execute_query(
-                '''SELECT * FROM missions 
-                WHERE user_id = ? AND mission_type = 'upgrade_building' 
-                AND completed = 0 AND DATE(created_at) = DATE('now')''',
-                (user_id,)
-            )
-            
-            if missions:
-                mission = missions[0]
-                new_value = mission['current_value'] + 1
-                self.db.execute_update(
-                    'UPDATE missions SET current_value = ? WHERE mission_id = ?',
-                    (new_value, mission['mission_id'])
-                )
-                
-                # بررسی تکمیل ماموریت
-                if new_value >= mission['target_value']:
-                    self.db.execute_update(
-                        '''UPDATE missions SET completed = 1 
-                        WHERE mission_id = ?''',
-                        (mission['mission_id'],)
-                    )
-                    
-                    # دادن پاداش
-                    user = self.db.get_user(user_id)
-                    self.db.update_user(
-                        user_id,
-                        gold=user.gold + mission['reward_gold'],
-                        elixir=user.elixir + mission['reward_elixir'],
-                        gem=user.gem + mission['reward_gem']
-                    )
+            self.missions.emit(GameEvent.BUILDING_UPGRADED, user_id)
         else:
             await callback_query.answer(f"❌ {result['message']}")
     
@@ -2278,59 +5695,50 @@ class AmeleClashBot:
     # هندلر کلی callback queries
     # ============================================================================
     
+    def build_callback_router(self) -> CallbackRouter:
+        """جدول مسیرهای callback_data"""
+        router = CallbackRouter()
+        routes = {
+            "main_menu": lambda cq: self.show_main_menu(cq.message, cq.from_user.id),
+            "village": self.show_village_menu,
+            "profile": self.show_profile_menu,
+            "clan": self.show_clan_menu,
+            "attack": self.show_attack_menu,
+            "leaderboard": self.show_leaderboard,
+            "missions": self.show_missions,
+            "daily_reward": self.claim_daily_reward,
+            "help": self.show_help,
+            "admin_panel": self.show_admin_panel,
+            "admin_reports": self.show_admin_reports,
+            "admin_routes": self.show_admin_routes,
+            "admin_queries": self.show_admin_queries,
+            "admin_queries_reset": self.show_admin_queries,
+            "attack_random": self.attack_random_player,
+            "attack_superpower": self.attack_superpower,
+            "clan_create": self.create_clan_start,
+            "clan_chat": self.show_clan_chat,
+            "clan_chat_send": self.send_clan_message_start,
+            "clan_chat_link": self.show_clan_chat_link,
+        }
+        for data, handler in routes.items():
+            router.add(data, handler)
+        
+        router.add_prefix("upgrade_", self.upgrade_building_handler)
+        router.add_prefix("clan_chat_link_", self.show_clan_chat_link)
+        router.add_prefix("report_", self.report_message)
+        return router
+    
     async def callback_query_handler(self, callback_query: types.CallbackQuery):
         """مدیریت کلی callback queries"""
-        data = callback_query.data
-        
-        try:
-            if data == "main_menu":
-                await self.show_main_menu(callback_query.message)
-            elif data == "village":
-                await self.show_village_menu(callback_query)
-            elif data == "profile":
-                await self.show_profile_menu(callback_query)
-            elif data == "clan":
-                await self.show_clan_menu(callback_query)
-            elif data == "attack":
-                await self.show_attack_menu(callback_query)
-            elif data == "leaderboard":
-                await self.show_leaderboard(callback_query)
-            elif data == "missions":
-                await self.show_missions(callback_query)
-            elif data == "daily_reward":
-                await self.claim_daily_reward(callback_query)
-            elif data == "help":
-                await self.show_help(callback_query)
-            elif data == "admin_panel":
-                await self.show_admin_panel(callback_query)
-            elif data == "attack_random":
-                await self.attack_random_player(callback_query)
-            elif data == "attack_superpower":
-                await self.attack_superpower(callback_query)
-            elif data.startswith("upgrade_"):
-                await self.upgrade_building_handler(callback_query)
-            elif data == "clan_create":
-                await self.create_clan_start(callback_query)
-            elif data == "clan_chat":
-                await self.show_clan_chat(callback_query)
-            elif data == "clan_chat_send":
-                await self.send_clan_message_start(callback_query)
-            elif data == "clan_chat_link":
-                await self.show_clan_chat_link(callback_query)
-            elif data.startswith("clan_chat_link_"):
-                await self.show_clan_chat_link(callback_query)
-            elif data.startswith("report_"):
-                await self.report_message(callback_query)
-            elif data == "admin_reports":
-                await self.show_admin_reports(callback_query)
-            elif data == "admin_panel":
-                await self.show_admin_panel(callback_query)
-            else:
-                await callback_query.answer("دکمه در حال توسعه...")
-        
-        except Exception as e:
-            logger.error(f"Error in callback handler: {e}")
-            await callback_query.answer("⚠️ خطا در پردازش درخواست!")
+        # کانتکست آپدیت (اگر از webhook نیامده باشد اینجا ساخته می‌شود)
+        with UpdateContext.scope():
+            try:
+                if not await self.callback_router.dispatch(callback_query):
+                    await callback_query.answer("دکمه در حال توسعه...")
+        
+            except Exception as e:
+                logger.error(f"Error in callback handler: {e}")
+                await callback_query.answer("⚠️ خطا در پردازش درخواست!")
     
     async def show_help(self, callback_query: types.CallbackQuery):
         """نمایش راهنما"""
@@ -2401,7 +5809,7 @@ class AmeleClashBot:
         user_id = message.from_user.id
         
         # بررسی اگر کاربر بن شده
-        user = self.db.get_user(user_id)
+        user = await self.adb.get_user(user_id)
         if user and user.banned:
             await message.answer("🚫 حساب شما مسدود شده است.")
             return
@@ -2468,9 +5876,19 @@ class AmeleClashBot:
             raise ValueError("WEBHOOK_URL environment variable is required")
         
         # ایجاد بوت و دیسپچر
-        self.bot = Bot(token=BOT_TOKEN)
-        storage = MemoryStorage()
+        server = TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION
+        self.bot = InstrumentedBot(token=BOT_TOKEN, server=server)
+        # همه ارسال‌ها (message.answer، edit_text، send_message) از صف ارسال با رعایت محدودیت‌های تلگرام عبور می‌کنند
+        self.outbound = OutboundQueue(self.bot.send_request)
+        self.outbound.start()
+        self.bot.outbound = self.outbound
+        storage = SQLiteFSMStorage()
         self.dp = Dispatcher(self.bot, storage=storage)
+        # وب‌سرور خودمان اجرا می‌شود (نه executor آیوگرام)، پس bot و dp باید در کانتکست ثبت شوند
+        # تا message.answer و Form.*.set() داخل هندلرها کار کنند
+        Bot.set_current(self.bot)
+        Dispatcher.set_current(self.dp)
+        self.scheduler = UpdateScheduler(self.dp.process_update)
         
         # تنظیم middleware
         self.dp.middleware.setup(LoggingMiddleware())
@@ -2483,9 +5901,20 @@ class AmeleClashBot:
         
         logger.info("Bot started successfully!")
         
-        # نگه داشتن برنامه در حال اجرا
-        while True:
-            await asyncio.sleep(3600)
+        # نگه داشتن برنامه در حال اجرا تا دریافت سیگنال توقف
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                pass  # ویندوز
+        
+        try:
+            await stop_event.wait()
+        finally:
+            # خاموش شدن تمیز (ذخیره بافرها و بستن اتصال‌ها)
+            await self.on_shutdown(self.dp)
 
 # ============================================================================
 # اجرای اصلی
@@ -2590,6 +6019,8 @@ if __name__ == '__main__':
 2. پنل وب:
    - آدرس: https://amele-clash-bot.onrender.com/
    - چت قبیله: https://amele-clash-bot.onrender.com/clan/{clan_id}
+   - متریک‌های Prometheus: https://amele-clash-bot.onrender.com/metrics
+   - گزارش کوئری‌های کند: https://amele-clash-bot.onrender.com/debug/queries (نیازمند DEBUG_TOKEN: ?token=...)
 
 3. دیتابیس:
    - به صورت فایل SQLite با نام db.db ذخیره می‌شود ✅